@@ -0,0 +1,126 @@
+"""
+bench_mutex.py — compare the distributed mutex algorithms in one process.
+
+Every node is a real MutexNode; only the network is replaced by an
+in-process transport with a fixed one-way latency and FIFO delivery per
+link. For each algorithm, cluster size N and contention level (how many
+nodes compete for the same resource), it reports messages per CS entry,
+acquisition latency (mean and p95) and CS entries per second.
+
+    python bench_mutex.py --nodes 3,5,9,16 --contention 0.25,1 --entries 10
+"""
+
+import argparse
+import asyncio
+import math
+import random
+import statistics
+import time
+
+from ricart_agrawala import ALGORITHMS
+
+
+class MockTransport:
+    def __init__(self, latency):
+        self.latency = latency
+        self.nodes = {}         # port -> node
+        self.last = {}          # (src, dst) -> delivery time of the previous message
+        self.messages = 0
+
+    def send(self, src, dst, msg):
+        self.messages += 1
+        loop = asyncio.get_running_loop()
+        # never overtake an earlier message on the same link
+        at = max(loop.time() + self.latency, self.last.get((src, dst), 0.0) + 1e-6)
+        self.last[(src, dst)] = at
+        loop.call_at(at, lambda: asyncio.create_task(self.nodes[dst].on_message(msg)))
+
+
+def bench_node(cls, transport, stats, cs_time):
+    class Node(cls):
+        async def send_msg(self, h, p, msg):
+            transport.send(self.port, p, dict(msg))
+
+        async def critical_section(self, rid=None):
+            if stats["inside"]:
+                stats["violations"] += 1
+            stats["inside"] += 1
+            await asyncio.sleep(cs_time)
+            stats["inside"] -= 1
+    return Node
+
+
+async def run_one(algo, n, active, entries, latency=0.001, cs_time=0.002, seed=1):
+    rng = random.Random(seed)
+    transport = MockTransport(latency)
+    stats = {"inside": 0, "violations": 0}
+    cls = bench_node(ALGORITHMS[algo], transport, stats, cs_time)
+    ports = [7000 + i for i in range(n)]
+    nodes = []
+    for i, p in enumerate(ports):
+        node = cls(i + 1, "127.0.0.1", p, [("127.0.0.1", q) for q in ports if q != p])
+        node.verbose = False
+        transport.nodes[p] = node
+        nodes.append(node)
+
+    waits = []
+
+    async def worker(node):
+        for _ in range(entries):
+            await asyncio.sleep(rng.uniform(0, cs_time))   # think time
+            t0 = time.perf_counter()
+            await node.acquire("f")
+            waits.append(time.perf_counter() - t0)
+            try:
+                await node.critical_section("f")
+            finally:
+                await node.release("f")
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(nd) for nd in rng.sample(nodes, active)))
+    elapsed = time.perf_counter() - t0
+    await asyncio.sleep(latency * 4)   # let trailing RELEASE/TOKEN messages land
+
+    waits.sort()
+    done = active * entries
+    return {
+        "algo": algo, "n": n, "active": active,
+        "msgs_per_entry": transport.messages / done,
+        "mean_ms": statistics.mean(waits) * 1000,
+        "p95_ms": waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000,
+        "per_sec": done / elapsed,
+        "violations": stats["violations"],
+    }
+
+
+async def run_all(args):
+    rows = []
+    for n in [int(x) for x in args.nodes.split(",")]:
+        for c in [float(x) for x in args.contention.split(",")]:
+            active = max(1, min(n, math.ceil(n * c)))
+            for algo in args.algos.split(","):
+                rows.append(await run_one(algo, n, active, args.entries,
+                                          args.latency_ms / 1000, args.cs_ms / 1000))
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nodes", default="3,5,9,16", help="cluster sizes")
+    ap.add_argument("--contention", default="0.25,1", help="fractions of nodes competing")
+    ap.add_argument("--entries", type=int, default=10, help="CS entries per competing node")
+    ap.add_argument("--algos", default=",".join(ALGORITHMS))
+    ap.add_argument("--latency-ms", type=float, default=1.0, help="one-way message latency")
+    ap.add_argument("--cs-ms", type=float, default=2.0, help="time spent inside the CS")
+    args = ap.parse_args()
+
+    rows = asyncio.run(run_all(args))
+    print(f"{'algo':8} {'N':>3} {'active':>6} {'msgs/entry':>10} {'mean ms':>8} "
+          f"{'p95 ms':>8} {'entries/s':>9} {'unsafe':>6}")
+    for r in rows:
+        print(f"{r['algo']:8} {r['n']:3d} {r['active']:6d} {r['msgs_per_entry']:10.1f} "
+              f"{r['mean_ms']:8.1f} {r['p95_ms']:8.1f} {r['per_sec']:9.0f} {r['violations']:6d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,619 @@
+"""
+dist_mutex.py — distributed mutual exclusion behind one interface.
+
+Every algorithm is a MutexNode. Nodes talk over persistent, pipelined
+connections (PeerChannel) using JSON-line messages stamped with a Lamport
+clock, and lock any number of resources (file ids) independently:
+
+    await node.acquire(rid)      # returns once this node holds rid
+    await node.release(rid)
+    await node.request_cs(rid)   # acquire, critical_section(rid), release
+
+Messages per CS entry with N nodes and no contention:
+    RANode            (ricart_agrawala.py) 2(N-1)
+    MaekawaNode       grid quorum voting   3 per quorum member, ~2*sqrt(N) members
+    SuzukiKasamiNode  broadcast token      N, or 0 if it already holds the token
+    LeaseNode         central coordinator  3, or 0 on the coordinator; leases expire
+"""
+
+import asyncio
+import heapq
+import json
+import math
+import random
+from collections import deque
+
+DEFAULT_RESOURCE = "_"   # what messages without a "res" field refer to
+
+
+def addr_of(key):
+    return f"{key[0]}:{key[1]}"
+
+
+def key_of(addr):
+    h, p = addr.rsplit(":", 1)
+    return (h, int(p))
+
+
+class PeerChannel:
+    """
+    Long-lived outgoing connection to one peer. Messages are queued and written
+    back to back as JSON lines (pipelined, one drain per burst) by a single task,
+    so order is kept. If the connection breaks it is reopened with backoff and
+    the unsent burst is written again.
+    """
+
+    def __init__(self, node_id, host, port, max_backoff=2.0, log=None):
+        self.node_id = node_id
+        self.log = log or (lambda *args: print(f"[{node_id}]", *args))
+        self.host = host
+        self.port = port
+        self.max_backoff = max_backoff
+        self.queue = asyncio.Queue()
+        self.writer = None
+        self.task = None
+        self.connects = 0
+
+    def send(self, msg):
+        self.queue.put_nowait(msg)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _connect(self):
+        backoff = 0.05
+        while True:
+            try:
+                _, self.writer = await asyncio.open_connection(self.host, self.port)
+                self.connects += 1
+                return
+            except OSError:
+                self.log(f"couldn't connect to {self.host}:{self.port}, retrying")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _drop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            data = "".join(json.dumps(m) + "\n" for m in batch).encode()
+            while True:
+                if self.writer is None:
+                    await self._connect()
+                try:
+                    self.writer.write(data)
+                    await self.writer.drain()
+                    break
+                except (ConnectionError, OSError):
+                    self.log(f"lost connection to {self.host}:{self.port}, reconnecting")
+                    self._drop()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.writer = None
+
+
+class MutexNode:
+    """Network plumbing and the acquire/release interface shared by all algorithms."""
+
+    # message type -> handler method name
+    handlers = {}
+
+    def __init__(self, node_id, host, port, peers):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self.addr = f"{host}:{port}"
+        self.key = (host, port)
+        self.peers = peers
+        # everyone, this node included, in the same order on every node
+        self.members = sorted(set(peers) | {self.key})
+
+        #lamport clock stuff
+        self.clock = 0
+
+        # one persistent outgoing connection per peer
+        self.channels = {}
+        self.server = None
+        self.inbound = {}       # writer -> task reading that connection
+        self.verbose = True
+
+    def log(self, *args):
+        if self.verbose:
+            print(f"[{self.node_id}]", *args)
+
+    # Clock Helpers
+
+    def bump_clock(self):
+        self.clock += 1
+        return self.clock
+
+    def adjust_clock(self, ts):
+        # lamport rule
+        self.clock = max(self.clock, ts) + 1
+
+    def stamp(self, mtype, rid, **fields):
+        msg = {"type": mtype, "from": self.node_id, "addr": self.addr, "ts": self.bump_clock()}
+        if rid != DEFAULT_RESOURCE:
+            msg["res"] = rid
+        msg.update(fields)
+        return msg
+
+    # Network Stuff
+
+    async def send_msg(self, h, p, msg):
+        # queued on the peer's persistent connection; its channel task writes it
+        ch = self.channels.get((h, p))
+        if ch is None:
+            ch = self.channels[(h, p)] = PeerChannel(self.node_id, h, p, log=self.log)
+        ch.send(msg)
+
+    async def send_to(self, key, msg):
+        # members include this node; messages to itself skip the network
+        if key == self.key:
+            asyncio.create_task(self.on_message(msg))
+        else:
+            await self.send_msg(key[0], key[1], msg)
+
+    async def send_to_all(self, msg):
+        tasks = []
+        for (h, p) in self.peers:
+            tasks.append(self.send_msg(h, p, msg))
+        await asyncio.gather(*tasks)
+
+    # this handles incoming connections from other nodes: one per peer,
+    # carrying any number of messages, handled in order
+    async def handle_conn(self, reader, writer):
+        self.inbound[writer] = asyncio.current_task()
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                try:
+                    msg = json.loads(data.decode().strip())
+                except json.JSONDecodeError as e:
+                    print(f"[{self.node_id}] bad msg:", e)
+                    continue
+                await self.on_message(msg)
+        except (ConnectionError, OSError) as e:
+            print(f"[{self.node_id}] error reading msg:", e)
+        finally:
+            self.inbound.pop(writer, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def start_server(self):
+        self.server = await asyncio.start_server(self.handle_conn, self.host, self.port)
+        print(f"[{self.node_id}] listens on {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        for ch in self.channels.values():
+            await ch.close()
+        if self.server is not None:
+            self.server.close()
+        # closing the inbound side ends their read loops normally
+        readers = list(self.inbound.values())
+        for w in list(self.inbound):
+            w.close()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+    async def on_message(self, msg):
+        #clock synced
+        self.adjust_clock(msg.get("ts", 0))
+        name = self.handlers.get(msg.get("type"))
+        if name is not None:
+            await getattr(self, name)(msg)
+
+    # Mutex interface
+
+    async def acquire(self, rid=DEFAULT_RESOURCE):
+        raise NotImplementedError
+
+    async def release(self, rid=DEFAULT_RESOURCE):
+        raise NotImplementedError
+
+    def lease_remaining(self, rid=DEFAULT_RESOURCE):
+        """Seconds left on the hold of rid, or None if holds don't expire."""
+        return None
+
+    async def request_cs(self, rid=DEFAULT_RESOURCE):
+        await self.acquire(rid)
+        try:
+            left = self.lease_remaining(rid)
+            if left is None:
+                await self.critical_section(rid)
+            else:
+                # the CS is cut short when the lease runs out (raises TimeoutError)
+                await asyncio.wait_for(self.critical_section(rid), max(left, 0))
+        finally:
+            await self.release(rid)
+
+    async def critical_section(self, rid=DEFAULT_RESOURCE):
+        print(f"\n[{self.node_id}] entered crit section ({rid})\n")
+        await asyncio.sleep(1.2)  # fake work
+        print(f"\n[{self.node_id}]  exited crit section ({rid})\n")
+
+    # Main
+
+    async def run(self, attempts=3, resources=(DEFAULT_RESOURCE,)):
+        asyncio.create_task(self.start_server())
+        await asyncio.sleep(3)  # wait for all servers to start
+
+        for i in range(attempts):
+            await asyncio.sleep(random.uniform(0.5, 2))
+            rid = random.choice(resources)
+            print(f"[{self.node_id}] trying to enter CS for {rid} (attempt {i+1})")
+            try:
+                await self.request_cs(rid)
+            except asyncio.TimeoutError as e:
+                print(f"[{self.node_id}] gave up: {e or 'lease expired'}")
+
+        print(f"[{self.node_id}] finished all attempts. Exiting.")
+        while True:
+            await asyncio.sleep(9999)
+
+
+# Maekawa
+
+def grid_quorum(members, key):
+    """
+    key's row plus its column in a ceil(sqrt(N))-wide grid of the members.
+    Missing cells of the last row wrap around to the first members, so cell
+    (row of a, column of b) always exists and any two quorums intersect.
+    """
+    n = len(members)
+    k = math.ceil(math.sqrt(n))
+    rows = math.ceil(n / k)
+    r, c = divmod(members.index(key), k)
+    cells = [r * k + j for j in range(k)] + [i * k + c for i in range(rows)]
+    return sorted({members[x % n] for x in cells})
+
+
+class _Ballot:
+    """Maekawa state for one resource: our vote as a quorum member, and our own request."""
+
+    def __init__(self):
+        # voter side
+        self.granted = None     # (ts, node_id, addr) holding our vote
+        self.waiting = []       # heap of requests waiting for it
+        self.inquired = False
+        # requester side
+        self.state = "RELEASED"
+        self.request_ts = None
+        self.grants = set()
+        self.inquiries = set()  # voters asking for their vote back
+        self.failed = False     # some voter prefers another request
+        self.got_quorum = asyncio.Event()
+        self.queue = asyncio.Lock()
+
+
+class MaekawaNode(MutexNode):
+    """
+    Maekawa's quorum voting with Sanders' deadlock avoidance. A request only
+    needs the votes of its grid quorum; a voter backs exactly one request at a
+    time. A voter that sees a better (older) request INQUIREs whether the
+    current holder can give the vote back, and a requester that knows it
+    cannot win yet (it got FAILED) RELINQUISHes.
+    """
+
+    handlers = {"REQUEST": "handle_request", "LOCKED": "handle_locked",
+                "FAILED": "handle_failed", "INQUIRE": "handle_inquire",
+                "RELINQUISH": "handle_relinquish", "RELEASE": "handle_release"}
+
+    def __init__(self, node_id, host, port, peers):
+        super().__init__(node_id, host, port, peers)
+        self.quorum = grid_quorum(self.members, self.key)
+        self.ballots = {}
+
+    def ballot(self, rid):
+        b = self.ballots.get(rid)
+        if b is None:
+            b = self.ballots[rid] = _Ballot()
+        return b
+
+    # voter side
+
+    async def handle_request(self, msg):
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        b = self.ballot(rid)
+        req = (msg["ts"], msg["from"], msg["addr"])
+        if b.granted is None:
+            await self._vote(rid, b, req)
+            return
+        best = b.waiting[0] if b.waiting else None
+        heapq.heappush(b.waiting, req)
+        if req < b.granted and (best is None or req < best):
+            # new best candidate: the one it displaced can't win here for now
+            if best is not None:
+                await self.send_to(key_of(best[2]), self.stamp("FAILED", rid, req=best[0]))
+            if not b.inquired:
+                b.inquired = True
+                await self.send_to(key_of(b.granted[2]),
+                                   self.stamp("INQUIRE", rid, req=b.granted[0]))
+        else:
+            await self.send_to(key_of(req[2]), self.stamp("FAILED", rid, req=req[0]))
+
+    async def _vote(self, rid, b, req):
+        b.granted = req
+        b.inquired = False
+        await self.send_to(key_of(req[2]), self.stamp("LOCKED", rid, req=req[0]))
+
+    def _holds_vote(self, b, msg):
+        return b.granted is not None and (b.granted[2], b.granted[0]) == (msg["addr"], msg["req"])
+
+    async def handle_relinquish(self, msg):
+        b = self.ballot(msg.get("res", DEFAULT_RESOURCE))
+        if self._holds_vote(b, msg):
+            heapq.heappush(b.waiting, b.granted)
+            await self._vote(msg.get("res", DEFAULT_RESOURCE), b, heapq.heappop(b.waiting))
+
+    async def handle_release(self, msg):
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        b = self.ballot(rid)
+        if not self._holds_vote(b, msg):
+            return
+        b.granted = None
+        if b.waiting:
+            await self._vote(rid, b, heapq.heappop(b.waiting))
+
+    # requester side
+
+    def _current(self, msg):
+        b = self.ballot(msg.get("res", DEFAULT_RESOURCE))
+        if b.state == "WANTED" and msg.get("req") == b.request_ts:
+            return b
+        return None   # about a request we no longer have
+
+    async def handle_locked(self, msg):
+        b = self._current(msg)
+        if b is None:
+            return
+        b.grants.add(key_of(msg["addr"]))
+        if b.grants.issuperset(self.quorum):
+            b.got_quorum.set()
+
+    async def handle_failed(self, msg):
+        b = self._current(msg)
+        if b is None or b.got_quorum.is_set():
+            return
+        b.failed = True
+        for k in list(b.inquiries):
+            await self._relinquish(msg.get("res", DEFAULT_RESOURCE), b, k)
+
+    async def handle_inquire(self, msg):
+        b = self._current(msg)
+        k = key_of(msg["addr"])
+        if b is None or b.got_quorum.is_set() or k not in b.grants:
+            return   # in (or entering) the CS: the RELEASE answers it
+        if b.failed:
+            await self._relinquish(msg.get("res", DEFAULT_RESOURCE), b, k)
+        else:
+            b.inquiries.add(k)
+
+    async def _relinquish(self, rid, b, k):
+        b.grants.discard(k)
+        b.inquiries.discard(k)
+        await self.send_to(k, self.stamp("RELINQUISH", rid, req=b.request_ts))
+
+    async def acquire(self, rid=DEFAULT_RESOURCE):
+        b = self.ballot(rid)
+        await b.queue.acquire()
+        req = self.stamp("REQUEST", rid)
+        b.state = "WANTED"
+        b.request_ts = req["ts"]
+        b.grants, b.inquiries, b.failed = set(), set(), False
+        b.got_quorum.clear()
+        self.log(f"REQUEST {rid} to quorum of {len(self.quorum)}")
+        await asyncio.gather(*(self.send_to(k, dict(req)) for k in self.quorum))
+        await b.got_quorum.wait()
+        b.state = "HELD"
+
+    async def release(self, rid=DEFAULT_RESOURCE):
+        b = self.ballot(rid)
+        msg = self.stamp("RELEASE", rid, req=b.request_ts)
+        b.state = "RELEASED"
+        b.request_ts = None
+        await asyncio.gather(*(self.send_to(k, dict(msg)) for k in self.quorum))
+        b.queue.release()
+
+
+# Suzuki-Kasami
+
+class _TokenState:
+    def __init__(self, holder):
+        self.state = "RELEASED"
+        self.rn = {}            # addr -> highest request number seen
+        # the token: last served request number per addr, and who gets it next
+        self.token = {"ln": {}, "q": []} if holder else None
+        self.got_token = asyncio.Event()
+        self.queue = asyncio.Lock()
+
+
+class SuzukiKasamiNode(MutexNode):
+    """
+    Suzuki-Kasami broadcast token. A node enters while it holds the token;
+    to get it, it broadcasts a numbered REQUEST and the holder passes the
+    token on when it leaves. The first member holds every token initially.
+    """
+
+    handlers = {"REQUEST": "handle_request", "TOKEN": "handle_token"}
+
+    def __init__(self, node_id, host, port, peers):
+        super().__init__(node_id, host, port, peers)
+        self.tokens = {}
+
+    def token_state(self, rid):
+        s = self.tokens.get(rid)
+        if s is None:
+            s = self.tokens[rid] = _TokenState(self.key == self.members[0])
+        return s
+
+    async def acquire(self, rid=DEFAULT_RESOURCE):
+        s = self.token_state(rid)
+        await s.queue.acquire()
+        s.state = "WANTED"
+        if s.token is None:
+            s.rn[self.addr] = s.rn.get(self.addr, 0) + 1
+            s.got_token.clear()
+            self.log(f"REQUEST {rid} #{s.rn[self.addr]}")
+            await self.send_to_all(self.stamp("REQUEST", rid, sn=s.rn[self.addr]))
+            await s.got_token.wait()
+        s.state = "HELD"
+
+    async def release(self, rid=DEFAULT_RESOURCE):
+        s = self.token_state(rid)
+        s.state = "RELEASED"
+        tok = s.token
+        tok["ln"][self.addr] = s.rn.get(self.addr, 0)
+        # queue everyone with an outstanding request, starting after us so no one starves
+        i = self.members.index(self.key)
+        for k in self.members[i + 1:] + self.members[:i]:
+            a = addr_of(k)
+            if a not in tok["q"] and s.rn.get(a, 0) == tok["ln"].get(a, 0) + 1:
+                tok["q"].append(a)
+        if tok["q"]:
+            await self._pass_token(rid, s, tok["q"].pop(0))
+        s.queue.release()
+
+    async def _pass_token(self, rid, s, addr):
+        tok, s.token = s.token, None
+        await self.send_to(key_of(addr), self.stamp("TOKEN", rid, token=tok))
+
+    async def handle_request(self, msg):
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        s = self.token_state(rid)
+        a = msg["addr"]
+        s.rn[a] = max(s.rn.get(a, 0), msg["sn"])
+        if (s.token is not None and s.state == "RELEASED"
+                and s.rn[a] == s.token["ln"].get(a, 0) + 1):
+            await self._pass_token(rid, s, a)
+
+    async def handle_token(self, msg):
+        s = self.token_state(msg.get("res", DEFAULT_RESOURCE))
+        s.token = msg["token"]
+        s.got_token.set()
+
+
+# Lease coordinator
+
+class _Lease:
+    def __init__(self):
+        # coordinator side
+        self.holder = None      # (addr, lease id)
+        self.waiting = deque()
+        self.seq = 0
+        self.timer = None
+        # client side
+        self.lease = None
+        self.valid_until = 0.0
+        self.got_lease = asyncio.Event()
+        self.queue = asyncio.Lock()
+
+
+class LeaseNode(MutexNode):
+    """
+    One coordinator (the first member) grants time-bounded leases in FIFO
+    order. A holder that doesn't release within lease_ttl loses the lease and
+    the coordinator moves on, so a crashed holder blocks the resource for at
+    most lease_ttl; request_cs() cuts the CS short at that point. Holders count
+    the lease from when they asked for it, which errs on the safe side.
+    """
+
+    handlers = {"LEASE_REQ": "handle_lease_req", "LEASE_GRANT": "handle_lease_grant",
+                "LEASE_RELEASE": "handle_lease_release"}
+
+    def __init__(self, node_id, host, port, peers, lease_ttl=5.0):
+        super().__init__(node_id, host, port, peers)
+        self.coordinator = self.members[0]
+        self.lease_ttl = lease_ttl
+        self.leases = {}
+
+    def lease(self, rid):
+        s = self.leases.get(rid)
+        if s is None:
+            s = self.leases[rid] = _Lease()
+        return s
+
+    def lease_valid(self, rid=DEFAULT_RESOURCE):
+        left = self.lease_remaining(rid)
+        return left is not None and left > 0
+
+    def lease_remaining(self, rid=DEFAULT_RESOURCE):
+        s = self.lease(rid)
+        if s.lease is None:
+            return None
+        return s.valid_until - asyncio.get_running_loop().time()
+
+    async def acquire(self, rid=DEFAULT_RESOURCE):
+        s = self.lease(rid)
+        await s.queue.acquire()
+        s.got_lease.clear()
+        asked = asyncio.get_running_loop().time()
+        await self.send_to(self.coordinator, self.stamp("LEASE_REQ", rid))
+        await s.got_lease.wait()
+        s.valid_until = asked + self.lease_ttl
+
+    async def release(self, rid=DEFAULT_RESOURCE):
+        s = self.lease(rid)
+        await self.send_to(self.coordinator, self.stamp("LEASE_RELEASE", rid, lease=s.lease))
+        s.lease = None
+        s.queue.release()
+
+    async def handle_lease_grant(self, msg):
+        s = self.lease(msg.get("res", DEFAULT_RESOURCE))
+        s.lease = msg["lease"]
+        s.got_lease.set()
+
+    # coordinator side
+
+    async def handle_lease_req(self, msg):
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        s = self.lease(rid)
+        if s.holder is None:
+            await self._grant(rid, s, msg["addr"])
+        elif msg["addr"] not in s.waiting:
+            s.waiting.append(msg["addr"])
+
+    async def handle_lease_release(self, msg):
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        s = self.lease(rid)
+        if s.holder == (msg["addr"], msg.get("lease")):
+            s.timer.cancel()
+            await self._next(rid, s)
+
+    async def _grant(self, rid, s, addr):
+        s.seq += 1
+        s.holder = (addr, s.seq)
+        s.timer = asyncio.get_running_loop().call_later(
+            self.lease_ttl, lambda seq=s.seq: asyncio.create_task(self._expire(rid, seq)))
+        await self.send_to(key_of(addr), self.stamp("LEASE_GRANT", rid, lease=s.seq,
+                                                    ttl=self.lease_ttl))
+
+    async def _expire(self, rid, seq):
+        s = self.lease(rid)
+        if s.holder is not None and s.holder[1] == seq:
+            self.log(f"lease {seq} on {rid} held by {s.holder[0]} expired")
+            await self._next(rid, s)
+
+    async def _next(self, rid, s):
+        s.holder = None
+        if s.waiting:
+            await self._grant(rid, s, s.waiting.popleft())
@@ -0,0 +1,230 @@
+"""
+admission.py  (Admission Control & Rate Limiting)
+
+Sits in front of the routes as a plain ASGI middleware:
+- Per-user token buckets keyed by X-User-Id (separate for writes and reads)
+- Separate concurrency pools for writes (uploads, updates, shares) and reads,
+  so bulk transfers can't occupy every worker thread
+- Bounded wait queues: when a pool is full, requests wait briefly and are
+  otherwise rejected fast with 503 + Retry-After
+- Rate limited requests get 429 + Retry-After
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from starlette.responses import JSONResponse
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills `rate` tokens per second up to `burst`.
+    try_take() never blocks; it returns how long the caller should wait.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self, n: float = 1.0) -> float:
+        """Take n tokens. Returns 0.0 on success, else seconds until n are available."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            if self.rate <= 0:
+                return float("inf")
+            return (n - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Per-key token buckets. Idle keys are evicted LRU-style to bound memory."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, key: str) -> float:
+        if self.rate <= 0:
+            return 0.0  # limiting disabled
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_take()
+
+
+class ConcurrencyPool:
+    """
+    Caps in-flight requests of one class. At most `max_waiting` requests may
+    queue for a slot, each for at most `wait_timeout` seconds.
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int, wait_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        if not self._sem.locked():
+            await self._sem.acquire()
+            self.in_flight += 1
+            return True
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._sem.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+# Paths that bypass admission control entirely (cheap + needed for ops)
+EXEMPT_PREFIXES = ("/health", "/static", "/docs", "/redoc", "/openapi.json")
+
+# Anything that changes state (uploads, updates, shares) goes to the upload class
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    """Map a request onto a traffic class: 'upload' (writes), 'read', or None (exempt)."""
+    if path == "/" or path.startswith(EXEMPT_PREFIXES):
+        return None
+    if method in WRITE_METHODS:
+        return "upload"
+    return "read"
+
+
+class AdmissionController:
+    """Holds the per-class rate limiters and pools. Configured via env vars."""
+
+    def __init__(self):
+        self.pools = {
+            "upload": ConcurrencyPool(
+                "upload",
+                limit=int(_env_float("ADMISSION_UPLOAD_CONCURRENCY", 4)),
+                max_waiting=int(_env_float("ADMISSION_UPLOAD_QUEUE", 16)),
+                wait_timeout=_env_float("ADMISSION_QUEUE_TIMEOUT", 2.0),
+            ),
+            "read": ConcurrencyPool(
+                "read",
+                limit=int(_env_float("ADMISSION_READ_CONCURRENCY", 32)),
+                max_waiting=int(_env_float("ADMISSION_READ_QUEUE", 64)),
+                wait_timeout=_env_float("ADMISSION_QUEUE_TIMEOUT", 2.0),
+            ),
+        }
+        self.limiters = {
+            "upload": RateLimiter(
+                rate=_env_float("RATE_LIMIT_UPLOADS_PER_SEC", 2.0),
+                burst=_env_float("RATE_LIMIT_UPLOADS_BURST", 10.0),
+            ),
+            "read": RateLimiter(
+                rate=_env_float("RATE_LIMIT_READS_PER_SEC", 20.0),
+                burst=_env_float("RATE_LIMIT_READS_BURST", 40.0),
+            ),
+        }
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+
+def _reject(status: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def _user_from_scope(scope) -> str:
+    for k, v in scope.get("headers", []):
+        if k == b"x-user-id":
+            return v.decode("latin-1")
+    return "anonymous"
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware. The pool slot is held until the response has been fully
+    sent, so streamed downloads count against the read pool for their whole
+    duration.
+    """
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        cls = classify(scope["method"], scope["path"])
+        if cls is None:
+            await self.app(scope, receive, send)
+            return
+
+        # 1) Per-user rate limit — cheap, rejects before touching the pool
+        wait = self.controller.limiters[cls].check(_user_from_scope(scope))
+        if wait > 0:
+            await _reject(429, f"Rate limit exceeded for {cls} requests", wait)(scope, receive, send)
+            return
+
+        # 2) Concurrency pool with bounded queue
+        pool = self.controller.pools[cls]
+        if not await pool.acquire():
+            await _reject(503, f"Server busy ({cls} pool saturated)", 1)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release()
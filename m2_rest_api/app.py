@@ -1,34 +1,65 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Response, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Response, Depends, Query
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from sqlalchemy import or_
 
-from db import Base, engine, SessionLocal
+from db import SessionLocal, init_schema
 from models import FileMeta, Share
 from mq import MqPublisher
 
 # --- M4 ADDITION: Transaction Locking Helper ---
-from transactions import acquire_file_lock
+from transactions import (acquire_file_lock, check_file_lock, start_lock_backend,
+                          close_lock_backend, LockTimeout)
 # -----------------------------------------------
+from admission import AdmissionController, AdmissionMiddleware
+from search import index_file, search_files
+from maintenance import StorageScrubber
+from storage import STORAGE_DIR, blob_path, checksum, stage_blob, publish_blob, restore_blob, discard_blob
+from usage import QuotaExceeded, QUOTA_BYTES, QUOTA_FILES, check_quota, apply_usage_delta, get_usage
 
-# Initialize DB
-Base.metadata.create_all(bind=engine)
-
-STORAGE_DIR = os.path.join(os.getcwd(), "storage")
-os.makedirs(STORAGE_DIR, exist_ok=True)
+# Message queue publisher (safe even if broker is down; connects in background)
+publisher = MqPublisher()
 
-app = FastAPI(title="File Sync/Share — Milestone 2 REST API")
+# Background storage GC + integrity scrubber (rate-limited, off the request path)
+scrubber = StorageScrubber(SessionLocal)
+
+# --- Startup/shutdown: nothing slow happens at import time ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    init_schema()        # cached: one PRAGMA read when the schema is current
+    publisher.start()    # broker connect + retry runs on a daemon thread
+    if os.environ.get("SCRUB_ENABLED", "1") == "1":
+        scrubber.start()
+    start_lock_backend() # no-op unless FILE_LOCK_BACKEND=ra
+    yield
+    close_lock_backend()
+    scrubber.close()
+    publisher.close()
+
+app = FastAPI(title="File Sync/Share — Milestone 2 REST API", lifespan=lifespan)
+
+# Admission control: per-user rate limits + separate upload/read pools
+admission = AdmissionController()
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
+# Another writer (possibly on another replica) held the file lock too long
+@app.exception_handler(LockTimeout)
+def lock_timeout(request, exc: LockTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": "1"})
 
 # Serve static assets for demo UI
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
 @app.get("/", response_class=HTMLResponse)
 def spotify_demo_root():
     """Serve the Spotify-style demo UI."""
@@ -38,11 +69,9 @@ def spotify_demo_root():
     with open(html_path, "r", encoding="utf-8") as f:
         return f.read()
 
-# Message queue publisher (safe even if broker is down)
-publisher = MqPublisher()
-
 # --- Dependency: DB session per request ---
 def get_db():
+    init_schema()  # no-op once lifespan has run
     db = SessionLocal()
     try:
         yield db
@@ -67,6 +96,22 @@ class FileOut(BaseModel):
     class Config:
         from_attributes = True
 
+class UsageOut(BaseModel):
+    user_id: str
+    bytes_used: int
+    file_count: int
+    shared_with_count: int
+    quota_bytes: int
+    quota_files: int
+
+def _upload_size(uploaded: UploadFile) -> int:
+    # Size of the spooled upload without reading it into memory
+    f = uploaded.file
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
+
 class ShareIn(BaseModel):
     target_user_id: str
 
@@ -79,7 +124,12 @@ class ShareOut(BaseModel):
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "time": datetime.utcnow().isoformat()}
+    return {
+        "status": "ok",
+        "time": datetime.utcnow().isoformat(),
+        "mq_connected": publisher.connected,
+        "admission": admission.stats(),
+    }
 
 @app.post("/files", response_model=FileOut, status_code=201)
 def upload_file(
@@ -88,9 +138,17 @@ def upload_file(
     user_id: str = Depends(require_user),
     db: Session = Depends(get_db),
 ):
-    # Persist file content to disk
+    # Quota check before any bytes are written to disk
+    size = _upload_size(uploaded)
+    try:
+        check_quota(db, user_id, size, files_delta=1)
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    # Stage file content on disk; it only becomes visible after the commit
     content = uploaded.file.read()
     size = len(content)
+    tmp_path = stage_blob(content)
 
     meta = FileMeta(
         filename=uploaded.filename,
@@ -98,16 +156,32 @@ def upload_file(
         owner_id=user_id,
         version=1,
         size_bytes=size,
+        checksum=checksum(content),
     )
     db.add(meta)
-    db.commit()
+    published = False
+    try:
+        apply_usage_delta(db, user_id, bytes_delta=size, files_delta=1)  # same transaction
+        db.flush()
+        index_file(db, meta)  # same transaction
+        file_id = meta.id
+        # Move bytes into place under STORAGE_DIR/<file_id>; undone if the commit fails
+        publish_blob(tmp_path, file_id)
+        published = True
+        db.commit()
+    except QuotaExceeded as e:
+        db.rollback()
+        discard_blob(tmp_path)
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception:
+        db.rollback()
+        if published:
+            restore_blob(None, file_id)
+        else:
+            discard_blob(tmp_path)
+        raise
     db.refresh(meta)
 
-    # Save bytes under STORAGE_DIR/<file_id>
-    disk_path = os.path.join(STORAGE_DIR, meta.id)
-    with open(disk_path, "wb") as f:
-        f.write(content)
-
     response.headers["ETag"] = f'"{meta.version}"'
     # MQ event
     publisher.publish(
@@ -130,6 +204,30 @@ def list_files(
     )
     return q.all()
 
+# NOTE: must be registered before /files/{file_id} so "search" isn't taken as an id
+@app.get("/files/search", response_model=List[FileOut])
+def search(
+    q: str = "",
+    prefix: bool = True,
+    scope: str = Query(default="all", pattern="^(all|owned|shared)$"),
+    owner: Optional[str] = None,
+    content_type: Optional[str] = None,
+    min_size: Optional[int] = Query(default=None, ge=0),
+    max_size: Optional[int] = Query(default=None, ge=0),
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    limit: int = Query(default=50, ge=1, le=200),
+    offset: int = Query(default=0, ge=0),
+    user_id: str = Depends(require_user),
+    db: Session = Depends(get_db),
+):
+    return search_files(
+        db, user_id, q=q, prefix=prefix, scope=scope, owner=owner,
+        content_type=content_type, min_size=min_size, max_size=max_size,
+        created_after=created_after, created_before=created_before,
+        limit=limit, offset=offset,
+    )
+
 @app.get("/files/{file_id}")
 def download_file(
     file_id: str,
@@ -149,7 +247,7 @@ def download_file(
     if meta.owner_id != user_id and not shared:
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    disk_path = os.path.join(STORAGE_DIR, meta.id)
+    disk_path = blob_path(meta.id)
     if not os.path.exists(disk_path):
         raise HTTPException(status_code=410, detail="File content missing")
 
@@ -192,27 +290,62 @@ def update_file(
     # === M4 ADDITION: Pessimistic CC + Transactional Wrapper ===
     # ============================================================
     with acquire_file_lock(file_id):  # prevents concurrent writers to same file_id
+        # Another replica may have committed while we waited for the lock
+        db.refresh(meta)
+        if f'"{meta.version}"' != expected:
+            raise HTTPException(
+                status_code=409,
+                detail=f'Version mismatch. Current ETag is "{meta.version}". Provide If-Match header.',
+            )
+
+        # Quota check on the size difference before touching disk
+        try:
+            check_quota(db, user_id, _upload_size(uploaded) - meta.size_bytes)
+        except QuotaExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        tmp_path = None
+        published, backup = False, None
         try:
-            # Replace content on disk
+            # Stage new content next to the live blob
             content = uploaded.file.read()
             size = len(content)
-            disk_path = os.path.join(STORAGE_DIR, meta.id)
-            with open(disk_path, "wb") as f:
-                f.write(content)
+            apply_usage_delta(db, user_id, bytes_delta=size - meta.size_bytes)
+            tmp_path = stage_blob(content)
 
             # Bump version and timestamps in DB (single transaction)
             meta.version += 1
             meta.size_bytes = size
+            meta.checksum = checksum(content)
             meta.updated_at = datetime.utcnow()
             db.add(meta)
+            index_file(db, meta)
+            db.flush()
+            # the cluster-wide hold must still be good when the new version lands
+            check_file_lock(file_id)
+            # Swap the content in, keeping the old blob until the commit succeeds
+            backup = publish_blob(tmp_path, file_id)
+            published = True
             db.commit()      # COMMIT = transaction success
-            db.refresh(meta)
+        except QuotaExceeded as e:
+            db.rollback()
+            raise HTTPException(status_code=413, detail=str(e))
+        except LockTimeout:
+            db.rollback()    # nothing published yet: answered 503 by lock_timeout
+            discard_blob(tmp_path)
+            raise
         except Exception as e:
             db.rollback()    # ABORT = rollback on error
+            if published:
+                restore_blob(backup, file_id)  # disk goes back with the DB
+            else:
+                discard_blob(tmp_path)
             raise HTTPException(
                 status_code=500,
                 detail=f"Transactional update failed and was rolled back: {str(e)}"
             )
+        discard_blob(backup)
+        db.refresh(meta)
     # ============================================================
     # === END OF M4 ADDITION =====================================
     # ============================================================
@@ -246,6 +379,7 @@ def share_file(
 
     s = Share(file_id=file_id, target_user_id=share.target_user_id)
     db.add(s)
+    apply_usage_delta(db, share.target_user_id, shared_delta=1)  # same transaction
     db.commit()
     db.refresh(s)
     publisher.publish(
@@ -267,3 +401,45 @@ def list_shares(
 
     shares = db.query(Share).filter(Share.file_id == file_id).all()
     return shares
+
+@app.get("/usage", response_model=UsageOut)
+def my_usage(
+    user_id: str = Depends(require_user),
+    db: Session = Depends(get_db),
+):
+    # Primary-key lookup on the aggregate row (backfilled once if missing)
+    usage = get_usage(db, user_id)
+    db.commit()
+    return UsageOut(
+        user_id=usage.user_id,
+        bytes_used=usage.bytes_used,
+        file_count=usage.file_count,
+        shared_with_count=usage.shared_with_count,
+        quota_bytes=QUOTA_BYTES,
+        quota_files=QUOTA_FILES,
+    )
+
+# Callers allowed to see the scrubber report for every file
+ADMIN_USERS = {u.strip() for u in os.environ.get("ADMIN_USER_IDS", "").split(",") if u.strip()}
+
+@app.get("/maintenance/storage")
+def storage_report(
+    user_id: str = Depends(require_user),
+    db: Session = Depends(get_db),
+):
+    # Last scrubber pass: corrupt blobs, missing content, reclaimed orphans.
+    # Admins see every file; anyone else only the files they own.
+    report = scrubber.report
+    if user_id in ADMIN_USERS:
+        return report
+    corrupt, missing = report.get("corrupt", []), report.get("missing", [])
+    ids = [c["file_id"] for c in corrupt] + missing
+    owned = {
+        fid for (fid,) in
+        db.query(FileMeta.id).filter(FileMeta.id.in_(ids), FileMeta.owner_id == user_id)
+    } if ids else set()
+    return {
+        **report,
+        "corrupt": [c for c in corrupt if c["file_id"] in owned],
+        "missing": [fid for fid in missing if fid in owned],
+    }
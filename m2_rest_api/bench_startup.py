@@ -0,0 +1,73 @@
+"""
+bench_startup.py — cold-start benchmark for the REST API worker.
+
+Each run spawns a fresh interpreter (like a uvicorn worker spawn or --reload),
+imports app.py and drives the lifespan startup, timing both phases. The broker
+host defaults to an unroutable address so a slow/down RabbitMQ is part of the
+measurement; startup must not wait on it.
+
+    cd m2_rest_api
+    python bench_startup.py --runs 10 --target-ms 1500
+
+Exits non-zero if the median cold start exceeds the target.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = r"""
+import asyncio, json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+t2 = None
+async def boot():
+    global t2
+    async with app.app.router.lifespan_context(app.app):
+        t2 = time.perf_counter()  # ready to serve
+asyncio.run(boot())
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "startup_ms": (t2 - t1) * 1000}))
+"""
+
+
+def run_once(env) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--target-ms", type=float, default=1500.0, help="max median cold start")
+    ap.add_argument("--broker", default="10.255.255.1", help="RABBITMQ_HOST for the runs")
+    args = ap.parse_args()
+
+    env = dict(os.environ, RABBITMQ_HOST=args.broker)
+    results = [run_once(env) for _ in range(args.runs)]
+
+    imports = [r["import_ms"] for r in results]
+    startups = [r["startup_ms"] for r in results]
+    totals = [r["import_ms"] + r["startup_ms"] for r in results]
+    med = statistics.median(totals)
+
+    print(f"[Bench] runs={args.runs} broker={args.broker}")
+    print(f"[Bench] import   median={statistics.median(imports):.1f}ms max={max(imports):.1f}ms")
+    print(f"[Bench] lifespan median={statistics.median(startups):.1f}ms max={max(startups):.1f}ms")
+    print(f"[Bench] total    median={med:.1f}ms max={max(totals):.1f}ms target={args.target_ms:.0f}ms")
+
+    if med > args.target_ms:
+        print("[Bench] FAIL: cold start over target")
+        sys.exit(1)
+    print("[Bench] PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine
+import os
+import threading
+
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./app.db")
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
@@ -10,3 +13,43 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+# Bump when tables/columns change. Stored in SQLite's PRAGMA user_version so a
+# worker whose DB is already current skips create_all with a single pragma read.
+SCHEMA_VERSION = 2
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _add_missing_columns():
+    # create_all never alters existing tables; add new nullable columns in place
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            have = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table.name})"))}
+            for col in table.columns:
+                if col.name not in have and col.nullable:
+                    ddl = col.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {ddl}"))
+
+
+def init_schema():
+    """Create/upgrade the schema once per process. Cheap no-op after the first call."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        import models  # noqa: F401  (registers tables on Base)
+        from search import ensure_search_index
+
+        with engine.connect() as conn:
+            current = conn.execute(text("PRAGMA user_version")).scalar()
+        if current != SCHEMA_VERSION:
+            Base.metadata.create_all(bind=engine)
+            _add_missing_columns()
+            with engine.begin() as conn:
+                conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+        ensure_search_index(engine)
+        _schema_ready = True
@@ -0,0 +1,245 @@
+"""
+maintenance.py  (Storage Garbage Collector & Integrity Scrubber)
+
+A background thread that periodically walks STORAGE_DIR and file_meta:
+- Verifies blob size and sha256 checksum against metadata
+- Reclaims orphaned blobs (no metadata row) and stale temp files once they
+  are older than a grace period
+- Reports metadata rows whose blob is missing
+- Reads are throttled by a token bucket (bytes/sec) and work is done in small
+  batches with short DB sessions, so the serving path never waits on it
+- Never holds file locks; a suspected corruption is re-checked against fresh
+  metadata before it is reported, so a concurrent update isn't a false alarm
+"""
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+
+from admission import TokenBucket
+from models import FileMeta
+from storage import STORAGE_DIR, TMP_MARKER
+
+READ_CHUNK = 1024 * 1024
+MAX_REPORTED = 100  # cap on listed problem files per pass
+
+
+def _env(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class StorageScrubber:
+    def __init__(
+        self,
+        session_factory,
+        storage_dir: str = STORAGE_DIR,
+        io_bytes_per_sec: float = None,
+        interval_s: float = None,
+        orphan_grace_s: float = None,
+        reclaim: bool = None,
+        batch_size: int = 200,
+    ):
+        self.session_factory = session_factory
+        self.storage_dir = storage_dir
+        self.io_rate = io_bytes_per_sec or _env("SCRUB_IO_BYTES_PER_SEC", 8 * 1024 * 1024)
+        self.interval_s = interval_s or _env("SCRUB_INTERVAL_S", 3600)
+        self.orphan_grace_s = orphan_grace_s if orphan_grace_s is not None else _env("SCRUB_ORPHAN_GRACE_S", 3600)
+        self.reclaim = reclaim if reclaim is not None else os.environ.get("SCRUB_RECLAIM", "1") == "1"
+        self.batch_size = batch_size
+
+        self._bucket = TokenBucket(rate=self.io_rate, burst=max(self.io_rate, READ_CHUNK))
+        self._stop = threading.Event()
+        self._thread = None
+        self.report = {"status": "not started"}
+
+    # --- lifecycle ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="storage-scrubber", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                self.report = {"status": "error", "error": str(e), "time": datetime.utcnow().isoformat()}
+                print(f"[Scrub] pass failed: {e}")
+            self._stop.wait(self.interval_s)
+
+    # --- one full pass ---
+
+    def run_pass(self) -> dict:
+        stats = {
+            "status": "running",
+            "started_at": datetime.utcnow().isoformat(),
+            "blobs_scanned": 0,
+            "bytes_verified": 0,
+            "corrupt": [],
+            "missing": [],
+            "orphans_reclaimed": 0,
+            "temp_reclaimed": 0,
+            "bytes_reclaimed": 0,
+        }
+        self._scan_blobs(stats)
+        if not self._stop.is_set():
+            self._scan_metadata(stats)
+        stats["status"] = "stopped" if self._stop.is_set() else "ok"
+        stats["finished_at"] = datetime.utcnow().isoformat()
+        self.report = stats
+        print(
+            f"[Scrub] scanned={stats['blobs_scanned']} corrupt={len(stats['corrupt'])} "
+            f"missing={len(stats['missing'])} reclaimed={stats['orphans_reclaimed'] + stats['temp_reclaimed']} "
+            f"({stats['bytes_reclaimed']} bytes)"
+        )
+        return stats
+
+    def _scan_blobs(self, stats):
+        if not os.path.isdir(self.storage_dir):
+            return
+        batch = []
+        with os.scandir(self.storage_dir) as it:
+            for entry in it:
+                if self._stop.is_set():
+                    return
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    self._check_batch(batch, stats)
+                    batch = []
+            if batch:
+                self._check_batch(batch, stats)
+
+    def _check_batch(self, entries, stats):
+        now = time.time()
+        ids = [e.name for e in entries if TMP_MARKER not in e.name]
+        db = self.session_factory()
+        try:
+            metas = {
+                m.id: (m.size_bytes, m.checksum, m.version)
+                for m in db.query(FileMeta).filter(FileMeta.id.in_(ids))
+            } if ids else {}
+        finally:
+            db.close()
+
+        for entry in entries:
+            if self._stop.is_set():
+                return
+            stats["blobs_scanned"] += 1
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # replaced/removed since listing
+
+            expected = metas.get(entry.name)
+            if expected is None:
+                # Temp file from a failed/in-flight write, or blob with no metadata
+                if now - st.st_mtime >= self.orphan_grace_s and self.reclaim:
+                    self._reclaim(entry.path, st.st_size, stats, temp=TMP_MARKER in entry.name)
+                continue
+
+            size, digest, version = expected
+            problem = None
+            if st.st_size != size:
+                problem = f"size mismatch: expected {size}, found {st.st_size}"
+            elif digest:
+                actual = self._hash(entry.path, stats)
+                if actual is None:
+                    continue
+                if actual != digest:
+                    problem = "checksum mismatch"
+
+            if problem and self._still_current(entry.name, version, entry.path, st):
+                self._add(stats["corrupt"], {"file_id": entry.name, "problem": problem})
+                print(f"[Scrub] CORRUPT {entry.name}: {problem}")
+
+        self._stop.wait(0.01)  # yield between batches
+
+    def _scan_metadata(self, stats):
+        # Keyset-paginate file_meta and look for rows whose blob is gone
+        last_id = ""
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                rows = (
+                    db.query(FileMeta.id)
+                    .filter(FileMeta.id > last_id)
+                    .order_by(FileMeta.id)
+                    .limit(self.batch_size)
+                    .all()
+                )
+            finally:
+                db.close()
+            if not rows:
+                return
+            for (fid,) in rows:
+                if not os.path.exists(os.path.join(self.storage_dir, fid)):
+                    self._add(stats["missing"], fid)
+            last_id = rows[-1][0]
+            self._stop.wait(0.01)
+
+    # --- helpers ---
+
+    def _hash(self, path, stats):
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(READ_CHUNK)
+                    if not chunk:
+                        break
+                    self._throttle(len(chunk))
+                    if self._stop.is_set():
+                        return None
+                    h.update(chunk)
+                    stats["bytes_verified"] += len(chunk)
+        except FileNotFoundError:
+            return None
+        return h.hexdigest()
+
+    def _throttle(self, nbytes):
+        while not self._stop.is_set():
+            wait = self._bucket.try_take(nbytes)
+            if wait <= 0:
+                return
+            self._stop.wait(wait)
+
+    def _still_current(self, file_id, version, path, st) -> bool:
+        """Re-check after a mismatch: skip if the file was updated while we read it."""
+        db = self.session_factory()
+        try:
+            row = db.query(FileMeta.version).filter(FileMeta.id == file_id).first()
+        finally:
+            db.close()
+        if row is None or row[0] != version:
+            return False
+        try:
+            now_st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return now_st.st_mtime == st.st_mtime and now_st.st_ino == st.st_ino
+
+    def _reclaim(self, path, size, stats, temp: bool):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        stats["temp_reclaimed" if temp else "orphans_reclaimed"] += 1
+        stats["bytes_reclaimed"] += size
+
+    @staticmethod
+    def _add(lst, item):
+        if len(lst) < MAX_REPORTED:
+            lst.append(item)
@@ -12,6 +12,7 @@ class FileMeta(Base):
     owner_id = Column(String, nullable=False, index=True)
     version = Column(Integer, default=1, nullable=False)
     size_bytes = Column(Integer, default=0, nullable=False)
+    checksum = Column(String, nullable=True)  # sha256 hex of current content
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
@@ -24,3 +25,12 @@ class Share(Base):
     target_user_id = Column(String, nullable=False, index=True)
 
     file = relationship("FileMeta", back_populates="shares")
+
+class UserUsage(Base):
+    """Per-user aggregates, maintained incrementally by upload/update/share."""
+    __tablename__ = "user_usage"
+    user_id = Column(String, primary_key=True)
+    bytes_used = Column(Integer, default=0, nullable=False)
+    file_count = Column(Integer, default=0, nullable=False)
+    shared_with_count = Column(Integer, default=0, nullable=False)  # files shared TO this user
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -1,34 +1,92 @@
 import os
-import pika
+import queue
+import threading
+
 
 class MqPublisher:
-    def __init__(self):
+    """
+    Publishes to RabbitMQ from a background thread.
+
+    Nothing connects at construction time: start() spawns a daemon thread that
+    connects with exponential backoff and owns the pika connection (pika's
+    BlockingConnection is not thread-safe). publish() only enqueues, so request
+    handlers never wait on the broker. While the broker is unreachable messages
+    are buffered up to `max_buffer`, then dropped.
+
+    Each thread gets its own stop Event: a thread that close() gave up waiting
+    for stays stopped even if start() runs again.
+    """
+
+    def __init__(self, max_buffer: int = 1000):
         self.host = os.environ.get("RABBITMQ_HOST", "localhost")
         self.queue = os.environ.get("RABBITMQ_QUEUE", "file_alerts")
-        self._connection = None
-        self._channel = None
-        self._enabled = True
+        self._outbox: "queue.Queue[str]" = queue.Queue(maxsize=max_buffer)
+        self._stop = threading.Event()
+        self._thread = None
+        self.connected = False
+        self.dropped = 0
 
-        try:
-            self._connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
-            self._channel = self._connection.channel()
-            self._channel.queue_declare(queue=self.queue, durable=False)
-        except Exception:
-            # RabbitMQ not reachable — keep API running, skip publishing
-            self._enabled = False
+    def start(self):
+        if self._thread is None:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,),
+                                            name="mq-publisher", daemon=True)
+            self._thread.start()
 
     def publish(self, message: str):
-        if not self._enabled or not self._channel:
-            return False
         try:
-            self._channel.basic_publish(exchange="", routing_key=self.queue, body=message)
+            self._outbox.put_nowait(message)
             return True
-        except Exception:
+        except queue.Full:
+            self.dropped += 1
             return False
 
+    def _connect(self):
+        import pika  # deferred: keeps API import/startup fast
+
+        conn = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        ch = conn.channel()
+        ch.queue_declare(queue=self.queue, durable=False)
+        return conn, ch
+
+    def _run(self, stop: threading.Event):
+        backoff = 0.5
+        # taken off the outbox but not yet published; survives reconnects so
+        # it goes out before anything queued behind it (per-file event order)
+        pending = None
+        while not stop.is_set():
+            try:
+                conn, ch = self._connect()
+            except Exception:
+                # RabbitMQ not reachable — keep API running, retry later
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            self.connected = True
+            backoff = 0.5
+            try:
+                while not stop.is_set():
+                    if pending is None:
+                        try:
+                            pending = self._outbox.get(timeout=1.0)
+                        except queue.Empty:
+                            conn.process_data_events(0)  # keep heartbeats flowing
+                            continue
+                    ch.basic_publish(exchange="", routing_key=self.queue, body=pending)
+                    pending = None
+            except Exception:
+                # Connection lost — reconnect; `pending` is retried first
+                pass
+            finally:
+                self.connected = False
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
     def close(self):
-        try:
-            if self._connection:
-                self._connection.close()
-        except Exception:
-            pass
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
@@ -0,0 +1,148 @@
+"""
+search.py  (Indexed Filename Search)
+
+Server-side search over filename + content type:
+- SQLite FTS5 virtual table `file_search`, kept in sync by the upload/update
+  paths inside their own transactions. Its rows are keyed by an integer rowid
+  from `file_search_ids` (file_id -> rowid), so reindexing a file deletes by
+  rowid instead of scanning the index for an UNINDEXED file_id
+- Prefix and token queries ("rep 2024" -> rep* AND 2024*)
+- Visibility is the same as list_files (owner OR shared), applied in SQL, plus
+  optional owner / shared-with-me / size / date filters and pagination
+- Falls back to LIKE matching if the SQLite build has no FTS5
+"""
+
+import re
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import text, or_, select, literal_column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from models import FileMeta, Share
+
+FTS_ENABLED = False
+
+
+def ensure_search_index(engine) -> bool:
+    """Create the FTS5 table if needed and backfill it once. Returns FTS availability."""
+    global FTS_ENABLED
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='file_search_ids'")
+        ).first()
+        if not exists:
+            # an index from before the rowid map is rebuilt
+            conn.execute(text("DROP TABLE IF EXISTS file_search"))
+            try:
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE file_search USING fts5("
+                    "file_id UNINDEXED, filename, content_type, tokenize='unicode61')"
+                ))
+            except OperationalError:
+                FTS_ENABLED = False
+                return False
+            conn.execute(text(
+                "CREATE TABLE file_search_ids ("
+                "rowid INTEGER PRIMARY KEY, file_id TEXT NOT NULL UNIQUE)"
+            ))
+            conn.execute(text("INSERT INTO file_search_ids(file_id) SELECT id FROM file_meta"))
+            conn.execute(text(
+                "INSERT INTO file_search(rowid, file_id, filename, content_type) "
+                "SELECT m.rowid, f.id, f.filename, coalesce(f.content_type, '') "
+                "FROM file_search_ids m JOIN file_meta f ON f.id = m.file_id"
+            ))
+    FTS_ENABLED = True
+    return True
+
+
+def index_file(db: Session, meta: FileMeta):
+    """(Re)index one file inside the caller's transaction. meta.id must be set (flush first)."""
+    if not FTS_ENABLED:
+        return
+    db.execute(text("INSERT OR IGNORE INTO file_search_ids(file_id) VALUES (:id)"), {"id": meta.id})
+    rowid = db.execute(
+        text("SELECT rowid FROM file_search_ids WHERE file_id = :id"), {"id": meta.id}
+    ).scalar()
+    db.execute(text("DELETE FROM file_search WHERE rowid = :rowid"), {"rowid": rowid})
+    db.execute(
+        text("INSERT INTO file_search(rowid, file_id, filename, content_type) "
+             "VALUES (:rowid, :id, :fn, :ct)"),
+        {"rowid": rowid, "id": meta.id, "fn": meta.filename, "ct": meta.content_type or ""},
+    )
+
+
+def _tokens(q: str) -> List[str]:
+    return re.findall(r"\w+", q or "")
+
+
+def _match_expr(tokens: List[str], prefix: bool) -> str:
+    # Quote every token so user input can't inject FTS operators
+    star = "*" if prefix else ""
+    return " ".join(f'"{t}"{star}' for t in tokens)
+
+
+def _like_escape(s: str) -> str:
+    # LIKE wildcards from user input must match literally
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_files(
+    db: Session,
+    user_id: str,
+    q: str = "",
+    prefix: bool = True,
+    scope: str = "all",               # all | owned | shared
+    owner: Optional[str] = None,
+    content_type: Optional[str] = None,
+    min_size: Optional[int] = None,
+    max_size: Optional[int] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    limit: int = 50,
+    offset: int = 0,
+) -> List[FileMeta]:
+    query = db.query(FileMeta)
+
+    # Visibility — same rule as list_files
+    shared_ids = select(Share.file_id).where(Share.target_user_id == user_id)
+    if scope == "owned":
+        query = query.filter(FileMeta.owner_id == user_id)
+    elif scope == "shared":
+        query = query.filter(FileMeta.id.in_(shared_ids))
+    else:
+        query = query.filter(or_(FileMeta.owner_id == user_id, FileMeta.id.in_(shared_ids)))
+
+    tokens = _tokens(q)
+    if tokens:
+        if FTS_ENABLED:
+            matched = (
+                select(literal_column("file_id"))
+                .select_from(text("file_search"))
+                .where(text("file_search MATCH :match"))
+            )
+            query = query.filter(FileMeta.id.in_(matched)).params(match=_match_expr(tokens, prefix))
+        else:
+            for t in tokens:
+                query = query.filter(FileMeta.filename.ilike(f"%{_like_escape(t)}%", escape="\\"))
+
+    if owner:
+        query = query.filter(FileMeta.owner_id == owner)
+    if content_type:
+        query = query.filter(FileMeta.content_type.like(f"{_like_escape(content_type)}%", escape="\\"))
+    if min_size is not None:
+        query = query.filter(FileMeta.size_bytes >= min_size)
+    if max_size is not None:
+        query = query.filter(FileMeta.size_bytes <= max_size)
+    if created_after is not None:
+        query = query.filter(FileMeta.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(FileMeta.created_at <= created_before)
+
+    return (
+        query.order_by(FileMeta.created_at.desc())
+        .limit(limit)
+        .offset(offset)
+        .all()
+    )
@@ -0,0 +1,70 @@
+"""
+storage.py  (Blob Storage Helpers)
+
+Blobs live at STORAGE_DIR/<file_id>. Writers stage bytes in a temp file next
+to the final path, so a live id never has partially-written content. The
+staged blob is renamed into place right before the DB commit, keeping the
+previous content as a backup; if the commit fails the backup is put back, so
+the blob on disk always matches the committed metadata.
+Leftover temp files are reclaimed by the maintenance scrubber.
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
+from typing import Optional
+
+STORAGE_DIR = os.environ.get("STORAGE_DIR", os.path.join(os.getcwd(), "storage"))
+TMP_MARKER = ".tmp-"
+
+
+def blob_path(file_id: str) -> str:
+    return os.path.join(STORAGE_DIR, file_id)
+
+
+def checksum(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def stage_blob(content: bytes) -> str:
+    """Write content to a temp file in STORAGE_DIR and return its path."""
+    tmp_path = os.path.join(STORAGE_DIR, f"{TMP_MARKER}{uuid.uuid4().hex}")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    return tmp_path
+
+
+def publish_blob(tmp_path: str, file_id: str) -> Optional[str]:
+    """
+    Atomically move a staged blob into place (call just before the DB commit).
+    Returns a backup of the content it replaced, or None if there was none:
+    discard it after the commit, or pass it to restore_blob if the commit fails.
+    """
+    live = blob_path(file_id)
+    backup = os.path.join(STORAGE_DIR, f"{TMP_MARKER}{uuid.uuid4().hex}")
+    try:
+        os.link(live, backup)  # second name for the old content, no copy
+    except FileNotFoundError:
+        backup = None
+    except OSError:
+        shutil.copyfile(live, backup)  # filesystem without hard links
+    os.replace(tmp_path, live)
+    return backup
+
+
+def restore_blob(backup: Optional[str], file_id: str):
+    """Undo publish_blob after a failed commit."""
+    if backup is None:
+        discard_blob(blob_path(file_id))
+    else:
+        os.replace(backup, blob_path(file_id))
+
+
+def discard_blob(tmp_path: Optional[str]):
+    if tmp_path is None:
+        return
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
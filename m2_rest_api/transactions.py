@@ -5,17 +5,69 @@ Provides local transaction support:
 - Per-file pessimistic locking using RLocks
 - Prevents concurrent writes to the same file
 - Wrap DB changes in a safe context manager
+
+With several API replicas behind a load balancer the per-process lock is not
+enough, so the lock has a pluggable backend (FILE_LOCK_BACKEND):
+- local  (default) — process-local RLocks only
+- ra     — additionally takes a cluster-wide lock per file_id through the
+           project's Ricart-Agrawala mutex (ricart_agrawala.py), with no
+           central lock server. Configured by:
+             FILE_LOCK_LISTEN   host:port this replica's lock node listens on
+             FILE_LOCK_PEERS    comma-separated host:port of the other replicas
+             FILE_LOCK_NODE_ID  integer, unique per replica (default: port)
+             FILE_LOCK_LINGER   seconds an uncontended lock stays cached (0.5)
+             FILE_LOCK_RETRANSMIT  seconds between REQUEST resends (1.0)
+             FILE_LOCK_FD_TIMEOUT  seconds of silence before a peer is no
+                                   longer waited for (unset: wait forever;
+                                   trades safety for liveness, see README)
+             FILE_LOCK_LEASE_TTL   seconds a hold lasts at most (unset: no cap);
+                                   check_file_lock() raises LockTimeout once
+                                   less than a quarter of it is left
+FILE_LOCK_TIMEOUT (seconds, default 10) bounds the wait; LockTimeout is
+raised after it.
 """
 
+import asyncio
+import concurrent.futures
+import os
+import sys
 import threading
 from contextlib import contextmanager
-from typing import Dict
+from typing import Dict, Optional
+
+
+class LockTimeout(TimeoutError):
+    """The file lock could not be acquired in time."""
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_optional_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+LOCK_TIMEOUT = _env_float("FILE_LOCK_TIMEOUT", 10.0)
 
 
 # Global lock table: file_id -> threading.RLock
 _file_locks: Dict[str, threading.RLock] = {}
 _table_lock = threading.Lock()
 
+# file_id -> nesting depth of the thread holding its RLock (only that thread
+# touches its entry), so the backend is only involved at the outermost level
+_depth: Dict[str, int] = {}
+
 
 def _get_lock(key: str) -> threading.RLock:
     """
@@ -28,18 +80,246 @@ def _get_lock(key: str) -> threading.RLock:
         return _file_locks[key]
 
 
+class LocalLockBackend:
+    """No cluster-wide lock: the process-local RLock is all there is."""
+
+    def start(self):
+        pass
+
+    def acquire(self, key: str, timeout: float):
+        pass
+
+    def release(self, key: str):
+        pass
+
+    def check(self, key: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class DistributedLockBackend:
+    """
+    Cluster-wide per-file lock. An RANode runs on a private event loop thread
+    and request threads block on it with a timeout. The local RLock is always
+    taken first, so each replica has at most one request per file in the
+    algorithm at a time.
+
+    Fast path: on release the node keeps holding an uncontended lock for
+    `linger` seconds, so a burst of writes to one file from this replica
+    costs no messages after the first. A REQUEST from another replica for a
+    cached lock releases it at once.
+    """
+
+    def __init__(self, listen: str, peers, node_id: Optional[int] = None,
+                 linger: float = 0.5, retransmit: float = 1.0,
+                 fd_timeout: Optional[float] = None, lease_ttl: Optional[float] = None):
+        host, port = listen.rsplit(":", 1)
+        self.host, self.port = host, int(port)
+        self.peers = [(h, int(p)) for h, p in (x.rsplit(":", 1) for x in peers)]
+        self.node_id = self.port if node_id is None else node_id
+        self.linger = linger
+        self.retransmit = retransmit
+        self.fd_timeout = fd_timeout
+        self.lease_ttl = lease_ttl
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.node = None
+        self.cached: Dict[str, asyncio.TimerHandle] = {}
+        self.fast_hits = 0
+        self.renewals = 0
+        self._thread = None
+
+    def _make_node(self):
+        # the mutex lives at the repo root, next to m2_rest_api/
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if root not in sys.path:
+            sys.path.append(root)
+        from ricart_agrawala import RANode
+
+        backend = self
+
+        class Node(RANode):
+            def on_deferred(self, rid):
+                # another replica wants a lock we only hold as a cache
+                backend._drop(rid)
+
+        node = Node(self.node_id, self.host, self.port, self.peers,
+                    acquire_timeout=LOCK_TIMEOUT, retransmit=self.retransmit,
+                    fd_timeout=self.fd_timeout, lease_ttl=self.lease_ttl)
+        node.verbose = False
+        return node
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.node = self._make_node()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="file-lock", daemon=True)
+        self._thread.start()
+        # start_server listens right away; no need for serve_forever
+        self.node.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.node.handle_conn, self.host, self.port), self.loop
+        ).result(5)
+
+    def _lease_short(self, key: str, fraction: float) -> bool:
+        # True if the hold's lease has less than `fraction` of lease_ttl left
+        left = self.node.lease_remaining(key)
+        return left is not None and left < self.lease_ttl * fraction
+
+    async def _acquire(self, key: str, timeout: float):
+        handle = self.cached.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+            if not self._lease_short(key, 0.5):
+                self.fast_hits += 1
+                return
+            # the cached hold's lease is running out: give it up, ask again
+            self.renewals += 1
+            await self.node.release(key)
+        await self.node.acquire(key, timeout)
+
+    def acquire(self, key: str, timeout: float):
+        fut = asyncio.run_coroutine_threadsafe(self._acquire(key, timeout), self.loop)
+        try:
+            # the node enforces the timeout and cleans up; this is a backstop
+            fut.result(timeout + 1.0)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            fut.cancel()
+            raise LockTimeout(f"file {key} is locked on another node")
+
+    def _release(self, key: str):
+        linger = self.linger
+        left = self.node.lease_remaining(key)
+        if left is not None:
+            linger = min(linger, left - self.lease_ttl / 2)   # never cache past the lease
+        if linger > 0 and not self.node.resource(key).deferred_replies:
+            self.cached[key] = self.loop.call_later(linger, self._drop, key)
+        else:
+            self.loop.create_task(self.node.release(key))
+
+    def _drop(self, key: str):
+        handle = self.cached.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+            self.loop.create_task(self.node.release(key))
+
+    def release(self, key: str):
+        self.loop.call_soon_threadsafe(self._release, key)
+
+    def check(self, key: str):
+        fut = asyncio.run_coroutine_threadsafe(self._check(key), self.loop)
+        if fut.result(5):
+            raise LockTimeout(f"lease on file {key} ran out before the write finished")
+
+    async def _check(self, key: str) -> bool:
+        return self._lease_short(key, 0.25)
+
+    def close(self):
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            for key in list(self.cached):
+                self._drop(key)
+            await asyncio.sleep(0)
+            await self.node.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(5)
+            self.loop.close()
+            self.loop = None
+            self._thread = None
+
+
+def make_backend(name: Optional[str] = None):
+    name = name or os.environ.get("FILE_LOCK_BACKEND", "local")
+    if name == "local":
+        return LocalLockBackend()
+    if name == "ra":
+        peers = [p for p in os.environ.get("FILE_LOCK_PEERS", "").split(",") if p.strip()]
+        node_id = os.environ.get("FILE_LOCK_NODE_ID")
+        return DistributedLockBackend(
+            os.environ.get("FILE_LOCK_LISTEN", "127.0.0.1:7100"), peers,
+            node_id=int(node_id) if node_id else None,
+            linger=_env_float("FILE_LOCK_LINGER", 0.5),
+            retransmit=_env_float("FILE_LOCK_RETRANSMIT", 1.0),
+            fd_timeout=_env_optional_float("FILE_LOCK_FD_TIMEOUT"),
+            lease_ttl=_env_optional_float("FILE_LOCK_LEASE_TTL"),
+        )
+    raise ValueError(f"unknown FILE_LOCK_BACKEND {name!r}")
+
+
+_backend = None
+
+
+def lock_backend():
+    """The configured backend, created on first use."""
+    global _backend
+    if _backend is None:
+        with _table_lock:
+            if _backend is None:
+                _backend = make_backend()
+    return _backend
+
+
+def start_lock_backend():
+    # called from the app lifespan, so peers can reach this replica's lock
+    # node before it ever writes
+    lock_backend().start()
+
+
+def close_lock_backend():
+    global _backend
+    if _backend is not None:
+        _backend.close()
+        _backend = None
+
+
+def check_file_lock(file_id: str):
+    """
+    Call under acquire_file_lock() right before committing: raises LockTimeout
+    if the cluster-wide hold is about to outlive its lease (FILE_LOCK_LEASE_TTL),
+    after which other replicas may no longer respect it.
+    """
+    if _depth.get(file_id):
+        lock_backend().check(file_id)
+
+
 @contextmanager
-def acquire_file_lock(file_id: str):
+def acquire_file_lock(file_id: str, timeout: Optional[float] = None):
     """
     Context manager for per-file pessimistic locking.
 
     Usage:
         with acquire_file_lock(file_id):
             # perform disk + db writes safely
+
+    Raises LockTimeout if the lock isn't free within `timeout` seconds
+    (default FILE_LOCK_TIMEOUT).
     """
+    timeout = LOCK_TIMEOUT if timeout is None else timeout
     lock = _get_lock(file_id)
-    lock.acquire()
+    if not lock.acquire(timeout=timeout):
+        raise LockTimeout(f"file {file_id} is locked")
+    outer = _depth.get(file_id, 0) == 0
+    try:
+        if outer:
+            backend = lock_backend()
+            backend.start()
+            backend.acquire(file_id, timeout)
+        _depth[file_id] = _depth.get(file_id, 0) + 1
+    except BaseException:
+        lock.release()
+        raise
     try:
         yield
     finally:
+        _depth[file_id] -= 1
+        if outer:
+            del _depth[file_id]
+            backend.release(file_id)
         lock.release()
@@ -0,0 +1,101 @@
+"""
+usage.py  (Per-user Usage Aggregates & Quotas)
+
+Keeps one UserUsage row per user so totals are a primary-key lookup instead
+of a SUM over file_meta:
+- Rows are created lazily and backfilled once from existing metadata
+- Deltas are applied with SQL-side arithmetic inside the caller's transaction
+  (caller commits), so concurrent writers never lose an increment
+- Quota is checked twice: a cheap pre-check before any bytes hit disk, and an
+  atomic conditional UPDATE that reserves the bytes
+"""
+
+import os
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import FileMeta, Share, UserUsage
+
+# 0 = unlimited
+QUOTA_BYTES = int(os.environ.get("USER_QUOTA_BYTES", "0"))
+QUOTA_FILES = int(os.environ.get("USER_QUOTA_FILES", "0"))
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_usage(db: Session, user_id: str) -> UserUsage:
+    """Return the user's usage row, backfilling it from existing data on first use."""
+    usage = db.get(UserUsage, user_id)
+    if usage is not None:
+        return usage
+
+    bytes_used, file_count = (
+        db.query(func.coalesce(func.sum(FileMeta.size_bytes), 0), func.count(FileMeta.id))
+        .filter(FileMeta.owner_id == user_id)
+        .one()
+    )
+    shared = db.query(func.count(Share.id)).filter(Share.target_user_id == user_id).scalar()
+    # Two first requests for the same user can both get here: the loser's
+    # insert is a no-op and it reads the winner's row instead of failing
+    db.execute(
+        insert(UserUsage)
+        .values(
+            user_id=user_id,
+            bytes_used=int(bytes_used),
+            file_count=int(file_count),
+            shared_with_count=int(shared or 0),
+        )
+        .on_conflict_do_nothing(index_elements=[UserUsage.user_id])
+    )
+    return db.get(UserUsage, user_id)
+
+
+def check_quota(db: Session, user_id: str, bytes_delta: int, files_delta: int = 0):
+    """Fast pre-check; raises QuotaExceeded. Does not reserve anything."""
+    if bytes_delta <= 0 and files_delta <= 0:
+        return
+    usage = get_usage(db, user_id)
+    if QUOTA_BYTES and usage.bytes_used + bytes_delta > QUOTA_BYTES:
+        raise QuotaExceeded(
+            f"Storage quota exceeded: {usage.bytes_used} + {bytes_delta} > {QUOTA_BYTES} bytes"
+        )
+    if QUOTA_FILES and usage.file_count + files_delta > QUOTA_FILES:
+        raise QuotaExceeded(f"File count quota exceeded: limit is {QUOTA_FILES} files")
+
+
+def apply_usage_delta(
+    db: Session,
+    user_id: str,
+    bytes_delta: int = 0,
+    files_delta: int = 0,
+    shared_delta: int = 0,
+):
+    """
+    Add deltas to the user's aggregates inside the current transaction.
+    Growth is conditional on staying within quota; raises QuotaExceeded
+    (caller should roll back) if another request got there first.
+    """
+    get_usage(db, user_id)  # make sure the row exists
+
+    q = db.query(UserUsage).filter(UserUsage.user_id == user_id)
+    if QUOTA_BYTES and bytes_delta > 0:
+        q = q.filter(UserUsage.bytes_used + bytes_delta <= QUOTA_BYTES)
+    if QUOTA_FILES and files_delta > 0:
+        q = q.filter(UserUsage.file_count + files_delta <= QUOTA_FILES)
+
+    updated = q.update(
+        {
+            UserUsage.bytes_used: UserUsage.bytes_used + bytes_delta,
+            UserUsage.file_count: UserUsage.file_count + files_delta,
+            UserUsage.shared_with_count: UserUsage.shared_with_count + shared_delta,
+            UserUsage.updated_at: datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    if updated == 0:
+        raise QuotaExceeded("Quota exceeded")
@@ -0,0 +1,72 @@
+"""
+anti_entropy.py — compact digests for gossip reconciliation.
+
+Files (file_id -> version) are hashed into a fixed number of buckets. Each
+bucket's value is the XOR of its entries' hashes, so updating one entry is
+O(1). The root is a hash over all bucket values.
+
+Reconciliation (push-pull):
+  A -> B  digest   {root}              (steady state: this is all that's sent)
+  B -> A  buckets  {hashes}            (only if roots differ)
+  A -> B  entries  {files, want}       (A's entries in differing buckets)
+  B -> A  entries  {files}             (B's entries in the buckets A wants)
+"""
+
+import hashlib
+from typing import Dict, Iterable, List
+
+DEFAULT_BUCKETS = 64
+
+
+def _h64(data: str) -> int:
+    return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8).digest(), "big")
+
+
+def bucket_of(file_id: str, n_buckets: int) -> int:
+    return _h64(file_id) % n_buckets
+
+
+def entry_hash(file_id: str, version) -> int:
+    return _h64(f"{file_id}\x00{version}")
+
+
+class BucketDigest:
+    def __init__(self, n_buckets: int = DEFAULT_BUCKETS):
+        self.n = n_buckets
+        self.buckets: List[int] = [0] * n_buckets
+        self.members: List[set] = [set() for _ in range(n_buckets)]
+        self._root = None
+
+    def update(self, file_id: str, old_version, new_version):
+        """Account for file_id moving from old_version (None = absent) to new_version."""
+        b = bucket_of(file_id, self.n)
+        if old_version is not None:
+            self.buckets[b] ^= entry_hash(file_id, old_version)
+        if new_version is not None:
+            self.buckets[b] ^= entry_hash(file_id, new_version)
+            self.members[b].add(file_id)
+        else:
+            self.members[b].discard(file_id)
+        self._root = None
+
+    def root(self) -> str:
+        if self._root is None:
+            h = hashlib.blake2b(digest_size=16)
+            for v in self.buckets:
+                h.update(v.to_bytes(8, "big"))
+            self._root = h.hexdigest()
+        return self._root
+
+    def diff(self, other_buckets: List[int]) -> List[int]:
+        """Indexes of buckets whose value differs from the remote's."""
+        if len(other_buckets) != self.n:
+            return list(range(self.n))  # incompatible layout: reconcile everything
+        return [i for i, (a, b) in enumerate(zip(self.buckets, other_buckets)) if a != b]
+
+    def entries_in(self, files: Dict[str, int], bucket_ids: Iterable[int]) -> Dict[str, int]:
+        out = {}
+        for b in bucket_ids:
+            if 0 <= b < self.n:
+                for fid in self.members[b]:
+                    out[fid] = files[fid]
+        return out
@@ -0,0 +1,220 @@
+"""
+chunks.py — content replication as fixed-size, hash-verified chunks.
+
+A file version is described by a manifest:
+    {"file_id": "...", "version": N, "size": bytes, "chunk_size": bytes,
+     "chunks": [sha256 hex, ...], "root": sha256 over the chunk hashes}
+
+Chunks are stored content-addressed (by hash), so identical chunks are kept
+once across files and versions, and a peer can serve any chunk it holds as
+soon as it has verified it, before the rest of the file has arrived.
+
+Fetching (I/O in p2p_peer.py):
+  A -> neighbours  have_req  {file_id, version}
+  B -> A           have      {manifest, chunks: [idx, ...]}   (what B holds)
+  A -> B           chunk_req {file_id, version, idx}
+  B -> A           chunk     {file_id, version, idx, data: base64}
+A downloads missing chunks from every neighbour that holds them in parallel:
+rarest chunk first, a few requests in flight per source. A chunk that fails
+verification or times out is requeued for a different source.
+
+This module is pure bookkeeping; all I/O stays in the peer.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+CHUNK_SIZE = 128 * 1024
+MAX_INFLIGHT = 4      # outstanding chunk requests per source
+
+
+def chunk_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def manifest_root(hashes: List[str]) -> str:
+    return hashlib.sha256("".join(hashes).encode()).hexdigest()
+
+
+def split(data: bytes, chunk_size: int = CHUNK_SIZE) -> List[bytes]:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [b""]
+
+
+def build_manifest(file_id: str, version: int, data: bytes,
+                   chunk_size: int = CHUNK_SIZE) -> Tuple[dict, List[bytes]]:
+    parts = split(data, chunk_size)
+    hashes = [chunk_hash(p) for p in parts]
+    manifest = {"file_id": file_id, "version": version, "size": len(data),
+                "chunk_size": chunk_size, "chunks": hashes,
+                "root": manifest_root(hashes)}
+    return manifest, parts
+
+
+def valid_manifest(manifest) -> bool:
+    try:
+        hashes = manifest["chunks"]
+        return (isinstance(hashes, list) and len(hashes) > 0
+                and manifest_root(hashes) == manifest["root"]
+                and int(manifest["size"]) <= len(hashes) * int(manifest["chunk_size"]))
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+class ChunkStore:
+    """Content-addressed chunk storage (on disk if data_dir is given, else in memory)."""
+
+    def __init__(self, data_dir: Optional[str] = None):
+        self.data_dir = data_dir
+        self._mem: Dict[str, bytes] = {}
+        self._on_disk: Set[str] = set()
+        self.manifests: Dict[Tuple[str, int], dict] = {}
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+            self._on_disk = {n for n in os.listdir(data_dir) if len(n) == 64}
+            self._manifest_log = os.path.join(data_dir, "manifests.jsonl")
+            if os.path.exists(self._manifest_log):
+                with open(self._manifest_log, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            m = json.loads(line)
+                        except json.JSONDecodeError:
+                            break  # torn tail from a crash
+                        self.manifests[(m["file_id"], m["version"])] = m
+
+    def has(self, h: str) -> bool:
+        return h in self._mem or h in self._on_disk
+
+    def get(self, h: str) -> Optional[bytes]:
+        if h in self._mem:
+            return self._mem[h]
+        if h in self._on_disk:
+            with open(os.path.join(self.data_dir, h), "rb") as f:
+                return f.read()
+        return None
+
+    def put(self, data: bytes, expected: Optional[str] = None) -> bool:
+        """Store a chunk. Returns False (and stores nothing) if it doesn't match `expected`."""
+        h = chunk_hash(data)
+        if expected is not None and h != expected:
+            return False
+        if self.has(h):
+            return True
+        if self.data_dir:
+            path = os.path.join(self.data_dir, h)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._on_disk.add(h)
+        else:
+            self._mem[h] = data
+        return True
+
+    # --- manifests ---
+
+    def add_file(self, file_id: str, version: int, data: bytes,
+                 chunk_size: int = CHUNK_SIZE) -> dict:
+        manifest, parts = build_manifest(file_id, version, data, chunk_size)
+        for p, h in zip(parts, manifest["chunks"]):
+            self.put(p, h)
+        self.add_manifest(manifest)
+        return manifest
+
+    def add_manifest(self, manifest: dict):
+        key = (manifest["file_id"], manifest["version"])
+        if key in self.manifests:
+            return
+        self.manifests[key] = manifest
+        if self.data_dir:
+            with open(self._manifest_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(manifest, separators=(",", ":")) + "\n")
+
+    def manifest(self, file_id: str, version: int) -> Optional[dict]:
+        return self.manifests.get((file_id, version))
+
+    def held(self, manifest: dict) -> List[int]:
+        return [i for i, h in enumerate(manifest["chunks"]) if self.has(h)]
+
+    def missing(self, manifest: dict) -> List[int]:
+        return [i for i, h in enumerate(manifest["chunks"]) if not self.has(h)]
+
+    def complete(self, file_id: str, version: int) -> bool:
+        m = self.manifest(file_id, version)
+        return m is not None and not self.missing(m)
+
+    def assemble(self, manifest: dict) -> bytes:
+        data = b"".join(self.get(h) for h in manifest["chunks"])
+        return data[:manifest["size"]]
+
+
+class FetchPlan:
+    """
+    Which chunk to request from which source next. Rarest-first over the
+    sources' advertised chunk sets, at most `max_inflight` requests per
+    source, and a chunk that failed at one source is retried at another.
+    """
+
+    def __init__(self, missing: Iterable[int], max_inflight: int = MAX_INFLIGHT):
+        self.pending: Set[int] = set(missing)
+        self.max_inflight = max_inflight
+        self.sources: Dict[object, Set[int]] = {}
+        self.inflight: Dict[object, Set[int]] = {}
+        self.failed: Dict[int, Set[object]] = {}
+
+    def add_source(self, src, chunks: Iterable[int]):
+        self.sources[src] = set(chunks)
+        self.inflight.setdefault(src, set())
+
+    def remove_source(self, src) -> List[int]:
+        """Forget a source; its in-flight chunks go back to pending."""
+        self.sources.pop(src, None)
+        back = list(self.inflight.pop(src, ()))
+        self.pending.update(back)
+        return back
+
+    def done(self) -> bool:
+        return not self.pending and not any(self.inflight.values())
+
+    def stalled(self) -> bool:
+        """Nothing in flight and no source can supply what is left."""
+        if any(self.inflight.values()):
+            return False
+        return not any(self._usable(src) for src in self.sources)
+
+    def _usable(self, src) -> List[int]:
+        have = self.sources.get(src, set())
+        return [i for i in self.pending if i in have and src not in self.failed.get(i, ())]
+
+    def next_requests(self) -> List[Tuple[object, int]]:
+        counts: Dict[int, int] = {}
+        for have in self.sources.values():
+            for i in have:
+                if i in self.pending:
+                    counts[i] = counts.get(i, 0) + 1
+        out = []
+        # round-robin one chunk per source per pass so work spreads across all of them
+        progress = True
+        while progress:
+            progress = False
+            for src in sorted(self.sources, key=lambda s: len(self.inflight[s])):
+                if len(self.inflight[src]) >= self.max_inflight:
+                    continue
+                usable = self._usable(src)
+                if not usable:
+                    continue
+                i = min(usable, key=lambda i: (counts.get(i, 0), i))
+                self.pending.discard(i)
+                self.inflight[src].add(i)
+                out.append((src, i))
+                progress = True
+        return out
+
+    def completed(self, src, idx: int):
+        self.inflight.get(src, set()).discard(idx)
+
+    def failed_at(self, src, idx: int):
+        self.inflight.get(src, set()).discard(idx)
+        self.failed.setdefault(idx, set()).add(src)
+        self.pending.add(idx)
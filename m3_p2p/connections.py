@@ -0,0 +1,302 @@
+"""
+connections.py — one persistent, bidirectional connection per peer pair.
+
+- Both dialed and accepted connections get a reader task
+- Connections are identified by the remote's listen address from its hello;
+  if two peers dial each other at once, both keep the connection initiated by
+  the lower address and close the other, so the pair ends up with exactly one
+- Heartbeat pings go out every `heartbeat_interval`; every received message
+  counts as a heartbeat
+- A phi-accrual failure detector per connection adapts to observed arrival
+  intervals; once phi crosses the threshold the peer is evicted and the owner
+  is told so it can back off and redial
+- Sends are bounded by a timeout, so a stuck peer can't stall gossip
+- Once both hellos have been exchanged, connections whose peer supports it
+  switch to length-prefixed binary frames (see wire.py); messages sent within
+  `flush_window` are coalesced into one frame with a single drain; if that
+  write fails, the connection closes, the manager drops it at once and the
+  next send to it raises the error
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import wire
+
+Key = Tuple[str, int]
+
+
+def parse_key(addr: str) -> Key:
+    h, p = addr.rsplit(":", 1)
+    return (h, int(p))
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.). phi = -log10(P(a
+    heartbeat arrives later than now)) under a normal model of the observed
+    inter-arrival times.
+    """
+
+    def __init__(self, threshold: float = 8.0, window: int = 100,
+                 min_std: float = 0.1, first_interval: float = 1.0):
+        self.threshold = threshold
+        self.min_std = min_std
+        self.intervals = deque(maxlen=window)
+        self.intervals.append(first_interval)
+        self.last: Optional[float] = None
+
+    def heartbeat(self, now: float):
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    def phi(self, now: float) -> float:
+        if self.last is None:
+            return 0.0
+        n = len(self.intervals)
+        mean = sum(self.intervals) / n
+        var = sum((x - mean) ** 2 for x in self.intervals) / n
+        std = max(math.sqrt(var), self.min_std)
+        elapsed = now - self.last
+        p_later = 0.5 * math.erfc((elapsed - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p_later, 1e-300))
+
+    def suspect(self, now: float) -> bool:
+        return self.phi(now) > self.threshold
+
+
+class Connection:
+    def __init__(self, reader, writer, initiator: str, key: Optional[Key] = None,
+                 send_timeout: float = 2.0, detector: Optional[PhiAccrualDetector] = None,
+                 flush_window: float = 0.002, max_batch: int = 64,
+                 on_error: Optional[Callable[["Connection"], None]] = None,
+                 opened_at: Optional[float] = None):
+        self.reader = reader
+        self.writer = writer
+        self.initiator = initiator       # addr of the side that dialed
+        self.key = key                   # remote listen addr, once known
+        self.send_timeout = send_timeout
+        self.detector = detector or PhiAccrualDetector()
+        self.opened_at = time.monotonic() if opened_at is None else opened_at
+        self.closed = False
+        self.error: Optional[Exception] = None  # why a background flush failed
+        self.on_error = on_error
+
+        # framing: None = JSON lines (legacy / not negotiated yet)
+        self.codec: Optional[str] = None
+        self.flush_window = flush_window
+        self.max_batch = max_batch
+        self._outbox = []
+        self._flush_timer = None
+        self.frames_sent = 0
+        self.msgs_sent = 0
+
+    def negotiate(self, remote_wire):
+        self.codec = wire.negotiate(remote_wire)
+
+    def write(self, data: bytes):
+        self.writer.write(data)
+
+    async def drain(self):
+        await asyncio.wait_for(self.writer.drain(), self.send_timeout)
+
+    async def send(self, obj):
+        if self.closed:
+            raise self.error or ConnectionError("connection closed")
+        self.msgs_sent += 1
+        if self.codec is None:
+            self.write(wire.encode_line(obj))
+            self.frames_sent += 1
+            await self.drain()
+            return
+        # coalesce: flush when the batch is full or the window elapses
+        self._outbox.append(obj)
+        if len(self._outbox) >= self.max_batch:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                self.flush_window, self._on_flush_timer)
+
+    def _on_flush_timer(self):
+        self._flush_timer = None
+        asyncio.create_task(self._flush_or_close())
+
+    async def _flush_or_close(self):
+        # nobody awaits a timed flush: a failure has to reach the owner from here
+        try:
+            await self.flush()
+        except Exception as e:
+            self.error = e
+            self.close()
+            if self.on_error:
+                self.on_error(self)
+
+    async def flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._outbox or self.closed:
+            return
+        batch, self._outbox = self._outbox, []
+        self.write(wire.encode_frame(batch, self.codec))
+        self.frames_sent += 1
+        await self.drain()
+
+    async def recv(self):
+        """Next batch of messages (JSON line or binary frame), or None on EOF."""
+        return await wire.read_messages(self.reader)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            if self._outbox:
+                # last words (e.g. disconnect); transport.close() still flushes its buffer
+                try:
+                    self.write(wire.encode_frame(self._outbox, self.codec))
+                except Exception:
+                    pass
+                self._outbox = []
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+
+
+class ConnectionManager:
+    def __init__(self, addr: str,
+                 on_message: Callable[[dict, Connection], Awaitable[None]],
+                 make_hello: Callable[[], dict],
+                 on_evict: Optional[Callable[[Key], None]] = None,
+                 on_close: Optional[Callable[[Key], None]] = None,
+                 heartbeat_interval: float = 1.0,
+                 phi_threshold: float = 8.0,
+                 dial_timeout: float = 1.0,
+                 time_source=time):
+        self.addr = addr
+        self._time = time_source   # time()/monotonic(); virtual under the simulator
+        self.on_message = on_message
+        self.make_hello = make_hello
+        self.on_evict = on_evict
+        self.on_close = on_close
+        self.heartbeat_interval = heartbeat_interval
+        self.phi_threshold = phi_threshold
+        self.dial_timeout = dial_timeout
+        self.conns: Dict[Key, Connection] = {}
+        self.dialing = set()
+
+    def _hello(self):
+        hello = self.make_hello()
+        hello.setdefault("wire", wire.advertise())
+        return hello
+
+    def _detector(self):
+        return PhiAccrualDetector(self.phi_threshold, first_interval=self.heartbeat_interval)
+
+    # --- establishing ---
+
+    async def dial(self, key: Key) -> Connection:
+        self.dialing.add(key)
+        try:
+            r, w = await asyncio.wait_for(asyncio.open_connection(*key), self.dial_timeout)
+        finally:
+            self.dialing.discard(key)
+        conn = Connection(r, w, initiator=self.addr, key=key, detector=self._detector(),
+                          on_error=self.drop, opened_at=self._time.monotonic())
+        conn.detector.heartbeat(self._time.monotonic())
+        if not self._register(conn):
+            return self.conns.get(key)  # lost a simultaneous-dial race
+        print(f"[P2P] connected {key[0]}:{key[1]}")
+        await conn.send(self._hello())
+        asyncio.create_task(self._read_loop(conn))
+        return conn
+
+    async def accept(self, reader, writer):
+        conn = Connection(reader, writer, initiator="", detector=self._detector(),
+                          on_error=self.drop, opened_at=self._time.monotonic())
+        conn.detector.heartbeat(self._time.monotonic())
+        try:
+            await conn.send(self._hello())
+        except Exception:
+            conn.close()
+            return
+        await self._read_loop(conn)
+
+    def _register(self, conn: Connection) -> bool:
+        """Install conn for its key, resolving duplicates. Returns True if kept."""
+        existing = self.conns.get(conn.key)
+        if existing is None or existing is conn or existing.closed:
+            self.conns[conn.key] = conn
+            return True
+        # Simultaneous dial: keep the connection initiated by the lower address
+        keeper_initiator = min(self.addr, f"{conn.key[0]}:{conn.key[1]}")
+        if conn.initiator == keeper_initiator and existing.initiator != keeper_initiator:
+            self.conns[conn.key] = conn
+            existing.close()
+            return True
+        conn.close()
+        return False
+
+    # --- reading ---
+
+    async def _read_loop(self, conn: Connection):
+        try:
+            while not conn.closed:
+                msgs = await conn.recv()
+                if msgs is None:
+                    break
+                conn.detector.heartbeat(self._time.monotonic())
+                for msg in msgs:
+                    t = msg.get("type")
+                    if t == "ping":
+                        continue
+                    if t == "hello":
+                        conn.negotiate(msg.get("wire"))
+                        if conn.key is None:
+                            frm = msg.get("from")
+                            if frm and frm != self.addr:
+                                conn.initiator = frm
+                                conn.key = parse_key(frm)
+                                if not self._register(conn):
+                                    return
+                    await self.on_message(msg, conn)
+        except Exception:
+            pass
+        finally:
+            self.drop(conn)
+
+    # --- liveness ---
+
+    def drop(self, conn: Connection):
+        conn.close()
+        if conn.key is not None and self.conns.get(conn.key) is conn:
+            self.conns.pop(conn.key, None)
+            if self.on_close:
+                self.on_close(conn.key)
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = self._time.monotonic()
+            alive = []
+            for key, conn in list(self.conns.items()):
+                if conn.detector.suspect(now):
+                    print(f"[P2P] evicting {key[0]}:{key[1]} (phi={conn.detector.phi(now):.1f})")
+                    self.drop(conn)
+                    if self.on_evict:
+                        self.on_evict(key)
+                else:
+                    alive.append(conn)
+            # ping concurrently so one slow peer doesn't delay the rest
+            await asyncio.gather(*(self._ping(c) for c in alive))
+
+    async def _ping(self, conn: Connection):
+        try:
+            await conn.send({"type": "ping"})
+        except Exception:
+            self.drop(conn)
@@ -0,0 +1,51 @@
+"""
+dissemination.py — bounded-fanout rumor mongering helpers.
+
+Every new (file_id, version) event is pushed by the peer where it starts to
+its whole active view, then by each peer it reaches to `fanout` random
+neighbours, with a TTL that drops by one per hop. A bounded "seen" cache stops a peer
+from re-forwarding a rumor it already spread. The periodic digest
+anti-entropy is the pull half: anything a rumor misses is repaired there.
+With fanout k a rumor reaches N peers in O(log N) hops, and each peer
+sends at most k messages per rumor regardless of cluster size.
+"""
+
+import random
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Optional
+
+DEFAULT_FANOUT = 3
+DEFAULT_TTL = 6
+
+
+class SeenCache:
+    """Insertion-ordered set with a size bound (oldest entries evicted first)."""
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self._items: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def add(self, key) -> bool:
+        """Add key. Returns False if it was already present."""
+        if key in self._items:
+            self._items.move_to_end(key)
+            return False
+        self._items[key] = None
+        if len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+        return True
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def choose_targets(candidates: Iterable, k: int, exclude: Optional[set] = None,
+                   rng: Optional[random.Random] = None) -> List:
+    rng = rng or random
+    pool = [c for c in candidates if not exclude or c not in exclude]
+    if len(pool) <= k:
+        return pool
+    return rng.sample(pool, k)
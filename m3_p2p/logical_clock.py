@@ -1,12 +1,15 @@
 #logical clock
 
+import time
+from typing import Dict, Tuple
+
 class LamportClock:
     def __init__(self):
         self.time = 0
 
     # local event
     def tick(self):
-        self.time =+ 1
+        self.time += 1
         return self.time
 
     # event before send a message
@@ -18,3 +21,56 @@ class LamportClock:
     def recv_event(self, received_time: int):
         self.time = max(received_time, self.time) + 1
         return self.time
+
+
+# hybrid logical clock (Kulkarni et al.): timestamps are (l, c) where l is
+# the highest physical time seen in ms and c counts events within the same l.
+# They stay close to wall time but, like Lamport time, never go backwards and
+# always order a receive after its send.
+class HybridLogicalClock:
+    def __init__(self, now_ms=None):
+        self.l = 0
+        self.c = 0
+        self._now = now_ms or (lambda: int(time.time() * 1000))
+
+    # local or send event
+    def send_event(self) -> Tuple[int, int]:
+        pt = self._now()
+        if pt > self.l:
+            self.l, self.c = pt, 0
+        else:
+            self.c += 1
+        return (self.l, self.c)
+
+    # merge an incoming (l, c)
+    def recv_event(self, remote) -> Tuple[int, int]:
+        rl, rc = int(remote[0]), int(remote[1])
+        pt = self._now()
+        if pt > self.l and pt > rl:
+            self.l, self.c = pt, 0
+        elif rl > self.l:
+            self.l, self.c = rl, rc + 1
+        elif self.l > rl:
+            self.c += 1
+        else:
+            self.c = max(self.c, rc) + 1
+        return (self.l, self.c)
+
+
+# version vectors: {replica_id: number of writes by that replica}
+EQUAL, BEFORE, AFTER, CONCURRENT = "equal", "before", "after", "concurrent"
+
+def vv_compare(a: Dict[str, int], b: Dict[str, int]) -> str:
+    """How a relates to b: EQUAL, BEFORE (b saw all of a), AFTER, or CONCURRENT."""
+    less = more = False
+    for k in set(a) | set(b):
+        x, y = a.get(k, 0), b.get(k, 0)
+        if x < y: less = True
+        elif x > y: more = True
+    if less and more: return CONCURRENT
+    if less: return BEFORE
+    if more: return AFTER
+    return EQUAL
+
+def vv_merge(a: Dict[str, int], b: Dict[str, int]) -> Dict[str, int]:
+    return {k: max(a.get(k, 0), b.get(k, 0)) for k in set(a) | set(b)}
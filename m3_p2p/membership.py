@@ -0,0 +1,122 @@
+"""
+membership.py — HyParView-style partial views.
+
+Each peer keeps two bounded views instead of one ever-growing peer set:
+- active view  (small, e.g. 5): the only peers we hold connections to and
+  gossip with. Links are symmetric: if A has B active, B has A active.
+- passive view (larger, e.g. 30): addresses we know about but don't connect
+  to, used to replace failed active peers.
+
+Protocol (messages handled in p2p_peer.py):
+  join            new node -> contact; a contact that is in the overlay adds
+                  it to its active view, answers with neighbor_reply and sends
+                  forward_join to its other active neighbours. A contact that
+                  isn't (yet) turns it away with a sample of the peers it knows,
+                  and the joiner retries through one of them
+  forward_join    random walk of length ARWL; the node where it ends (or any
+                  node with an almost-empty active view) asks the joiner to be
+                  its neighbour; the node at hop PRWL adds it to its passive view
+  neighbor        ask to become an active neighbour; "high" priority (we have
+                  at most one active peer left, or a walk ended here) must be
+                  accepted, "low" only if there is room. Answered by
+                  neighbor_reply, which carries a sample when it says no.
+                  A peer only goes active once both ends agreed, over a live
+                  connection, so active views stay symmetric
+  disconnect      we dropped you from our active view (you go to passive)
+  shuffle / shuffle_reply
+                  periodic random walk of a small sample (ttl ARWL); the node
+                  where it ends trades a sample back, so passive views mix
+                  across the whole overlay rather than among neighbours
+
+Per-node connection count and membership traffic stay constant as the
+overlay grows. A lost connection drops the active entry and a passive peer
+is asked to replace it; now and then a full view also trades one link for a
+passive peer (ROTATE_CHANCE), so a group whose views filled up with each
+other still meets the rest of the overlay.
+
+This class is pure bookkeeping; all I/O stays in the peer.
+"""
+
+import random
+from typing import List, Optional, Set, Tuple
+
+Key = Tuple[str, int]
+
+ACTIVE_SIZE = 5
+PASSIVE_SIZE = 30
+ARWL = 6   # active random walk length
+PRWL = 3   # passive random walk length
+SHUFFLE_ACTIVE = 3
+SHUFFLE_PASSIVE = 4
+ROTATE_CHANCE = 0.1  # per shuffle round, a full active view trades one link
+REQUEST_TIMEOUT = 2.0  # seconds to wait for a neighbor_reply before asking again
+REQUEST_TRIES = 3
+
+
+class Membership:
+    def __init__(self, me: Key, active_size: int = ACTIVE_SIZE,
+                 passive_size: int = PASSIVE_SIZE, rng: Optional[random.Random] = None):
+        self.me = me
+        self.active_size = active_size
+        self.passive_size = passive_size
+        self.active: Set[Key] = set()
+        self.passive: Set[Key] = set()
+        self.rng = rng or random.Random()
+
+    def known(self) -> Set[Key]:
+        return self.active | self.passive
+
+    def is_full(self) -> bool:
+        return len(self.active) >= self.active_size
+
+    def add_active(self, key: Key) -> Optional[Key]:
+        """Add key to the active view. Returns the peer dropped to make room, if any."""
+        if key == self.me or key in self.active:
+            return None
+        dropped = None
+        if self.is_full():
+            dropped = self.rng.choice(sorted(self.active))
+            self.active.discard(dropped)
+            self.add_passive(dropped)
+        self.passive.discard(key)
+        self.active.add(key)
+        return dropped
+
+    def remove_active(self, key: Key, to_passive: bool = True):
+        if key in self.active:
+            self.active.discard(key)
+            if to_passive:
+                self.add_passive(key)
+
+    def add_passive(self, key: Key, prefer_evict: Optional[Set[Key]] = None):
+        if key == self.me or key in self.active or key in self.passive:
+            return
+        if len(self.passive) >= self.passive_size:
+            pool = sorted(prefer_evict & self.passive) if prefer_evict else []
+            victim = self.rng.choice(pool or sorted(self.passive))
+            self.passive.discard(victim)
+            if prefer_evict:
+                prefer_evict.discard(victim)
+        self.passive.add(key)
+
+    def random_active(self, exclude: Set[Key] = frozenset()) -> Optional[Key]:
+        pool = sorted(self.active - set(exclude))
+        return self.rng.choice(pool) if pool else None
+
+    def promotion_candidate(self, exclude: Set[Key] = frozenset()) -> Optional[Key]:
+        pool = sorted(self.passive - set(exclude))
+        return self.rng.choice(pool) if pool else None
+
+    def shuffle_sample(self) -> List[Key]:
+        act = sorted(self.active)
+        pas = sorted(self.passive)
+        sample = [self.me]
+        sample += self.rng.sample(act, min(SHUFFLE_ACTIVE, len(act)))
+        sample += self.rng.sample(pas, min(SHUFFLE_PASSIVE, len(pas)))
+        return sample
+
+    def merge_sample(self, sample: List[Key], sent: List[Key] = ()):
+        """Fold a shuffle sample into the passive view, evicting what we sent first."""
+        prefer = set(sent)
+        for key in sample:
+            self.add_passive(key, prefer_evict=prefer)
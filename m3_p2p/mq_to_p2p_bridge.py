@@ -1,9 +1,43 @@
+"""
+mq_to_p2p_bridge.py — forwards RabbitMQ file events into the P2P network.
+
+- `--workers` consumer threads, each with its own AMQP connection (pika's
+  BlockingConnection is not thread-safe) and a `--prefetch` window, so the
+  broker keeps deliveries flowing instead of one message per round trip
+- each worker keeps persistent TCP connections to every `--peer` and sends
+  whole batches (up to `--batch` events, or whatever arrived within
+  `--flush-ms`) as JSON lines on one connection, round-robin across peers,
+  failing over to the next peer on error
+- a batch ends with a {"type":"barrier"}; the peer answers once it has applied
+  everything before it, and only then is the batch acked (basic_ack with
+  multiple=True). Failed batches are nacked and requeued, so a dead peer or a
+  crash never loses events (they may be delivered twice, which is harmless:
+  peers keep the highest version per file)
+- idle links send a ping now and then, so an idle link isn't silently
+  dropped by a middlebox and a dead peer is noticed before the next batch
+- within a batch, events for the same file collapse into the newest version
+  (peers are last-write-wins, so superseded versions never need forwarding);
+  all of them are still acked
+- throughput, batch size, forward latency and queue backlog are printed every
+  `--metrics-interval` seconds
+
+Events from different workers may arrive out of order; peers resolve that by
+version (last-write-wins), so no ordering is needed across workers.
+"""
+
 import pika
 import json
 import socket
 import argparse
+import threading
+import time
+from collections import deque
+
+import wire
+
 
 def send_p2p_event(peer_host, peer_port, file_id, version, ts):
+    """One-shot send on a fresh connection (kept for scripts and tests)."""
     msg = json.dumps({
         "type": "event",
         "file_id": file_id,
@@ -13,50 +47,343 @@ def send_p2p_event(peer_host, peer_port, file_id, version, ts):
     with socket.create_connection((peer_host, peer_port), timeout=1.0) as s:
         s.sendall(msg.encode())
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--peer", default="127.0.0.1:9001", help="p2p peer to forward to")
-    ap.add_argument("--queue", default="file_alerts")
-    args = ap.parse_args()
-    ph, pp = args.peer.split(":"); pp = int(pp)
 
-    conn = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-    ch = conn.channel()
-    ch.queue_declare(queue=args.queue)
+def coalesce(events):
+    """Keep only the newest event per file_id (first-seen order)."""
+    latest = {}
+    for ev in events:
+        cur = latest.get(ev["file_id"])
+        if cur is None or ev["version"] > cur["version"]:
+            latest[ev["file_id"]] = ev
+    return list(latest.values())
+
+
+def parse_event(body: bytes):
+    """Turn a queue message into an event dict, or None if unrecognized."""
+    txt = body.decode(errors="replace")
+    try:
+        data = json.loads(txt)
+        file_id = data.get("file_id")
+        version = data.get("version", 1)
+        ts = data.get("ts", 0)
+    except (json.JSONDecodeError, AttributeError):
+        # fallback: look for "id=" and "version="
+        file_id, version, ts = None, 1, 0
+        parts = txt.replace(",", " ").split()
+        for p in parts:
+            if p.startswith("id="): file_id = p.split("=",1)[1]
+            if p.startswith("version="): version = p.split("=",1)[1]
+    if not file_id:
+        return None
+    try:
+        return {"type": "event", "file_id": str(file_id), "version": int(version), "ts": int(ts)}
+    except (TypeError, ValueError):
+        return None
+
 
-    print(f"[Bridge] Subscribed to '{args.queue}', forwarding to {ph}:{pp}")
+class PeerLink:
+    """Persistent connection to one peer, speaking the JSON-line protocol."""
 
-    def callback(chd, method, properties, body):
-        txt = body.decode()
+    def __init__(self, addr, timeout: float = 2.0):
+        self.addr = addr
+        self.timeout = timeout
+        self.sock = None
+        self._buf = b""
+        self._seq = 0
+        self.last_send = 0.0
+        self.down_until = 0.0     # skipped (unless nothing else works) after a failure
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.addr, timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = b""
+        # no "from": we are not a peer and must not end up in anyone's views
+        self.sock.sendall(wire.encode_line({"type": "hello"}))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def send_batch(self, events):
+        """Send events and wait until the peer has applied them all."""
+        reused = self.sock is not None
         try:
-            data = json.loads(txt)
-            file_id = data.get("file_id")
-            version = data.get("version", 1)
-            ts = data.get("ts", 0)
-        except json.JSONDecodeError:
-            # fallback: look for "id=" and "version="
-            file_id, version, ts = None, 1, 0
-            parts = txt.replace(",", " ").split()
-            for p in parts:
-                if p.startswith("id="): file_id = p.split("=",1)[1]
-                if p.startswith("version="): version = p.split("=",1)[1]
-            if not file_id:
-                print(f"[Bridge] Unrecognized message: {txt}")
+            self._send_batch(events)
+        except Exception:
+            if not reused:
+                raise
+            self._send_batch(events)  # stale connection: retry once on a fresh one
+
+    def _send_batch(self, events):
+        if self.sock is None:
+            self._connect()
+        self._seq += 1
+        data = b"".join(wire.encode_line(ev) for ev in events)
+        data += wire.encode_line({"type": "barrier", "id": self._seq})
+        try:
+            self.sock.sendall(data)
+            self.last_send = time.monotonic()
+            self._wait_ack(self._seq)
+        except Exception:
+            self.close()
+            raise
+
+    def _wait_ack(self, seq):
+        # the peer also sends its own hello first; skip anything but our ack
+        while True:
+            while b"\n" not in self._buf:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError(f"{self.addr} closed the connection")
+                self._buf += chunk
+            line, self._buf = self._buf.split(b"\n", 1)
+            try:
+                msg = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if msg.get("type") == "barrier_ack" and msg.get("id") == seq:
                 return
+
+    def keepalive(self, interval: float):
+        if self.sock is None or time.monotonic() - self.last_send < interval:
+            return
         try:
-            send_p2p_event(ph, pp, file_id, version, ts)
-            print(f"[Bridge] forwarded event: {file_id} -> v{version} ts={ts}")
-        except Exception as e:
-            print(f"[Bridge] forward failed: {e}")
+            self.sock.sendall(wire.encode_line({"type": "ping"}))
+            self.last_send = time.monotonic()
+            # discard whatever the peer sent meanwhile so its buffer never fills
+            self.sock.setblocking(False)
+            try:
+                while True:
+                    if not self.sock.recv(65536):
+                        raise ConnectionError(f"{self.addr} closed the connection")
+            except BlockingIOError:
+                pass
+            finally:
+                self.sock.settimeout(self.timeout)
+            self._buf = b""
+        except OSError:
+            self.close()
+
+
+class PeerPool:
+    """Round-robin over persistent links; a batch fails over to the next peer."""
+
+    def __init__(self, peers, timeout: float = 2.0):
+        self.links = [PeerLink(p, timeout) for p in peers]
+        self._next = 0
+
+    def send(self, events):
+        last_err = None
+        now = time.monotonic()
+        order = self.links[self._next:] + self.links[:self._next]
+        self._next = (self._next + 1) % len(self.links)
+        # healthy links first, recently failed ones only as a last resort
+        for link in sorted(order, key=lambda l: l.down_until > now):
+            try:
+                link.send_batch(events)
+                link.down_until = 0.0
+                return link.addr
+            except Exception as e:
+                link.down_until = time.monotonic() + 5.0
+                last_err = e
+        raise ConnectionError(f"no peer accepted the batch: {last_err}")
+
+    def keepalive(self, interval: float):
+        for link in self.links:
+            link.keepalive(interval)
+
+    def close(self):
+        for link in self.links:
+            link.close()
 
-    ch.basic_consume(queue=args.queue, on_message_callback=callback, auto_ack=True)
+
+class BridgeMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.received = 0
+        self.forwarded = 0
+        self.unrecognized = 0
+        self.requeued = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.backlog = None
+        self._latency = deque(maxlen=2000)   # seconds from delivery to ack
+        self._last = (time.monotonic(), 0)
+
+    def record_batch(self, n_events, n_msgs, n_coalesced, oldest_delivery):
+        now = time.monotonic()
+        with self._lock:
+            self.batches += 1
+            self.forwarded += n_events
+            self.received += n_msgs
+            self.coalesced += n_coalesced
+            self._latency.append(now - oldest_delivery)
+
+    def record_requeue(self, n_msgs):
+        with self._lock:
+            self.requeued += n_msgs
+
+    def record_unrecognized(self):
+        with self._lock:
+            self.unrecognized += 1
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            t0, fwd0 = self._last
+            self._last = (now, self.forwarded)
+            lat = sorted(self._latency)
+            self._latency.clear()
+            return {
+                "rate": (self.forwarded - fwd0) / max(now - t0, 1e-9),
+                "forwarded": self.forwarded,
+                "requeued": self.requeued,
+                "coalesced": self.coalesced,
+                "unrecognized": self.unrecognized,
+                "avg_batch": self.forwarded / self.batches if self.batches else 0.0,
+                "lat_p50_ms": lat[len(lat) // 2] * 1000 if lat else 0.0,
+                "lat_p99_ms": lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1000 if lat else 0.0,
+                "backlog": self.backlog,
+            }
+
+
+class BridgeWorker(threading.Thread):
+    def __init__(self, idx, args, peers, metrics: BridgeMetrics, stop: threading.Event):
+        super().__init__(name=f"bridge-{idx}", daemon=True)
+        self.args = args
+        self.pool = PeerPool(peers, timeout=args.peer_timeout)
+        self.metrics = metrics
+        self.stop = stop
+
+    def run(self):
+        backoff = 0.5
+        while not self.stop.is_set():
+            try:
+                self._consume()
+                backoff = 0.5
+            except Exception as e:
+                print(f"[Bridge] {self.name}: {e}; reconnecting in {backoff:.1f}s")
+                self.stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+        self.pool.close()
+
+    def _connect(self):
+        return pika.BlockingConnection(pika.ConnectionParameters(self.args.mq_host))
+
+    def _consume(self):
+        a = self.args
+        conn = self._connect()
+        try:
+            ch = conn.channel()
+            ch.queue_declare(queue=a.queue)
+            ch.basic_qos(prefetch_count=a.prefetch)
+            flush_s = a.flush_ms / 1000.0
+            batch = []          # (delivery_tag, event or None)
+            first_at = 0.0
+            for method, _props, body in ch.consume(a.queue, inactivity_timeout=flush_s):
+                if self.stop.is_set():
+                    break
+                if method is not None:
+                    ev = parse_event(body)
+                    if ev is None:
+                        print(f"[Bridge] Unrecognized message: {body[:200]!r}")
+                        self.metrics.record_unrecognized()
+                    if not batch:
+                        first_at = time.monotonic()
+                    batch.append((method.delivery_tag, ev))
+                if batch and (len(batch) >= a.batch or time.monotonic() - first_at >= flush_s):
+                    if not self._flush(ch, batch, first_at):
+                        self.stop.wait(0.5)  # every peer failed; don't spin
+                    batch = []
+                elif method is None:
+                    self.pool.keepalive(a.keepalive)
+            # unacked deliveries are requeued by the broker when the channel closes
+            ch.cancel()
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _flush(self, ch, batch, first_at) -> bool:
+        last_tag = batch[-1][0]
+        parsed = [ev for _, ev in batch if ev is not None]
+        events = coalesce(parsed)
+        try:
+            if events:
+                self.pool.send(events)
+        except ConnectionError as e:
+            print(f"[Bridge] forward failed ({len(events)} events requeued): {e}")
+            ch.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            self.metrics.record_requeue(len(batch))
+            return False
+        ch.basic_ack(delivery_tag=last_tag, multiple=True)
+        self.metrics.record_batch(len(events), len(batch), len(parsed) - len(events), first_at)
+        return True
+
+
+def report_loop(args, metrics: BridgeMetrics, stop: threading.Event):
+    """Print metrics; the main thread owns one extra AMQP connection for backlog checks."""
+    conn = None
+    while not stop.is_set():
+        try:
+            if conn is None or conn.is_closed:
+                conn = pika.BlockingConnection(pika.ConnectionParameters(args.mq_host))
+                ch = conn.channel()
+            conn.process_data_events(time_limit=args.metrics_interval)
+            metrics.backlog = ch.queue_declare(queue=args.queue, passive=True).method.message_count
+        except Exception:
+            conn = None
+            stop.wait(args.metrics_interval)
+        s = metrics.snapshot()
+        print(f"[Bridge] {s['rate']:.0f} ev/s, forwarded={s['forwarded']} "
+              f"requeued={s['requeued']} coalesced={s['coalesced']} "
+              f"unrecognized={s['unrecognized']} "
+              f"avg_batch={s['avg_batch']:.1f} latency p50={s['lat_p50_ms']:.1f}ms "
+              f"p99={s['lat_p99_ms']:.1f}ms backlog={s['backlog']}")
+    if conn is not None and conn.is_open:
+        conn.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--peer", action="append", default=[],
+                    help="p2p peer to forward to (repeat; default 127.0.0.1:9001)")
+    ap.add_argument("--queue", default="file_alerts")
+    ap.add_argument("--mq-host", default="localhost")
+    ap.add_argument("--workers", type=int, default=2, help="consumer threads")
+    ap.add_argument("--prefetch", type=int, default=500, help="unacked deliveries per worker")
+    ap.add_argument("--batch", type=int, default=100, help="max events per forwarded batch")
+    ap.add_argument("--flush-ms", type=float, default=20.0, help="max wait to fill a batch")
+    ap.add_argument("--peer-timeout", type=float, default=2.0, help="connect/ack timeout, seconds")
+    ap.add_argument("--keepalive", type=float, default=0.5, help="ping idle peer links every N s")
+    ap.add_argument("--metrics-interval", type=float, default=5.0)
+    args = ap.parse_args()
+    peers = []
+    for s in args.peer or ["127.0.0.1:9001"]:
+        ph, pp = s.rsplit(":", 1); peers.append((ph, int(pp)))
+
+    metrics = BridgeMetrics()
+    stop = threading.Event()
+    workers = [BridgeWorker(i, args, peers, metrics, stop) for i in range(args.workers)]
+    for w in workers:
+        w.start()
+
+    print(f"[Bridge] {args.workers} workers consuming '{args.queue}', forwarding to "
+          f"{', '.join(f'{h}:{p}' for h, p in peers)}")
     try:
         print("[Bridge] Waiting for messages... Ctrl+C to exit")
-        ch.start_consuming()
+        report_loop(args, metrics, stop)
     except KeyboardInterrupt:
         pass
     finally:
-        conn.close()
+        stop.set()
+        for w in workers:
+            w.join(timeout=2.0)
 
 if __name__ == "__main__":
     main()
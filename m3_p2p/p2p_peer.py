@@ -1,80 +1,462 @@
 import asyncio
+import base64
 import json
 import time
 import random
 import argparse
 from typing import Dict, Set, Tuple
-from logical_clock import LamportClock
+from logical_clock import (LamportClock, HybridLogicalClock, vv_compare, vv_merge,
+                           EQUAL, BEFORE, CONCURRENT)
+from anti_entropy import BucketDigest
+from dissemination import SeenCache, choose_targets, DEFAULT_FANOUT, DEFAULT_TTL
+from connections import Connection, ConnectionManager, parse_key
+from membership import (Membership, ACTIVE_SIZE, PASSIVE_SIZE, ARWL, PRWL, ROTATE_CHANCE,
+                        REQUEST_TIMEOUT, REQUEST_TRIES)
+from state_store import StateStore
+from chunks import ChunkStore, FetchPlan, valid_manifest
 
 # JSON-line protocol messages:
 # {"type":"hello","from":"host:port"}
-# {"type":"state","from":"host:port","files":{"id":ver,...},"peers":["h1:p1","h2:p2"]}
-# {"type":"event","file_id":"...", "version": N, "ts": T}
+# {"type":"ping"}   (heartbeat, consumed by the connection manager)
+# {"type":"digest","from":"host:port","root":"..."}
+# {"type":"buckets","from":"host:port","hashes":[...]}
+# {"type":"entries","from":"host:port","files":{"id":ver,...},"want":[bucket,...]}
+# {"type":"event","file_id":"...", "version": N, "ts": T, "ttl": hops_left, "from":"host:port"}
+#   multi-writer files add "vc": {"vv":{replica:n,...},"hlc":[l,c],"by":"host:port"};
+#   entries carry the same per file in "clocks": {"id": vc,...}
+# {"type":"barrier","id":N} -> {"type":"barrier_ack","id":N} once everything before it is applied
+# Membership (see membership.py):
+# {"type":"join"} (answered by neighbor_reply) {"type":"forward_join","node":"h:p","ttl":N}
+# {"type":"neighbor","priority":"high"|"low"} {"type":"neighbor_reply","accepted":bool,"sample":[...]}
+# {"type":"disconnect"} {"type":"shuffle","sample":[...],"ttl":N} {"type":"shuffle_reply","sample":[...]}
+# Content (see chunks.py):
+# {"type":"have_req","file_id":"...","version":N}
+# {"type":"have","file_id":"...","version":N,"manifest":{...},"chunks":[idx,...]}
+# {"type":"chunk_req","file_id":"...","version":N,"idx":i}
+# {"type":"chunk","file_id":"...","version":N,"idx":i,"data":"base64"|null}
+# Legacy (still accepted): {"type":"state",...} and {"type":"peers","peers":[...]}
 
 class Peer:
-    def __init__(self, host: str, port: int, bootstrap: Set[Tuple[str,int]]):
+    def __init__(self, host: str, port: int, bootstrap: Set[Tuple[str,int]],
+                 fanout: int = DEFAULT_FANOUT, ttl: int = DEFAULT_TTL,
+                 gossip_interval: float = 2.0, heartbeat_interval: float = 1.0,
+                 phi_threshold: float = 8.0, active_size: int = ACTIVE_SIZE,
+                 passive_size: int = PASSIVE_SIZE, shuffle_interval: float = 5.0,
+                 store: StateStore = None, chunks: ChunkStore = None,
+                 fetch_timeout: float = 5.0, fetch_attempts: int = 6,
+                 coalesce_window: float = 0.05, time_source=time,
+                 cm_factory=ConnectionManager):
         self.host, self.port = host, port
+        # time_source: anything with time()/monotonic() (the simulator's runs on
+        # virtual time); cm_factory: builds the connection manager
+        self._time = time_source
         self.addr = f"{host}:{port}"
         self.files: Dict[str, int] = {}      # file_id -> version
-        self.peers: Set[Tuple[str,int]] = set(bootstrap)
-        self.connections = {}                # (h,p) -> writer
+        self.digest = BucketDigest()         # incrementally maintained over files
         self.backoff_until = {}              # (h,p) -> unix timestamp
+        self.rng = random.Random()
+
+        # bounded active/passive views instead of a full peer set
+        self.membership = Membership((host, port), active_size, passive_size, rng=self.rng)
+        self.shuffle_interval = shuffle_interval
+        self._last_shuffle = []              # sample we sent in our last shuffle
+        # links we asked for but that aren't confirmed yet: key -> "join" | "forced" | "promote".
+        # A key only enters the active view once both ends agreed over a live
+        # connection, so active views stay symmetric.
+        self._pending: Dict[Tuple[str,int], str] = {}
+        self._pending_until: Dict[Tuple[str,int], float] = {}  # request sent, expires at
+        self._tries: Dict[Tuple[str,int], int] = {}            # times a request was sent
+        self._joined = not bootstrap         # only a node in the overlay takes joins
+        for key in sorted(bootstrap):
+            # pending keys stay in the passive view, to retry them if the request fails
+            self.membership.add_passive(key)
+            if len(self._pending) < active_size:
+                self._pending[key] = "join"
+
+        # one bidirectional connection per peer, heartbeats + phi-accrual eviction
+        self.cm = cm_factory(self.addr, self._on_msg,
+                             make_hello=lambda: {"type":"hello","from":self.addr},
+                             on_evict=self._on_evict,
+                             on_close=self._on_conn_closed,
+                             heartbeat_interval=heartbeat_interval,
+                             phi_threshold=phi_threshold,
+                             time_source=time_source)
+        self.connections = self.cm.conns     # (h,p) -> Connection
 
         # logical clock for event ordering
         self.clock = LamportClock()
 
+        # multi-writer files: version vector + HLC stamp of the winning write
+        self.hlc = HybridLogicalClock(lambda: int(self._time.time() * 1000))
+        self.vclocks: Dict[str, dict] = {}   # file_id -> {"vv":{...},"hlc":[l,c],"by":addr}
+        self.conflicts = 0
+
+        # rumor mongering (push) + digest anti-entropy (pull) tunables
+        self.fanout = fanout
+        self.ttl = ttl
+        self.gossip_interval = gossip_interval
+        self.seen = SeenCache()              # (file_id, version) already spread
+
+        # edit storms: per file, apply/forward at most ~one event per window
+        self.coalesce_window = coalesce_window
+        self._pending_events = {}            # file_id -> (version, ttl, from)
+        self._hot = {}                       # file_id -> loop time its window closes
+        self._coalesce_timer = None
+        self.coalesced = 0                   # superseded events never applied/forwarded
+
+        # snapshot + append-only log; restores files, views and clock on restart
+        self.store = store
+        self._last_snapshot = self._time.time()
+
+        # chunked content replication (off unless a chunk store is given)
+        self.chunks = chunks
+        self.fetch_timeout = fetch_timeout
+        self.fetch_attempts = fetch_attempts
+        self._fetches = {}                   # (file_id, version) -> Task
+        self._have_replies = {}              # (file_id, version) -> [(conn, msg)]
+        self._chunk_waiters = {}             # (peer key, file_id, version, idx) -> Future
+        if store is not None:
+            self._restore(*store.load())
+
+    def _restore(self, files, peers, clock, meta=None):
+        meta = meta or {}
+        for fid, ver in files.items():
+            self.files[fid] = ver
+            if fid in meta:
+                self.vclocks[fid] = meta[fid]
+                self.hlc.recv_event(meta[fid]["hlc"])
+            self.digest.update(fid, None, self._entry(fid))
+        self.clock.time = max(self.clock.time, clock)
+        for key in [parse_key(a) for a in peers]:
+            self.membership.add_passive(key)
+            self._joined = True              # we were part of the overlay before
+        # refill the active view right away instead of one promotion per shuffle
+        self._refill()
+
     async def start(self):
         server = await asyncio.start_server(self._handle_conn, self.host, self.port)
         print(f"[P2P] listening {self.addr}")
-        asyncio.create_task(self._dial_loop())
-        asyncio.create_task(self._gossip_loop())
+        self._start_loops()
         async with server:
             await server.serve_forever()
 
+    def _start_loops(self):
+        self._tasks = [asyncio.create_task(self._dial_loop()),
+                       asyncio.create_task(self._gossip_loop()),
+                       asyncio.create_task(self.cm.heartbeat_loop()),
+                       asyncio.create_task(self._membership_loop())]
+        if self.store is not None:
+            self._tasks.append(asyncio.create_task(self._persist_loop()))
+
+    def stop(self):
+        # cancel background loops and close every connection
+        for t in getattr(self, "_tasks", []) + list(self._fetches.values()):
+            t.cancel()
+        if self._coalesce_timer is not None:
+            self._coalesce_timer.cancel()
+        for conn in list(self.connections.values()):
+            self.cm.drop(conn)
+        if self.store is not None:
+            self._snapshot()
+            self.store.close()
+
+    def _snapshot(self):
+        self.store.snapshot(self.files, self._keys_to_list(self.peers), self.clock.time,
+                            self.vclocks)
+        self._last_snapshot = self._time.time()
+
+    async def _persist_loop(self):
+        while True:
+            await asyncio.sleep(0.5)
+            self.store.flush()
+            # compact when the log grows, and now and then to persist the views;
+            # the copy and log rotation happen here, the write and fsync in a thread
+            if self.store.needs_compaction() or self._time.time() - self._last_snapshot > 60:
+                state = self.store.begin_snapshot(self.files, self._keys_to_list(self.peers),
+                                                  self.clock.time, self.vclocks)
+                self._last_snapshot = self._time.time()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.store.finish_snapshot, state)
+
+    def _guard_clock(self):
+        # persist a clock mark before handing out timestamps past the last one
+        if self.store is not None and self.clock.time >= self.store.clock_mark:
+            self.store.reserve_clock(self.clock.time)
+
+    def _set_version(self, fid: str, ver: int, meta: dict = None):
+        # single place that mutates files, so the digest stays in sync
+        old = self._entry(fid)
+        self.files[fid] = ver
+        if meta is None:
+            self.vclocks.pop(fid, None)      # server-versioned (again)
+        else:
+            self.vclocks[fid] = meta
+        self.digest.update(fid, old, self._entry(fid))
+        if self.store is not None:
+            self.store.append(fid, ver, self.clock.time, meta)
+
+    @staticmethod
+    def _entry_of(ver, meta):
+        # what the digest hashes: the version, plus the vector for multi-writer files
+        # (concurrent writes can share a version number)
+        if ver is None or meta is None:
+            return ver
+        return f"{ver}|{json.dumps(meta, sort_keys=True, separators=(',', ':'))}"
+
+    def _entry(self, fid: str):
+        return self._entry_of(self.files.get(fid), self.vclocks.get(fid))
+
+    def _merge_files(self, files: Dict[str, int], frm=None, clocks=None):
+        # last-write-wins by version; multi-writer files compare version vectors
+        clocks = clocks or {}
+        for fid, ver in files.items():
+            ver = int(ver)
+            if fid in clocks:
+                self._merge_versioned(fid, ver, clocks[fid], frm)
+            elif self._server_version_wins(fid, ver):
+                self._set_version(fid, ver)
+                print(f"[P2P] merge {fid} -> v{ver} (from {frm})")
+                self._want_content(fid, ver)
+
+    def _server_version_wins(self, fid: str, ver: int) -> bool:
+        # A server version replaces anything with a lower number. A multi-writer
+        # state with the same number forked from an older server version
+        # (vv {"_": 3, peer: 1} is v4 too), so it is concurrent with it; every
+        # replica settles it the same way: the server's version wins.
+        cur = self.files.get(fid, 0)
+        if ver == cur and fid in self.vclocks:
+            self.conflicts += 1
+            print(f"[P2P] conflict on {fid}: server v{ver} wins over vv={self.vclocks[fid]['vv']}")
+            return True
+        return ver > cur
+
+    def local_write(self, fid: str) -> int:
+        """Accept a write to fid on this replica, without coordinating with others."""
+        cur = self.vclocks.get(fid)
+        if cur is not None:
+            vv = dict(cur["vv"])
+        else:
+            # a server-versioned file carries its version into the vector, so
+            # the new version number is still higher than what peers hold
+            vv = {"_": self.files[fid]} if fid in self.files else {}
+        vv[self.addr] = vv.get(self.addr, 0) + 1
+        meta = {"vv": vv, "hlc": list(self.hlc.send_event()), "by": self.addr}
+        ver = sum(vv.values())
+        self._set_version(fid, ver, meta)
+        print(f"[P2P] local write {fid} -> v{ver} vv={vv}")
+        self.seen.add((fid, self._entry(fid)))
+        asyncio.create_task(self._spread(fid, ver, self.ttl))
+        return ver
+
+    def _merge_versioned(self, fid: str, ver: int, meta: dict, frm=None) -> bool:
+        """Fold a remote multi-writer state into ours. Returns True if ours changed."""
+        try:
+            self.hlc.recv_event(meta["hlc"])
+            remote_vv = {str(k): int(v) for k, v in meta["vv"].items()}
+            meta = {"vv": remote_vv, "hlc": [int(x) for x in meta["hlc"]], "by": str(meta["by"])}
+        except (KeyError, TypeError, ValueError, IndexError):
+            return False
+        cur = self.vclocks.get(fid)
+        if cur is None:
+            # nothing to compare vectors with: plain version order, and a
+            # server version beats a vector with the same number
+            if ver <= self.files.get(fid, 0):
+                return False
+        else:
+            order = vv_compare(remote_vv, cur["vv"])
+            if order in (EQUAL, BEFORE):
+                return False
+            if order == CONCURRENT:
+                # genuine conflict: keep both histories in the vector; the write
+                # with the highest (hlc, writer) wins. max() is associative, so
+                # every replica ends with the same winner whatever the merge order.
+                win = max(cur, meta, key=lambda m: (tuple(m["hlc"]), m["by"]))
+                lose = cur if win is meta else meta
+                self.conflicts += 1
+                print(f"[P2P] conflict on {fid}: {win['by']}@{win['hlc']} wins over "
+                      f"{lose['by']}@{lose['hlc']}")
+                meta = {"vv": vv_merge(cur["vv"], remote_vv), "hlc": win["hlc"], "by": win["by"]}
+        ver = sum(meta["vv"].values())
+        self._set_version(fid, ver, meta)
+        print(f"[P2P] merge {fid} -> v{ver} vv={meta['vv']} (from {frm})")
+        return True
+
+    def _entries_msg(self, bucket_ids, **extra):
+        files = self.digest.entries_in(self.files, bucket_ids)
+        msg = {"type":"entries","from":self.addr,"files":files}
+        clocks = {f: self.vclocks[f] for f in files if f in self.vclocks}
+        if clocks:
+            msg["clocks"] = clocks
+        msg.update(extra)
+        return msg
+
+    @property
+    def peers(self) -> Set[Tuple[str,int]]:
+        return self.membership.known()
+
+    def _merge_peers(self, peers):
+        for ps in peers:
+            try:
+                key = parse_key(ps)
+                if key not in self.peers and key != (self.host,self.port):
+                    print(f"[P2P] learned peer {ps}")
+                self.membership.add_passive(key)
+            except: pass
+
+    @staticmethod
+    def _keys_to_list(keys):
+        return [f"{h}:{p}" for (h,p) in keys]
+
     async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         peername = writer.get_extra_info("peername")
         print(f"[P2P] incoming {peername}")
+        await self.cm.accept(reader, writer)
+
+    def _on_evict(self, key):
+        # suspected dead: back off before redialing
+        self.backoff_until[key] = self._time.time() + self.rng.uniform(1.0, 4.0)
+
+    def _on_conn_closed(self, key):
+        # an active link went away: demote it and ask a passive peer to replace it
+        self._request_failed(key)
+        if key in self.membership.active:
+            self.membership.remove_active(key)
+            self.backoff_until.setdefault(key, self._time.time() + self.rng.uniform(0.5, 2.0))
+        self._refill()
+
+    def _unpend(self, key):
+        self._pending.pop(key, None)
+        self._pending_until.pop(key, None)
+        self._tries.pop(key, None)
+
+    def _request_failed(self, key):
+        # a join is retried until some bootstrap peer took us; other requests give up
+        if self._pending.get(key) == "join" and not self._joined:
+            self._pending_until.pop(key, None)
+            self._tries.pop(key, None)
+        else:
+            self._unpend(key)
+
+    def _refill(self):
+        # one neighbor request per free active slot, to passive peers not backed off
+        m = self.membership
+        if not self._joined:
+            return  # until a bootstrap peer took us, only the join goes out
+        now = self._time.time()
+        skip = {k for k, t in self.backoff_until.items() if t > now} | set(self._pending)
+        while len(m.active) + len(self._pending) < m.active_size:
+            cand = m.promotion_candidate(exclude=skip)
+            if cand is None:
+                return
+            skip.add(cand)
+            self._pending[cand] = "promote"  # dial loop connects and sends neighbor
+
+    async def _dial_loop(self):
+        # only the (bounded) active view and pending requests are ever dialed
+        while True:
+            now = self._time.time()
+            for key, until in sorted(self._pending_until.items()):
+                if until >= now: continue
+                # unanswered: the request or its reply went down with a connection
+                # (e.g. one that lost a simultaneous-dial race), so ask again
+                del self._pending_until[key]
+                if self._tries.get(key, 0) >= REQUEST_TRIES:
+                    self._request_failed(key)
+                    self.backoff_until[key] = now + self.rng.uniform(0.5, 2.0)
+                    if key not in self.membership.active and key in self.connections:
+                        self.cm.drop(self.connections[key])  # the other end may have said yes
+            for key in sorted(self._pending):  # sorted: reproducible under the simulator
+                if key in self._pending_until or key in self.cm.dialing: continue
+                if now < self.backoff_until.get(key, 0): continue
+                asyncio.create_task(self._dial(key))
+            await asyncio.sleep(0.5)
+
+    async def _dial(self, key):
+        # dials run as tasks so one slow host doesn't hold up the rest
+        if key not in self._pending: return
+        self._pending_until[key] = self._time.time() + self.cm.dial_timeout + REQUEST_TIMEOUT
+        try:
+            conn = self.connections.get(key) or await self.cm.dial(key)
+            kind = self._pending.get(key)
+            if conn is None or kind is None: return
+            self._tries[key] = self._tries.get(key, 0) + 1
+            self._pending_until[key] = self._time.time() + REQUEST_TIMEOUT
+            if kind == "join":
+                await self._send(conn, {"type":"join","from":self.addr})
+            else:
+                prio = "high" if kind == "forced" or len(self.membership.active) <= 1 else "low"
+                await self._send(conn, {"type":"neighbor","from":self.addr,"priority":prio})
+        except Exception:
+            self._request_failed(key)
+            self.backoff_until[key] = self._time.time() + self.rng.uniform(0.5, 2.0)
+            self._refill()
+
+    def _make_active(self, key):
+        # only called with a live connection to key, after both ends agreed
+        self._joined = True
+        dropped = self.membership.add_active(key)
+        if dropped is not None:
+            asyncio.create_task(self._disconnect(dropped))
+
+    async def _disconnect(self, key):
+        conn = self.connections.get(key)
+        if conn is None: return
         try:
-            await self._send(writer, {"type":"hello","from":self.addr})
-            while True:
-                line = await reader.readline()
-                if not line: break
-                msg = json.loads(line.decode().strip())
-                await self._on_msg(msg, writer)
+            await self._send(conn, {"type":"disconnect","from":self.addr})
         except Exception:
             pass
-        finally:
-            writer.close(); await writer.wait_closed()
+        self.cm.drop(conn)
 
-    async def _dial_loop(self):
+    async def _membership_loop(self):
         while True:
-            now = time.time()
-            for (h,p) in list(self.peers):
-                if (h,p) in self.connections: continue
-                if now < self.backoff_until.get((h,p), 0): continue
-                try:
-                    r,w = await asyncio.wait_for(asyncio.open_connection(h,p), 1.0)
-                    self.connections[(h,p)] = w
-                    print(f"[P2P] connected {h}:{p}")
-                    await self._send(w, {"type":"hello","from":self.addr})
-                except Exception:
-                    self.backoff_until[(h,p)] = now + random.uniform(0.5, 2.0)
-            await asyncio.sleep(0.5)
+            await asyncio.sleep(self.shuffle_interval)
+            now = self._time.time()
+            m = self.membership
+
+            # close links that never became (or stopped being) active
+            for key, conn in list(self.connections.items()):
+                if key not in m.active and key not in self._pending \
+                        and self._time.monotonic() - conn.opened_at > self.shuffle_interval:
+                    self.cm.drop(conn)
+
+            # refill the active view from the passive view
+            self._refill()
+            if m.is_full() and not self._pending and self.rng.random() < ROTATE_CHANCE:
+                # now and then trade a link for a passive peer: keeps the overlay
+                # mixing, and is the only way out for a group whose views filled
+                # up with each other
+                blocked = {k for k, t in self.backoff_until.items() if t > now}
+                cand = m.promotion_candidate(exclude=blocked)
+                if cand is not None:
+                    self._pending[cand] = "forced"  # taken even if it's full: a swap
+
+            # refresh passive views: the sample walks to a peer far from us, so
+            # passive views keep mixing across the whole overlay
+            target = m.random_active()
+            if target is not None and target in self.connections:
+                sample = m.shuffle_sample()
+                self._last_shuffle = sample
+                await self._send_or_drop(self.connections[target],
+                                         {"type":"shuffle","from":self.addr,"ttl":ARWL,
+                                          "sample": self._keys_to_list(sample)})
 
     async def _gossip_loop(self):
         while True:
-            await asyncio.sleep(2.0)
+            await asyncio.sleep(self.gossip_interval)
             if not self.connections: continue
-            state = {"type":"state","from":self.addr,
-                     "files": self.files,
-                     "peers": [f"{h}:{p}" for (h,p) in self.peers]}
-            for key, w in list(self.connections.items()):
-                try:
-                    await self._send(w, state)
-                except Exception:
-                    self.connections.pop(key, None)
-
-    async def _on_msg(self, msg, writer):
+            # constant-size digest; full entries only flow for differing buckets
+            digest = {"type":"digest","from":self.addr,
+                      "root": self.digest.root()}
+            await asyncio.gather(*(self._send_or_drop(c, dict(digest))
+                                   for c in list(self.connections.values())))
+
+    async def _send_or_drop(self, conn: Connection, obj):
+        try:
+            await self._send(conn, obj)
+        except Exception:
+            self.cm.drop(conn)
+
+    async def _on_msg(self, msg, conn: Connection):
         # merge logical time (Lamport) for any incoming message
         incoming_ts = msg.get("ts")
         if incoming_ts is not None:
@@ -82,37 +464,343 @@ class Peer:
             print(f"[P2P] clock update -> {local_time}")
         else:
             self.clock.tick()
+        self._guard_clock()
 
         t = msg.get("type")
         if t == "hello":
             frm = msg.get("from")
             if frm and frm != self.addr:
-                h,p = frm.split(":"); self.peers.add((h,int(p)))
+                self.membership.add_passive(parse_key(frm))
+        elif t in ("join", "forward_join", "neighbor", "neighbor_reply",
+                   "disconnect", "shuffle", "shuffle_reply"):
+            await self._on_membership_msg(t, msg, conn)
+        elif t == "digest":
+            if msg.get("root") != self.digest.root():
+                await self._send(conn, {"type":"buckets","from":self.addr,
+                                        "hashes": self.digest.buckets})
+        elif t == "buckets":
+            diff = self.digest.diff(msg.get("hashes", []))
+            if diff:
+                await self._send(conn, self._entries_msg(diff, want=diff))
+        elif t == "entries":
+            self._merge_files(msg.get("files", {}), msg.get("from"), msg.get("clocks"))
+            want = msg.get("want")
+            if want:
+                await self._send(conn, self._entries_msg(want))
+        elif t == "peers":
+            # legacy peer-list gossip: only feeds the passive view
+            self._merge_peers(msg.get("peers", []))
         elif t == "state":
-            # merge files: last-write-wins by version
-            for fid, ver in msg.get("files", {}).items():
-                if ver > self.files.get(fid, 0):
-                    self.files[fid] = ver
-                    print(f"[P2P] merge {fid} -> v{ver} (from {msg.get('from')})")
-            for ps in msg.get("peers", []):
-                try:
-                    h,p = ps.split(":"); p = int(p)
-                    if (h,p) != (self.host,self.port):
-                        if (h,p) not in self.peers:
-                            print(f"[P2P] learned peer {h}:{p}")
-                        self.peers.add((h,p))
-                except: pass
+            # legacy full-state gossip from older peers
+            self._merge_files(msg.get("files", {}), msg.get("from"))
+            self._merge_peers(msg.get("peers", []))
         elif t == "event":
-            fid = msg["file_id"]; ver = int(msg["version"])
-            newv = max(ver, self.files.get(fid, 0))
-            if newv != self.files.get(fid, 0):
-                self.files[fid] = newv
-                print(f"[P2P] event applied {fid} -> v{newv} (ts={self.clock.time})")
+            # an event from the MQ bridge starts here and gets all TTL hops, as a
+            # local write does (applying it takes one off before forwarding)
+            ttl = int(msg["ttl"]) if "ttl" in msg else self.ttl + 1
+            if msg.get("vc"):
+                # multi-writer: concurrent versions can't be collapsed, so no coalescing
+                self._apply_versioned_event(msg["file_id"], int(msg["version"]), msg["vc"],
+                                            ttl, msg.get("from"))
+            else:
+                self._queue_event(msg["file_id"], int(msg["version"]), ttl, msg.get("from"))
+        elif t == "barrier":
+            # messages on a connection are handled in order, so all earlier ones are applied
+            self._flush_events()
+            await self._send(conn, {"type":"barrier_ack","id":msg.get("id")})
+        elif t in ("have_req", "have", "chunk_req", "chunk"):
+            await self._on_content_msg(t, msg, conn)
+
+    def _queue_event(self, fid: str, ver: int, ttl: int, frm=None):
+        # The first event for a file applies at once and opens a window; later
+        # ones in the window collapse into the newest version, applied when it closes.
+        if self.coalesce_window <= 0:
+            self._apply_event(fid, ver, ttl, frm)
+            return
+        now = asyncio.get_running_loop().time()
+        pend = self._pending_events.get(fid)
+        if pend is None and self._hot.get(fid, 0) <= now:
+            self._apply_event(fid, ver, ttl, frm)
+            if len(self._hot) > 4096:
+                self._hot = {f: t for f, t in self._hot.items() if t > now}
+            self._hot[fid] = now + self.coalesce_window
+            return
+        if pend is None or (ver, ttl) > pend[:2]:
+            if pend is not None:
+                self.coalesced += 1
+            self._pending_events[fid] = (ver, ttl, frm)
+        else:
+            self.coalesced += 1
+        if self._coalesce_timer is None:
+            self._coalesce_timer = asyncio.get_running_loop().call_later(
+                self.coalesce_window, self._flush_events)
+
+    def _flush_events(self):
+        if self._coalesce_timer is not None:
+            self._coalesce_timer.cancel()
+            self._coalesce_timer = None
+        if not self._pending_events:
+            return
+        pending, self._pending_events = self._pending_events, {}
+        until = asyncio.get_running_loop().time() + self.coalesce_window
+        for fid, (ver, ttl, frm) in pending.items():
+            self._apply_event(fid, ver, ttl, frm)
+            self._hot[fid] = until
+
+    def _apply_event(self, fid: str, ver: int, ttl: int, frm=None):
+        cur = self.files.get(fid, 0)
+        if self._server_version_wins(fid, ver):
+            self._set_version(fid, ver)
+            print(f"[P2P] event applied {fid} -> v{ver} (ts={self.clock.time})")
+            self._want_content(fid, ver)
+        elif ver < cur:
+            self.coalesced += 1
+            return  # superseded: the newer version is spread on its own
+        # forward each (file_id, version) at most once, while TTL lasts
+        if ttl > 0 and self.seen.add((fid, ver)):
+            asyncio.create_task(self._spread(fid, ver, ttl - 1, frm))
+
+    def _apply_versioned_event(self, fid: str, ver: int, vc: dict, ttl: int, frm=None):
+        incoming = self._entry_of(ver, vc)
+        changed = self._merge_versioned(fid, ver, vc, frm)
+        current = self._entry(fid)
+        if not changed and incoming != current:
+            self.coalesced += 1
+            return  # stale: we already hold something newer
+        # forward our (possibly conflict-resolved) state, once per state
+        if ttl > 0 and self.seen.add((fid, current)):
+            asyncio.create_task(self._spread(fid, self.files[fid], ttl - 1, frm))
+
+    async def _on_membership_msg(self, t, msg, conn: Connection):
+        m = self.membership
+        sender = conn.key
+        if sender is None or self.connections.get(sender) is not conn: return
+
+        if t == "join":
+            if not self._joined or not m.active:
+                # an island grown around us would never meet the rest: send the
+                # joiner on to the peers we know (our own contact among them)
+                await self._send(conn, {"type":"neighbor_reply","from":self.addr,"accepted":False,
+                                        "sample": self._keys_to_list(m.shuffle_sample()[1:])})
+                return
+            retry = sender in m.active      # our first answer got lost
+            self._unpend(sender)
+            self._make_active(sender)
+            print(f"[P2P] join from {msg.get('from')}")
+            await self._send(conn, {"type":"neighbor_reply","from":self.addr,"accepted":True})
+            if retry: return
+            fwd = {"type":"forward_join","from":self.addr,"node":msg.get("from"),"ttl":ARWL}
+            for key in sorted(m.active):
+                if key != sender and key in self.connections:
+                    await self._send_or_drop(self.connections[key], dict(fwd))
+        elif t == "forward_join":
+            node = parse_key(msg["node"]); ttl = int(msg.get("ttl", 0))
+            if node == (self.host, self.port): return
+            nxt = m.random_active(exclude={sender, node})
+            if ttl <= 0 or len(m.active) <= 1 or nxt is None or nxt not in self.connections:
+                if node not in m.active:
+                    m.add_passive(node)
+                    self._pending[node] = "forced"  # dial loop sends a high-priority neighbor request
+                return
+            if ttl == PRWL:
+                m.add_passive(node)
+            await self._send_or_drop(self.connections[nxt],
+                                     {"type":"forward_join","from":self.addr,
+                                      "node":msg["node"],"ttl":ttl - 1})
+        elif t == "neighbor":
+            # a request crossing our own to the same peer is accepted on both ends
+            accept = msg.get("priority") == "high" or not m.is_full() \
+                or sender in m.active or sender in self._pending
+            if accept:
+                self._unpend(sender)
+                self._make_active(sender)
+            reply = {"type":"neighbor_reply","from":self.addr,"accepted":accept}
+            if not accept:
+                # point a peer we turn away at others it can ask instead
+                reply["sample"] = self._keys_to_list(m.shuffle_sample()[1:])
+            await self._send(conn, reply)
+        elif t == "neighbor_reply":
+            wanted = sender in self._pending or sender in m.active
+            self._request_failed(sender)  # done, unless it's a join to retry
+            if msg.get("accepted") and wanted:
+                self._make_active(sender)
+            elif msg.get("accepted"):
+                # we gave up on this request meanwhile: undo the other end
+                await self._disconnect(sender)
+            else:
+                self.backoff_until[sender] = self._time.time() + self.rng.uniform(0.5, 2.0)
+                sample = [parse_key(a) for a in msg.get("sample", [])]
+                m.merge_sample(sample)
+                others = sorted(set(sample) - {sender, (self.host, self.port)})
+                if self._pending.get(sender) == "join" and others:
+                    # our contact isn't in the overlay itself: join through its contacts
+                    self._unpend(sender)
+                    self._pending[self.rng.choice(others)] = "join"
+                m.remove_active(sender)
+                self.cm.drop(conn)  # on_close asks the next passive peer
+        elif t == "disconnect":
+            self._unpend(sender)
+            m.remove_active(sender)
+            self.cm.drop(conn)
+        elif t == "shuffle":
+            sample = [parse_key(a) for a in msg.get("sample", [])]
+            ttl = int(msg.get("ttl", 0))
+            nxt = m.random_active(exclude={sender, *sample[:1]})
+            if ttl > 0 and nxt is not None and nxt in self.connections:
+                await self._send_or_drop(self.connections[nxt], {**msg, "from":self.addr,"ttl":ttl - 1})
+                return
+            # end of the walk: trade samples with the peer that handed it to us
+            reply = m.shuffle_sample()
+            await self._send(conn, {"type":"shuffle_reply","from":self.addr,
+                                    "sample": self._keys_to_list(reply)})
+            m.merge_sample(sample, sent=reply)
+        elif t == "shuffle_reply":
+            sample = [parse_key(a) for a in msg.get("sample", [])]
+            m.merge_sample(sample, sent=self._last_shuffle)
+
+    # --- content replication ---
+
+    def publish_file(self, fid: str, data: bytes) -> dict:
+        """Store data as the next version of fid and serve its chunks to other peers."""
+        ver = self.files.get(fid, 0) + 1
+        manifest = self.chunks.add_file(fid, ver, data)
+        self._set_version(fid, ver)
+        return manifest
+
+    def read_file(self, fid: str):
+        """Bytes of the current version of fid, or None if not (fully) replicated yet."""
+        ver = self.files.get(fid)
+        if self.chunks is None or ver is None or not self.chunks.complete(fid, ver):
+            return None
+        return self.chunks.assemble(self.chunks.manifest(fid, ver))
+
+    def _want_content(self, fid: str, ver: int):
+        if self.chunks is None or (fid, ver) in self._fetches or self.chunks.complete(fid, ver):
+            return
+        self._fetches[(fid, ver)] = asyncio.create_task(self._fetch_content(fid, ver))
+
+    async def _fetch_content(self, fid: str, ver: int):
+        key = (fid, ver)
+        wait = 0.5
+        try:
+            for _ in range(self.fetch_attempts):
+                if self.files.get(fid) != ver:
+                    return  # superseded by a newer version
+                self._have_replies[key] = []
+                await asyncio.gather(*(self._send_or_drop(c, {"type":"have_req","from":self.addr,
+                                                              "file_id":fid,"version":ver})
+                                       for c in list(self.connections.values())))
+                await asyncio.sleep(wait)
+                if await self._download(fid, ver, self._have_replies.pop(key, [])):
+                    print(f"[P2P] content {fid} v{ver} complete")
+                    return
+                wait = min(wait * 2, 30.0)  # nobody has (all of) it yet
+            print(f"[P2P] content {fid} v{ver} unavailable, giving up")
+        finally:
+            self._have_replies.pop(key, None)
+            self._fetches.pop(key, None)
+
+    async def _download(self, fid: str, ver: int, replies) -> bool:
+        manifest = self.chunks.manifest(fid, ver)
+        for _, msg in replies:
+            m = msg.get("manifest")
+            if manifest is None and valid_manifest(m) and m.get("file_id") == fid \
+                    and m.get("version") == ver:
+                manifest = m
+        if manifest is None:
+            return False
+        self.chunks.add_manifest(manifest)
+
+        # every neighbour that holds chunks of the same manifest is a source
+        plan = FetchPlan(self.chunks.missing(manifest))
+        for conn, msg in replies:
+            m = msg.get("manifest") or {}
+            if conn.key is not None and m.get("root") == manifest["root"]:
+                plan.add_source(conn.key, msg.get("chunks", []))
+
+        running = {}
+        while not plan.done():
+            for src, idx in plan.next_requests():
+                task = asyncio.create_task(self._fetch_chunk(src, fid, ver, idx))
+                running[task] = (src, idx)
+            if not running:
+                break  # stalled: the rest isn't available from these sources
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                src, idx = running.pop(task)
+                data = task.result()
+                if data is not None and self.chunks.put(data, manifest["chunks"][idx]):
+                    plan.completed(src, idx)
+                else:
+                    plan.failed_at(src, idx)
+                    if src not in self.connections:
+                        plan.remove_source(src)
+        return plan.done()
+
+    async def _fetch_chunk(self, src, fid: str, ver: int, idx: int):
+        conn = self.connections.get(src)
+        if conn is None:
+            return None
+        key = (src, fid, ver, idx)
+        fut = asyncio.get_running_loop().create_future()
+        self._chunk_waiters[key] = fut
+        try:
+            await self._send(conn, {"type":"chunk_req","from":self.addr,
+                                    "file_id":fid,"version":ver,"idx":idx})
+            return await asyncio.wait_for(fut, self.fetch_timeout)
+        except Exception:
+            return None
+        finally:
+            self._chunk_waiters.pop(key, None)
+
+    async def _on_content_msg(self, t, msg, conn: Connection):
+        if self.chunks is None: return
+        fid = msg.get("file_id"); ver = msg.get("version")
+        if t == "have_req":
+            manifest = self.chunks.manifest(fid, ver)
+            held = self.chunks.held(manifest) if manifest else []
+            if held:
+                await self._send(conn, {"type":"have","from":self.addr,"file_id":fid,
+                                        "version":ver,"manifest":manifest,"chunks":held})
+        elif t == "have":
+            replies = self._have_replies.get((fid, ver))
+            if replies is not None:
+                replies.append((conn, msg))
+        elif t == "chunk_req":
+            manifest = self.chunks.manifest(fid, ver)
+            idx = msg.get("idx")
+            data = None
+            if manifest and isinstance(idx, int) and 0 <= idx < len(manifest["chunks"]):
+                data = self.chunks.get(manifest["chunks"][idx])
+            await self._send(conn, {"type":"chunk","from":self.addr,"file_id":fid,"version":ver,
+                                    "idx":idx,"data": base64.b64encode(data).decode()
+                                    if data is not None else None})
+        elif t == "chunk":
+            fut = self._chunk_waiters.get((conn.key, fid, ver, msg.get("idx")))
+            if fut is not None and not fut.done():
+                data = msg.get("data")
+                fut.set_result(base64.b64decode(data) if data is not None else None)
+
+    async def _spread(self, fid: str, ver: int, ttl: int, frm=None):
+        exclude = set()
+        if frm:
+            h,p = frm.split(":"); exclude.add((h,int(p)))
+        # the origin pushes to its whole (small) active view: the first hop
+        # decides how much of the overlay a bounded TTL can still reach
+        k = self.fanout if frm else len(self.connections)
+        targets = choose_targets(list(self.connections), k, exclude, self.rng)
+        event = {"type":"event","from":self.addr,"file_id":fid,"version":ver,"ttl":ttl}
+        if fid in self.vclocks and self.files.get(fid) == ver:
+            event["vc"] = self.vclocks[fid]
+        await asyncio.gather(*(
+            self._send_or_drop(self.connections[k], dict(event))
+            for k in targets if k in self.connections))
 
-    async def _send(self, writer: asyncio.StreamWriter, obj):
+    async def _send(self, conn: Connection, obj):
         # attach Lamport timestamp to every outgoing message
         obj["ts"] = self.clock.send_event()
-        writer.write((json.dumps(obj)+"\n").encode()); await writer.drain()
+        self._guard_clock()
+        await conn.send(obj)
 
 def parse_args():
     ap = argparse.ArgumentParser()
@@ -120,6 +808,20 @@ def parse_args():
     ap.add_argument("--port", type=int, required=True)
     ap.add_argument("--peer", action="append", default=[], help="bootstrap host:port (repeat)")
     ap.add_argument("--inject", action="append", default=[], help="seed: file_id:version (repeat)")
+    ap.add_argument("--write", action="append", default=[], help="local multi-writer write: file_id (repeat)")
+    ap.add_argument("--fanout", type=int, default=DEFAULT_FANOUT, help="peers each new event is pushed to")
+    ap.add_argument("--ttl", type=int, default=DEFAULT_TTL, help="max hops for a pushed event")
+    ap.add_argument("--gossip-interval", type=float, default=2.0, help="seconds between digest rounds")
+    ap.add_argument("--heartbeat-interval", type=float, default=1.0, help="seconds between pings")
+    ap.add_argument("--phi-threshold", type=float, default=8.0, help="failure detector suspicion level")
+    ap.add_argument("--active-size", type=int, default=ACTIVE_SIZE, help="max connected neighbours")
+    ap.add_argument("--passive-size", type=int, default=PASSIVE_SIZE, help="max known backup peers")
+    ap.add_argument("--shuffle-interval", type=float, default=5.0, help="seconds between view shuffles")
+    ap.add_argument("--data-dir", default=None, help="persist state here (snapshot + update log)")
+    ap.add_argument("--compact-every", type=int, default=10000, help="log entries between snapshots")
+    ap.add_argument("--coalesce-ms", type=float, default=50.0, help="per-file event coalescing window")
+    ap.add_argument("--chunk-dir", default=None, help="replicate file content, storing chunks here")
+    ap.add_argument("--publish", action="append", default=[], help="file_id:path to serve (repeat)")
     return ap.parse_args()
 
 async def main():
@@ -127,10 +829,29 @@ async def main():
     boots = set()
     for s in args.peer:
         h,p = s.split(":"); boots.add((h,int(p)))
-    node = Peer(args.host, args.port, boots)
+    node = Peer(args.host, args.port, boots, fanout=args.fanout, ttl=args.ttl,
+                gossip_interval=args.gossip_interval,
+                heartbeat_interval=args.heartbeat_interval,
+                phi_threshold=args.phi_threshold,
+                active_size=args.active_size,
+                passive_size=args.passive_size,
+                shuffle_interval=args.shuffle_interval,
+                store=StateStore(args.data_dir, args.compact_every) if args.data_dir else None,
+                chunks=ChunkStore(args.chunk_dir) if args.chunk_dir or args.publish else None,
+                coalesce_window=args.coalesce_ms / 1000.0)
     for inj in args.inject:
-        fid,ver = inj.split(":"); node.files[fid] = int(ver)
-    await node.start()
+        fid,ver = inj.split(":"); node._set_version(fid, int(ver))
+    for fid in args.write:
+        node.local_write(fid)
+    for pub in args.publish:
+        fid, path = pub.split(":", 1)
+        with open(path, "rb") as f:
+            m = node.publish_file(fid, f.read())
+        print(f"[P2P] publishing {fid} v{m['version']} ({m['size']} bytes, {len(m['chunks'])} chunks)")
+    try:
+        await node.start()
+    finally:
+        node.stop()  # final snapshot on shutdown
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,567 @@
+"""
+simulator.py — deterministic discrete-event simulator for the P2P overlay.
+
+Runs thousands of unmodified `Peer` instances in one process over a virtual
+network. Nothing touches real sockets or the wall clock:
+- the asyncio loop runs on virtual time: when every task is waiting, the
+  clock jumps straight to the next timer, so a 60 s scenario finishes as fast
+  as the CPU can process its messages
+- each peer's ConnectionManager dials through the virtual network; every
+  message is JSON-encoded (counted as bytes) and delivered after a random
+  latency, in order per link, unless it is lost or crosses a partition
+- all randomness (peer RNGs, latency, loss, who bootstraps from whom) comes
+  from one seed, so the same arguments give the same results
+
+Scenario: nodes join one after another through a random earlier node, the
+overlay warms up, then `--updates` events are injected at random nodes (as the
+MQ bridge would). Optional partition/heal and silent crashes run alongside.
+The report covers per-update convergence time, messages and bytes per node
+(total and by type), Lamport clock spread, and the final active-view graph.
+
+Example:
+    python simulator.py --nodes 2000 --updates 20 --loss 0.01 --seed 7
+    python simulator.py --nodes 500 --partition-at 15 --heal-at 30
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import heapq
+import json
+import os
+import random
+import selectors
+import statistics
+import time as _walltime
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional, Tuple
+
+import wire
+from connections import ConnectionManager, PhiAccrualDetector, parse_key
+from dissemination import DEFAULT_FANOUT, DEFAULT_TTL
+from membership import ACTIVE_SIZE, PASSIVE_SIZE
+from p2p_peer import Peer
+
+Key = Tuple[str, int]
+
+
+# --- virtual time ---
+
+class _VirtualSelector(selectors.SelectSelector):
+    """Never blocks: 'waiting' for a timeout just advances the virtual clock."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self._loop = loop
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("simulation deadlocked: no timers and nothing ready")
+        if timeout > 0:
+            self._loop._now += timeout
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self._now = 0.0
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        return self._now
+
+
+class _VirtualClock:
+    """The peers' time source during a run: wall and monotonic time are loop time."""
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def time(self):
+        return self._loop.time()
+
+    def monotonic(self):
+        return self._loop.time()
+
+
+# --- virtual network ---
+
+class SimConnection:
+    """One end of a virtual connection; duck-types connections.Connection."""
+
+    def __init__(self, net: "Network", owner: Key, initiator: str, key: Optional[Key],
+                 detector: PhiAccrualDetector):
+        self.net = net
+        self.owner = owner
+        self.initiator = initiator
+        self.key = key
+        self.detector = detector
+        self.opened_at = net.loop.time()
+        self.closed = False
+        self.codec = None
+        self.remote: Optional["SimConnection"] = None
+        self.in_flight = deque()     # sent to us, not delivered yet (oldest first)
+        self.inbox = deque()         # delivered, waiting for the reader
+        self.reader = None
+        self.msgs_sent = 0
+        self.frames_sent = 0
+
+    def negotiate(self, remote_wire):
+        pass  # everything is sized as JSON lines
+
+    async def send(self, obj):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self.msgs_sent += 1
+        self.frames_sent += 1
+        self.net.transmit(self, obj)
+
+    async def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.net.hangup(self)
+
+
+class SimConnectionManager(ConnectionManager):
+    """ConnectionManager whose dials and reads go through the virtual network."""
+
+    def __init__(self, *args, net: "Network", **kw):
+        super().__init__(*args, **kw)
+        self.net = net
+
+    async def dial(self, key: Key):
+        self.dialing.add(key)
+        try:
+            local = await self.net.connect(self, key)
+        finally:
+            self.dialing.discard(key)
+        if not self._register(local):
+            return self.conns.get(key)
+        await local.send(self._hello())
+        return local
+
+    async def receive(self, conn: SimConnection, msg: dict):
+        # same per-message steps as ConnectionManager._read_loop
+        if conn.closed:
+            return
+        conn.detector.heartbeat(self.net.loop.time())
+        t = msg.get("type")
+        if t == "ping":
+            return
+        if t == "hello" and conn.key is None:
+            frm = msg.get("from")
+            if frm and frm != self.addr:
+                conn.initiator = frm
+                conn.key = parse_key(frm)
+                if not self._register(conn):
+                    return
+        try:
+            await self.on_message(msg, conn)
+        except Exception:
+            self.drop(conn)
+
+
+class Network:
+    def __init__(self, loop, rng: random.Random, latency=(0.005, 0.05), loss: float = 0.0,
+                 dial_timeout: float = 1.0):
+        self.loop = loop
+        self.rng = rng
+        self.latency = latency
+        self.loss = loss
+        self.dial_timeout = dial_timeout
+        self.peers: Dict[Key, "SimPeer"] = {}
+        self.down = set()
+        self.groups: Dict[Key, int] = {}           # partition id per node (default 0)
+        self._link_clock: Dict[Tuple[int, int], float] = {}
+        self.msgs = Counter()                      # sender -> messages
+        self.bytes = Counter()                     # sender -> bytes
+        self.by_type = Counter()                   # message type -> count
+        self.bytes_by_type = Counter()
+        self.dropped = 0
+
+    def _delay(self) -> float:
+        lo, hi = self.latency
+        return self.rng.uniform(lo, hi)
+
+    def blocked(self, a: Key, b: Key) -> bool:
+        return a in self.down or b in self.down or self.groups.get(a, 0) != self.groups.get(b, 0)
+
+    async def connect(self, cm: SimConnectionManager, key: Key) -> SimConnection:
+        me = parse_key(cm.addr)
+        target = self.peers.get(key)
+        if target is None or self.blocked(me, key):
+            # refused (down) or unreachable (partitioned): the dial times out
+            await asyncio.sleep(self.dial_timeout)
+            raise ConnectionRefusedError(f"{key} unreachable")
+        await asyncio.sleep(2 * self._delay())  # handshake round trip
+        if self.blocked(me, key):
+            raise ConnectionRefusedError(f"{key} unreachable")
+        local = SimConnection(self, me, cm.addr, key, cm._detector())
+        remote = SimConnection(self, key, "", None, target.cm._detector())
+        local.remote, remote.remote = remote, local
+        local.detector.heartbeat(self.loop.time())
+        remote.detector.heartbeat(self.loop.time())
+        self.transmit(remote, target.cm._hello())  # acceptor's hello
+        return local
+
+    def transmit(self, conn: SimConnection, obj):
+        data = wire.encode_line(obj)
+        t = obj.get("type")
+        self.msgs[conn.owner] += 1
+        self.bytes[conn.owner] += len(data)
+        self.by_type[t] += 1
+        self.bytes_by_type[t] += len(data)
+        dst = conn.remote
+        if dst is None or dst.closed or self.blocked(conn.owner, dst.owner) \
+                or (self.loss and self.rng.random() < self.loss):
+            self.dropped += 1
+            return
+        # FIFO per link, like a TCP stream: each delivery takes the oldest message,
+        # so timers that fire at the same instant can't reorder them
+        link = (id(conn), id(dst))
+        at = max(self.loop.time() + self._delay(), self._link_clock.get(link, 0.0))
+        self._link_clock[link] = at
+        dst.in_flight.append(data)
+        self.loop.call_at(at, self._deliver, dst)
+
+    def _deliver(self, conn: SimConnection):
+        data = conn.in_flight.popleft()
+        peer = self.peers.get(conn.owner)
+        if conn.closed or peer is None or conn.owner in self.down:
+            return
+        conn.inbox.append(json.loads(data))
+        if conn.reader is None:
+            conn.reader = asyncio.ensure_future(self._read(peer, conn))
+
+    async def _read(self, peer: "SimPeer", conn: SimConnection):
+        # one message at a time, as ConnectionManager._read_loop handles them
+        try:
+            while conn.inbox and not conn.closed:
+                await peer.cm.receive(conn, conn.inbox.popleft())
+        finally:
+            conn.reader = None
+
+    def hangup(self, conn: SimConnection):
+        # the other end sees EOF one latency later (if a FIN can get through)
+        dst = conn.remote
+        self._link_clock.pop((id(conn), id(dst)), None)
+        if dst is None or dst.closed or self.blocked(conn.owner, dst.owner):
+            return
+        self.loop.call_at(self.loop.time() + self._delay(), self._eof, dst)
+
+    def _eof(self, conn: SimConnection):
+        peer = self.peers.get(conn.owner)
+        if peer is not None and not conn.closed:
+            peer.cm.drop(conn)
+
+
+# --- simulated peer ---
+
+class SimPeer(Peer):
+    def __init__(self, sim: "Simulator", host: str, port: int, bootstrap, seed: int, **kw):
+        super().__init__(host, port, bootstrap, time_source=sim.clock,
+                         cm_factory=functools.partial(SimConnectionManager, net=sim.net), **kw)
+        self.sim = sim
+        self.rng.seed(seed)
+
+    def _set_version(self, fid: str, ver: int, meta: dict = None):
+        super()._set_version(fid, ver, meta)
+        self.sim.on_version(self, fid, ver)
+
+
+class Simulator:
+    def __init__(self, nodes: int = 1000, seed: int = 1, latency=(0.005, 0.05),
+                 loss: float = 0.0, join_interval: float = 0.01, **peer_kw):
+        self.n = nodes
+        self.seed = seed
+        self.join_interval = join_interval
+        self.peer_kw = peer_kw
+        self.rng = random.Random(seed)
+        self.loop = VirtualTimeLoop()
+        self.clock = _VirtualClock(self.loop)
+        self.net = Network(self.loop, random.Random(seed + 1), latency, loss)
+        self.peers: List[SimPeer] = []
+        self.updates: Dict[Tuple[str, int], dict] = {}
+
+    # --- bookkeeping ---
+
+    def live(self) -> List[SimPeer]:
+        return [p for p in self.peers if (p.host, p.port) not in self.net.down]
+
+    def on_version(self, peer: SimPeer, fid: str, ver: int):
+        u = self.updates.get((fid, ver))
+        if u is None or u["converged_at"] is not None:
+            return
+        u["reached"] += 1
+        if u["reached"] >= u["target"]:
+            u["converged_at"] = self.loop.time()
+
+    def _recount(self):
+        # after crashes/partitions, count only nodes that are still up
+        live = self.live()
+        for (fid, ver), u in self.updates.items():
+            if u["converged_at"] is None:
+                u["target"] = len(live)
+                u["reached"] = sum(1 for p in live if p.files.get(fid, 0) >= ver)
+                if u["reached"] >= u["target"]:
+                    u["converged_at"] = self.loop.time()
+
+    # --- scenario steps ---
+
+    def add_peer(self, i: int) -> SimPeer:
+        bootstrap = set()
+        if self.peers:
+            boot = self.rng.choice(self.peers)
+            bootstrap.add((boot.host, boot.port))
+        p = SimPeer(self, "10.0.0.1", 20000 + i, bootstrap, seed=self.seed * 100003 + i,
+                    **self.peer_kw)
+        self.peers.append(p)
+        self.net.peers[(p.host, p.port)] = p
+        p._start_loops()
+        return p
+
+    async def inject(self, k: int):
+        live = self.live()
+        node = self.rng.choice(live)
+        fid = f"sim-{k}"
+        self.updates[(fid, 1)] = {"injected_at": self.loop.time(), "converged_at": None,
+                                  "reached": 0, "target": len(live)}
+        # same shape as the MQ bridge's event
+        await node._on_msg({"type": "event", "file_id": fid, "version": 1}, None)
+
+    def partition(self, frac: float):
+        keys = sorted(self.net.peers)
+        cut = set(self.rng.sample(keys, int(len(keys) * frac)))
+        self.net.groups = {k: 1 for k in cut}
+
+    def heal(self):
+        self.net.groups = {}
+
+    def crash(self, frac: float):
+        live = self.live()
+        for p in self.rng.sample(live, int(len(live) * frac)):
+            self.net.down.add((p.host, p.port))
+            for t in p._tasks + list(p._fetches.values()):
+                t.cancel()  # silent: neighbours must notice via the failure detector
+        self._recount()
+
+    async def scenario(self, warmup: float, updates: int, update_interval: float,
+                       max_time: float, partition_at=None, heal_at=None, partition_frac=0.3,
+                       crash_at=None, crash_frac=0.1):
+        for i in range(self.n):
+            self.add_peer(i)
+            await asyncio.sleep(self.join_interval)
+        await asyncio.sleep(warmup)
+
+        events = []  # (time, order, action)
+        start = self.loop.time()
+        for k in range(updates):
+            events.append((start + k * update_interval, 1, ("inject", k)))
+        if partition_at is not None:
+            events.append((start + partition_at, 0, ("partition",)))
+        if heal_at is not None:
+            events.append((start + heal_at, 0, ("heal",)))
+        if crash_at is not None:
+            events.append((start + crash_at, 0, ("crash",)))
+        heapq.heapify(events)
+        while events:
+            at, _, action = heapq.heappop(events)
+            await asyncio.sleep(max(0.0, at - self.loop.time()))
+            if action[0] == "inject":
+                await self.inject(action[1])
+            elif action[0] == "partition":
+                self.partition(partition_frac)
+            elif action[0] == "heal":
+                self.heal()
+            elif action[0] == "crash":
+                self.crash(crash_frac)
+
+        # run until every update reached every live node, or time runs out
+        deadline = start + max_time
+        while self.loop.time() < deadline:
+            if all(u["converged_at"] is not None for u in self.updates.values()):
+                break
+            await asyncio.sleep(0.1)
+            self._recount()
+
+        # stop the peers' loops and let in-flight handshakes land before the snapshot
+        for p in self.peers:
+            for t in p._tasks:
+                t.cancel()
+        await asyncio.sleep(1.0)
+
+        # stop everything still running (dials, in-flight handlers)
+        rest = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in rest:
+            t.cancel()
+        await asyncio.gather(*rest, return_exceptions=True)
+
+    def run(self, quiet: bool = True, **scenario) -> dict:
+        t0 = _walltime.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                if quiet:  # peers log every message
+                    stack.enter_context(contextlib.redirect_stdout(
+                        stack.enter_context(open(os.devnull, "w"))))
+                self.loop.run_until_complete(self.scenario(**scenario))
+        finally:
+            self.loop.close()
+        report = self.report()
+        report["wall_seconds"] = round(_walltime.perf_counter() - t0, 2)
+        return report
+
+    # --- results ---
+
+    def report(self) -> dict:
+        live = self.live()
+        conv = [u["converged_at"] - u["injected_at"] for u in self.updates.values()
+                if u["converged_at"] is not None]
+        reach = [u["reached"] / u["target"] for u in self.updates.values() if u["target"]]
+        msgs = [self.net.msgs[(p.host, p.port)] for p in self.peers]
+        byts = [self.net.bytes[(p.host, p.port)] for p in self.peers]
+        clocks = [p.clock.time for p in live]
+        active = [len(p.membership.active) for p in live]
+        return {
+            "nodes": self.n,
+            "live_nodes": len(live),
+            "seed": self.seed,
+            "virtual_seconds": round(self.loop.time(), 3),
+            "convergence": {
+                "updates": len(self.updates),
+                "converged": len(conv),
+                "p50_s": _round(_pct(conv, 50)),
+                "p99_s": _round(_pct(conv, 99)),
+                "max_s": _round(max(conv) if conv else None),
+                "reach_mean": _round(statistics.mean(reach) if reach else None, 4),
+                "reach_min": _round(min(reach) if reach else None, 4),
+            },
+            "per_node": {
+                "msgs_mean": _round(statistics.mean(msgs)),
+                "msgs_p99": _pct(msgs, 99),
+                "msgs_max": max(msgs),
+                "bytes_mean": _round(statistics.mean(byts)),
+                "bytes_p99": _pct(byts, 99),
+                "bytes_max": max(byts),
+            },
+            "by_type": {t: {"msgs": c, "bytes": self.net.bytes_by_type[t]}
+                        for t, c in sorted(self.net.by_type.items())},
+            "dropped": self.net.dropped,
+            "clock": {
+                "min": min(clocks),
+                "mean": _round(statistics.mean(clocks)),
+                "max": max(clocks),
+                "spread": max(clocks) - min(clocks),
+            },
+            "overlay": {
+                "active_mean": _round(statistics.mean(active)),
+                "active_min": min(active),
+                "active_max": max(active),
+                "components": _components(live),
+                **_link_faults(live),
+            },
+        }
+
+
+def _pct(xs, q):
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * q / 100))]
+
+
+def _round(x, nd=3):
+    return round(x, nd) if x is not None else None
+
+
+def _components(peers) -> int:
+    """Connected components of the (undirected) active-view graph."""
+    keys = {(p.host, p.port) for p in peers}
+    adj = defaultdict(set)
+    for p in peers:
+        me = (p.host, p.port)
+        for k in p.membership.active:
+            if k in keys:
+                adj[me].add(k)
+                adj[k].add(me)
+    seen, comps = set(), 0
+    for k in sorted(keys):
+        if k in seen:
+            continue
+        comps += 1
+        stack = [k]
+        seen.add(k)
+        while stack:
+            for nb in adj[stack.pop()]:
+                if nb not in seen:
+                    seen.add(nb)
+                    stack.append(nb)
+    return comps
+
+
+def _link_faults(peers) -> dict:
+    """Active entries the other end doesn't hold, or without an open connection at both ends."""
+    by_key = {(p.host, p.port): p for p in peers}
+    asymmetric = unbacked = 0
+    for p in peers:
+        me = (p.host, p.port)
+        for k in p.membership.active:
+            q = by_key.get(k)
+            if q is None or me not in q.membership.active:
+                asymmetric += 1
+            mine, theirs = p.connections.get(k), q.connections.get(me) if q else None
+            if mine is None or mine.closed or theirs is None or theirs.closed:
+                unbacked += 1
+    return {"asymmetric": asymmetric, "unbacked": unbacked}
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Deterministic P2P overlay simulator")
+    ap.add_argument("--nodes", type=int, default=1000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--latency-min", type=float, default=0.005, help="one-way latency, seconds")
+    ap.add_argument("--latency-max", type=float, default=0.05)
+    ap.add_argument("--loss", type=float, default=0.0, help="per-message loss probability")
+    ap.add_argument("--join-interval", type=float, default=0.01, help="seconds between joins")
+    ap.add_argument("--warmup", type=float, default=20.0, help="seconds before the first update")
+    ap.add_argument("--updates", type=int, default=10)
+    ap.add_argument("--update-interval", type=float, default=1.0)
+    ap.add_argument("--max-time", type=float, default=120.0, help="seconds after warmup")
+    ap.add_argument("--partition-at", type=float, default=None, help="seconds after warmup")
+    ap.add_argument("--heal-at", type=float, default=None)
+    ap.add_argument("--partition-frac", type=float, default=0.3)
+    ap.add_argument("--crash-at", type=float, default=None, help="seconds after warmup")
+    ap.add_argument("--crash-frac", type=float, default=0.1)
+    # Peer tunables, same names as p2p_peer.py
+    ap.add_argument("--fanout", type=int, default=DEFAULT_FANOUT)
+    ap.add_argument("--ttl", type=int, default=DEFAULT_TTL)
+    ap.add_argument("--gossip-interval", type=float, default=2.0)
+    ap.add_argument("--heartbeat-interval", type=float, default=1.0)
+    ap.add_argument("--phi-threshold", type=float, default=8.0)
+    ap.add_argument("--active-size", type=int, default=ACTIVE_SIZE)
+    ap.add_argument("--passive-size", type=int, default=PASSIVE_SIZE)
+    ap.add_argument("--shuffle-interval", type=float, default=5.0)
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    sim = Simulator(args.nodes, args.seed, (args.latency_min, args.latency_max), args.loss,
+                    args.join_interval, fanout=args.fanout, ttl=args.ttl,
+                    gossip_interval=args.gossip_interval,
+                    heartbeat_interval=args.heartbeat_interval,
+                    phi_threshold=args.phi_threshold, active_size=args.active_size,
+                    passive_size=args.passive_size, shuffle_interval=args.shuffle_interval)
+    report = sim.run(warmup=args.warmup, updates=args.updates,
+                     update_interval=args.update_interval, max_time=args.max_time,
+                     partition_at=args.partition_at, heal_at=args.heal_at,
+                     partition_frac=args.partition_frac, crash_at=args.crash_at,
+                     crash_frac=args.crash_frac)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
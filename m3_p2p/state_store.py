@@ -0,0 +1,172 @@
+"""
+state_store.py — local persistence for a peer: snapshot + append-only log.
+
+Layout under --data-dir:
+    snapshot.json   {"files": {...}, "peers": [...], "clock": N, "meta": {...}}   (atomic rename)
+    updates.log     one JSON line per applied update: {"f": id, "v": ver, "c": clock}
+                    plus "m": {vv, hlc, by} for multi-writer files (see logical_clock.py),
+                    and clock marks {"c": N}
+    updates.log.1   the log being folded into a snapshot, until the snapshot is on disk
+
+On restart: load the snapshot, replay the logs on top (a torn last line from a
+crash is ignored), and restore the Lamport clock to the highest value seen.
+The peer's clock moves on every message, not only on updates, so before it
+passes the last mark the peer writes a new mark CLOCK_RESERVE ahead (flushed
+at once); a restarted peer resumes from there and never reuses a timestamp.
+
+After `compact_every` log appends the state is rewritten as a new snapshot and
+the log is truncated, so restart time stays bounded. Compaction is split so
+the slow part can run off the event loop: begin_snapshot() copies the state
+and rotates the log (cheap), finish_snapshot() writes and fsyncs the snapshot
+and then drops the rotated log. Each begin_snapshot() takes a generation
+number; a finish_snapshot() that lands after a newer one (a background write
+overtaken by the final snapshot at shutdown) is skipped, and only the newest
+snapshot drops the rotated log, which holds every record since the oldest.
+
+Log appends are buffered and flushed by the peer on a short timer (and on
+compaction/close), not fsync'd per update. A crash can lose the last few
+hundred ms of updates; anti-entropy fetches them back from neighbours.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+CLOCK_RESERVE = 10000  # Lamport ticks covered by one persisted clock mark
+
+
+class StateStore:
+    def __init__(self, data_dir: str, compact_every: int = 10000):
+        self.data_dir = data_dir
+        self.compact_every = compact_every
+        self.snapshot_path = os.path.join(data_dir, "snapshot.json")
+        self.log_path = os.path.join(data_dir, "updates.log")
+        self.rotated_path = self.log_path + ".1"
+        os.makedirs(data_dir, exist_ok=True)
+        self._log = None
+        self.log_entries = 0
+        self.clock_mark = 0   # no Lamport time above this has been handed out
+        self._snap_lock = threading.Lock()  # one snapshot (and rotation) at a time
+        self._snap_gen = 0       # generation of the last begin_snapshot()
+        self._written_gen = 0    # generation of the snapshot on disk
+
+    def load(self) -> Tuple[Dict[str, int], list, int, Dict[str, dict]]:
+        """Return (files, peers, clock, meta) from snapshot + log replay."""
+        t0 = time.perf_counter()
+        files: Dict[str, int] = {}
+        meta: Dict[str, dict] = {}
+        peers = []
+        clock = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            files = {k: int(v) for k, v in snap.get("files", {}).items()}
+            peers = snap.get("peers", [])
+            clock = int(snap.get("clock", 0))
+            meta = snap.get("meta", {})
+
+        replayed = 0
+        # a rotated log is only left behind if its snapshot never made it to disk
+        for path in (self.rotated_path, self.log_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn tail from a crash
+                    clock = max(clock, int(rec.get("c", 0)))
+                    replayed += 1
+                    if "f" not in rec:
+                        continue  # clock mark
+                    # records are in apply order: the last one for a file is its state
+                    files[rec["f"]] = rec["v"]
+                    if "m" in rec:
+                        meta[rec["f"]] = rec["m"]
+                    else:
+                        meta.pop(rec["f"], None)
+        self.log_entries = replayed
+        self.clock_mark = clock
+        ms = (time.perf_counter() - t0) * 1000
+        print(f"[Store] loaded {len(files)} files, {len(peers)} peers, clock={clock} "
+              f"({replayed} log entries) in {ms:.1f} ms")
+        return files, peers, clock, meta
+
+    def _write(self, rec: dict):
+        if self._log is None:
+            self._log = open(self.log_path, "a", encoding="utf-8")
+        self._log.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        self.log_entries += 1
+
+    def append(self, file_id: str, version: int, clock: int, meta: dict = None):
+        rec = {"f": file_id, "v": version, "c": clock}
+        if meta is not None:
+            rec["m"] = meta
+        self._write(rec)
+
+    def reserve_clock(self, clock: int):
+        """Persist a mark CLOCK_RESERVE above clock; call before the clock passes clock_mark."""
+        self.clock_mark = clock + CLOCK_RESERVE
+        self._write({"c": self.clock_mark})
+        self._log.flush()
+
+    def flush(self):
+        if self._log is not None:
+            self._log.flush()
+
+    def needs_compaction(self) -> bool:
+        return self.log_entries >= self.compact_every
+
+    def snapshot(self, files: Dict[str, int], peers: Iterable[str], clock: int,
+                 meta: Dict[str, dict] = None):
+        """Write a full snapshot atomically, then truncate the log."""
+        self.finish_snapshot(self.begin_snapshot(files, peers, clock, meta))
+
+    def begin_snapshot(self, files: Dict[str, int], peers: Iterable[str], clock: int,
+                       meta: Dict[str, dict] = None) -> dict:
+        """Copy the state and move the log aside; returns what finish_snapshot() writes."""
+        # the peer replaces entries rather than mutating them, so flat copies do
+        state = {"files": dict(files), "peers": list(peers),
+                 "clock": max(clock, self.clock_mark), "meta": dict(meta or {})}
+        with self._snap_lock:
+            self._snap_gen += 1
+            state["gen"] = self._snap_gen
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if os.path.exists(self.log_path):
+                if os.path.exists(self.rotated_path):
+                    # the last snapshot failed: its records still have to be kept
+                    with open(self.log_path, "rb") as src, open(self.rotated_path, "ab") as dst:
+                        dst.write(src.read())
+                    os.remove(self.log_path)
+                else:
+                    os.replace(self.log_path, self.rotated_path)
+        self.log_entries = 0
+        return state
+
+    def finish_snapshot(self, state: dict):
+        """Write the snapshot and fsync it (blocking), then drop the rotated log."""
+        gen = state.get("gen", 0)
+        with self._snap_lock:
+            if gen <= self._written_gen:
+                return   # a newer snapshot is already on disk
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({k: v for k, v in state.items() if k != "gen"}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            self._written_gen = gen
+            # records rotated for a newer snapshot stay until that one is written
+            if gen == self._snap_gen and os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+
+    def close(self):
+        if self._log is not None:
+            self._log.flush()
+            self._log.close()
+            self._log = None
@@ -0,0 +1,104 @@
+"""
+wire.py — versioned binary framing for the P2P protocol.
+
+Frame layout (all big-endian):
+    magic   1 byte   0xB1  (can never start a JSON line, which starts with '{')
+    flags   1 byte   bit0: payload codec is msgpack (else compact JSON)
+                     bit1: payload is zlib-compressed
+    length  4 bytes  payload length
+    payload          encoded *list* of messages (a frame carries a batch)
+
+Negotiation: every hello (still a JSON line) advertises
+    "wire": {"frames": 1, "codecs": ["msgpack", "json"]}
+Once both sides have seen each other's hello, a connection switches to frames
+using the first codec in our list that the remote also supports. Peers that
+never advertise "wire" keep getting newline-delimited JSON, and readers accept
+both formats on the same stream, so old and new peers interoperate.
+"""
+
+import json
+import struct
+import zlib
+
+try:
+    import msgpack  # optional: smaller + faster than JSON
+except ImportError:  # pragma: no cover - depends on environment
+    msgpack = None
+
+MAGIC = 0xB1
+FRAME_VERSION = 1
+FLAG_MSGPACK = 0x01
+FLAG_ZLIB = 0x02
+HEADER = struct.Struct(">BBI")
+MAX_FRAME = 16 * 1024 * 1024
+COMPRESS_MIN = 4096  # only compress payloads at least this large
+
+CODECS = ["msgpack", "json"] if msgpack is not None else ["json"]
+
+
+def advertise() -> dict:
+    return {"frames": FRAME_VERSION, "codecs": list(CODECS)}
+
+
+def negotiate(remote) -> str:
+    """Pick a frame codec given the remote's hello 'wire' field, or None for JSON lines."""
+    if not isinstance(remote, dict) or int(remote.get("frames", 0)) < FRAME_VERSION:
+        return None
+    theirs = remote.get("codecs", [])
+    for c in CODECS:
+        if c in theirs:
+            return c
+    return None
+
+
+def encode_line(obj) -> bytes:
+    return (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+
+
+def encode_frame(messages, codec: str, compress_min: int = COMPRESS_MIN) -> bytes:
+    flags = 0
+    if codec == "msgpack":
+        payload = msgpack.packb(messages, use_bin_type=True)
+        flags |= FLAG_MSGPACK
+    else:
+        payload = json.dumps(messages, separators=(",", ":")).encode()
+    if compress_min and len(payload) >= compress_min:
+        packed = zlib.compress(payload, 1)
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, flags, len(payload)) + payload
+
+
+def decode_payload(flags: int, payload: bytes):
+    if flags & FLAG_ZLIB:
+        # bounded: a small frame must not inflate into gigabytes
+        d = zlib.decompressobj()
+        payload = d.decompress(payload, MAX_FRAME)
+        if d.unconsumed_tail or not d.eof:
+            raise ValueError(f"compressed frame inflates past {MAX_FRAME} bytes or is truncated")
+    if flags & FLAG_MSGPACK:
+        if msgpack is None:
+            raise ValueError("received msgpack frame but msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+async def read_messages(reader):
+    """
+    Read the next unit from a stream: either one JSON line or one binary
+    frame. Returns a list of messages ([] is never returned), or None on EOF.
+    """
+    first = await reader.read(1)
+    if not first:
+        return None
+    if first[0] == MAGIC:
+        rest = await reader.readexactly(HEADER.size - 1)
+        _, flags, length = HEADER.unpack(first + rest)
+        if length > MAX_FRAME:
+            raise ValueError(f"frame too large: {length}")
+        payload = await reader.readexactly(length)
+        msgs = decode_payload(flags, payload)
+        return msgs if isinstance(msgs, list) else [msgs]
+    line = first + await reader.readline()
+    return [json.loads(line.decode().strip())]
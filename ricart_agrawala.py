@@ -2,97 +2,115 @@
    Running each node on sepearte terminal
    python ricart_agrawala.py --id 1 --port 6001 --peers 127.0.0.1:6002,127.0.0.1:6003
    python ricart_agrawala.py --id 2 --port 6002 --peers 127.0.0.1:6001,127.0.0.1:6003
-   python ricart_agrawala.py --id 3 --port 6003 --peers 127.0.0.1:6001,127.0.0.1:6002"""
+   python ricart_agrawala.py --id 3 --port 6003 --peers 127.0.0.1:6001,127.0.0.1:6002
+
+   Each resource (e.g. a file id) is locked independently; pass
+   --resources a.txt,b.txt to have the nodes contend for several.
+   --algo maekawa|token|lease runs one of the other algorithms in
+   dist_mutex.py instead (every node must use the same one)."""
 
 
 import asyncio
-import json
 import argparse
-import random
-import time
 
-class RANode:
-    def __init__(self, node_id, host, port, peers):
-        self.node_id = node_id
-        self.host = host
-        self.port = port
-        self.addr = f"{host}:{port}"
-        self.peers = peers  
+from dist_mutex import (MutexNode, MaekawaNode, SuzukiKasamiNode, LeaseNode, DEFAULT_RESOURCE,
+                        addr_of, key_of)
+
 
-        #lamport clock stuff
-        self.clock = 0
+class ResourceState:
+    """Ricart-Agrawala state for one resource (file id)."""
 
-        #state
+    def __init__(self):
         self.state = "RELEASED"  # RELEASED, WANTED, HELD
         self.request_ts = None
-
         self.pending_replies = set()
-        self.deferred_replies = set()
-
+        self.replied = set()        # peers whose REPLY counted for this request
+        self.deferred_replies = {}  # (h, p) -> (ts, attempt) of the request we owe a REPLY
         # event for when all replies come in
         self.got_all_replies = asyncio.Event()
-
-    # Clock Helpers
-
-    def bump_clock(self):
-        self.clock += 1
-        return self.clock
-
-    def adjust_clock(self, ts):
-        # lamport rule
-        self.clock = max(self.clock, ts) + 1
-
-    # Network Stuff
-
-    async def send_msg(self, h, p, msg):
-        try:
-            reader, writer = await asyncio.open_connection(h, p)
-            writer.write((json.dumps(msg) + "\n").encode())
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-        except:
-            print(f"[{self.node_id}] couldn't send to {h}:{p}")
-
-    async def send_to_all(self, msg):
-        tasks = []
-        for (h, p) in self.peers:
-            tasks.append(self.send_msg(h, p, msg))
-        await asyncio.gather(*tasks)
-
-    # this handles incoming connections from other nodes
-    async def handle_conn(self, reader, writer):
-        try:
-            data = await reader.readline()
-            if not data:
-                return
-            msg = json.loads(data.decode().strip())
-            await self.on_message(msg)
-        except Exception as e:
-            print(f"[{self.node_id}] error reading msg:", e)
-        finally:
-            writer.close()
-            await writer.wait_closed()
-
-    async def start_server(self):
-        server = await asyncio.start_server(self.handle_conn, self.host, self.port)
-        print(f"[{self.node_id}] listens on {self.host}:{self.port}")
-        async with server:
-            await server.serve_forever()
-
-    # Ricart-Agrawala Algorithm
+        # local requests for this resource wait their turn here
+        self.queue = asyncio.Lock()
+        # timeouts / leases (only used when enabled on the node)
+        self.started = 0.0
+        self.sent_at = []           # send time of each transmission of the request
+        self.lease_from = None      # earliest send time behind a counted REPLY
+        self.lease_until = None
+
+
+class RANode(MutexNode):
+    """
+    Ricart-Agrawala, per resource. Everything below is off by default, in
+    which case a request waits for every peer forever (safe, not live):
+
+    acquire_timeout  acquire() gives up and raises asyncio.TimeoutError;
+                     acquire(rid, timeout) overrides it for one call
+    retransmit       resend the REQUEST to peers that haven't answered; a
+                     peer that defers answers a resend with DEFERRED
+    fd_timeout       a peer silent for this long is suspected and no longer
+                     waited for (it is still sent REQUESTs, and any message
+                     from it clears the suspicion). Only a node that got
+                     REPLYs from a majority (itself included) skips silent
+                     peers, so the two sides of a clean partition can't both
+                     enter; the minority side waits (or times out).
+                     This trades safety for liveness all the same: a silent
+                     peer may just be cut off from us, and under a partial
+                     partition (A reaches B and C, B and C can't reach each
+                     other) B and C can each skip the other and both hold the
+                     lock. Leave it off where that is not acceptable.
+    lease_ttl        a hold lasts at most this long from the REQUEST that
+                     earned the replies; request_cs() cuts the CS short then.
+                     A peer we replied to is only excluded once that grant's
+                     lease is over, so excluding a live holder can't break
+                     mutual exclusion.
+    """
+
+    handlers = {"REQUEST": "handle_request", "REPLY": "handle_reply",
+                "DEFERRED": "handle_deferred"}
+
+    def __init__(self, node_id, host, port, peers, acquire_timeout=None,
+                 retransmit=None, fd_timeout=None, lease_ttl=None):
+        super().__init__(node_id, host, port, peers)
+
+        # per-resource RA state, created on first use
+        self.resources = {}
+
+        self.acquire_timeout = acquire_timeout
+        self.retransmit = retransmit
+        self.fd_timeout = fd_timeout
+        self.lease_ttl = lease_ttl
+        self.last_heard = {}    # (h, p) -> loop time of the last message
+        self.granted_at = {}    # (h, p) -> loop time of our last REPLY to it
+        self.suspected = set()
+
+    # the default resource keeps the original single-lock view of the node
+    @property
+    def state(self):
+        return self.resource(DEFAULT_RESOURCE).state
+
+    @property
+    def request_ts(self):
+        return self.resource(DEFAULT_RESOURCE).request_ts
+
+    def resource(self, rid):
+        r = self.resources.get(rid)
+        if r is None:
+            r = self.resources[rid] = ResourceState()
+        return r
+
+    def now(self):
+        return asyncio.get_running_loop().time()
 
     async def on_message(self, msg):
-        mtype = msg.get("type")
-        ts = msg.get("ts", 0)
+        addr = msg.get("addr")
+        if addr:
+            key = key_of(addr)
+            self.last_heard[key] = self.now()
+            if key in self.suspected:
+                self.suspected.discard(key)
+                self.log(f"{addr} is back")
+        await super().on_message(msg)
 
-        #clock synced
-        self.adjust_clock(ts)
-
-        if mtype == "REQUEST":
-            await self.handle_request(msg)
-        elif mtype == "REPLY":
-            await self.handle_reply(msg)
+    # Ricart-Agrawala Algorithm
 
     async def handle_request(self, msg):
         other_id = msg["from"]
@@ -100,17 +118,20 @@ class RANode:
         h, p = other_addr.split(":")
         p = int(p)
         other_ts = msg["ts"]
+        attempt = msg.get("n", 0)
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        r = self.resource(rid)
 
-        my_pri = (self.request_ts, self.node_id) if self.request_ts else (None, self.node_id)
+        my_pri = (r.request_ts, self.node_id) if r.request_ts else (None, self.node_id)
         other_pri = (other_ts, other_id)
 
         send_now = False
 
-        if self.state == "RELEASED":
+        if r.state == "RELEASED":
             send_now = True
-        elif self.state == "HELD":
+        elif r.state == "HELD":
             send_now = False
-        elif self.state == "WANTED":
+        elif r.state == "WANTED":
             # RA rule
             if my_pri[0] is None:
                 send_now = True
@@ -118,91 +139,217 @@ class RANode:
                 send_now = other_pri < my_pri
 
         if send_now:
-            reply = {
-                "type": "REPLY",
-                "from": self.node_id,
-                "addr": self.addr,
-                "ts": self.bump_clock()
-            }
-            print(f"[{self.node_id}] sending REPLY to {other_addr}")
-            await self.send_msg(h, p, reply)
+            self.log(f"sending REPLY to {other_addr} for {rid}")
+            self.granted_at[(h, p)] = self.now()
+            await self.send_msg(h, p, self.reply_msg(rid, self.bump_clock(), other_ts, attempt))
         else:
-            print(f"[{self.node_id}] deferring REPLY to {other_addr}")
-            self.deferred_replies.add((h, p))
+            self.log(f"deferring REPLY to {other_addr} for {rid}")
+            r.deferred_replies[(h, p)] = (other_ts, attempt)
+            self.on_deferred(rid)
+            if attempt:
+                # a resend: tell the requester we're alive and it has to wait
+                await self.send_msg(h, p, self.stamp("DEFERRED", rid, req=other_ts))
+
+    def reply_msg(self, rid, ts, req_ts, attempt=0):
+        # "req" names the request being answered, so a REPLY that arrives late
+        # (e.g. resent after a reconnect) can't count towards a newer request
+        msg = {
+            "type": "REPLY",
+            "from": self.node_id,
+            "addr": self.addr,
+            "ts": ts,
+            "req": req_ts
+        }
+        if attempt:
+            msg["n"] = attempt
+        if rid != DEFAULT_RESOURCE:
+            msg["res"] = rid
+        return msg
 
     async def handle_reply(self, msg):
         addr = msg["addr"]
         h, p = addr.split(":")
         p = int(p)
         key = (h, p)
+        rid = msg.get("res", DEFAULT_RESOURCE)
+        r = self.resource(rid)
+
+        if "req" in msg and msg["req"] != r.request_ts:
+            self.log(f"stale REPLY from {addr} for {rid}")
+            return
+
+        if key in r.pending_replies:
+            r.pending_replies.remove(key)
+            r.replied.add(key)
+            self.log(f"REPLY from {addr} for {rid}")
+            if r.sent_at:
+                sent = r.sent_at[min(msg.get("n", 0), len(r.sent_at) - 1)]
+                r.lease_from = sent if r.lease_from is None else min(r.lease_from, sent)
+            # this REPLY may make the majority that lets us skip suspected peers
+            self._exclude_silent(r, self.now())
 
-        if key in self.pending_replies:
-            self.pending_replies.remove(key)
-            print(f"[{self.node_id}] REPLY from {addr}")
+        if len(r.pending_replies) == 0:
+            r.got_all_replies.set()
 
-        if len(self.pending_replies) == 0:
-            self.got_all_replies.set()
+    def on_deferred(self, rid):
+        """Hook: a peer is now waiting for us on rid."""
+
+    async def handle_deferred(self, msg):
+        pass  # liveness only; on_message already noted it
 
     # Critical Section
 
-    async def request_cs(self):
-        self.state = "WANTED"
-        self.request_ts = self.bump_clock()
-        self.pending_replies = set(self.peers)
-        self.deferred_replies = set()
-        self.got_all_replies.clear()
+    def _timed(self):
+        return any(x is not None for x in (self.acquire_timeout, self.retransmit,
+                                           self.fd_timeout, self.lease_ttl))
 
+    async def _send_request(self, rid, r, keys):
         req = {
             "type": "REQUEST",
             "from": self.node_id,
             "addr": self.addr,
-            "ts": self.request_ts
+            "ts": r.request_ts
         }
-
-        print(f"[{self.node_id}] REQUEST...")
-        await self.send_to_all(req)
+        if rid != DEFAULT_RESOURCE:
+            req["res"] = rid
+        if r.sent_at:
+            req["n"] = len(r.sent_at)
+        if self._timed():
+            r.sent_at.append(self.now())
+        await asyncio.gather(*(self.send_msg(h, p, dict(req)) for (h, p) in keys))
+
+    def _silent(self, key, r, now):
+        # suspected peers are judged on their last message, others only
+        # from the start of this request
+        since = self.last_heard.get(key, 0.0)
+        if key not in self.suspected:
+            since = max(since, r.started)
+        if now - since < self.fd_timeout:
+            return False
+        # a peer that may still be inside the CS on our grant is waited for
+        if self.lease_ttl is not None and now - self.granted_at.get(key, -1e18) < self.lease_ttl:
+            return False
+        return True
+
+    def _exclude_silent(self, r, now):
+        if self.fd_timeout is None or r.state != "WANTED":
+            return
+        # only a majority goes ahead without the rest: two sides of a
+        # partition can't both have one
+        if 2 * (1 + len(r.replied)) <= len(self.peers) + 1:
+            return
+        for key in [k for k in r.pending_replies if self._silent(k, r, now)]:
+            if key not in self.suspected:
+                self.log(f"suspect {addr_of(key)}, not waiting for it")
+            self.suspected.add(key)
+            r.pending_replies.discard(key)
+
+    async def _wait_replies(self, rid, r, deadline, timeout):
+        self._exclude_silent(r, self.now())   # already-suspected peers, given a majority
+        tick = min(x for x in (self.retransmit, self.fd_timeout and self.fd_timeout / 4,
+                               self.lease_ttl and self.lease_ttl / 4, 0.1 if deadline else None)
+                   if x is not None)
+        while r.pending_replies:
+            try:
+                await asyncio.wait_for(r.got_all_replies.wait(), tick)
+                return
+            except asyncio.TimeoutError:
+                pass
+            now = self.now()
+            if deadline is not None and now >= deadline:
+                raise asyncio.TimeoutError(f"no lock on {rid} within {timeout}s")
+            self._exclude_silent(r, now)
+            if self.retransmit is not None and r.pending_replies \
+                    and now - r.sent_at[-1] >= self.retransmit:
+                await self._send_request(rid, r, r.pending_replies)
+
+    async def acquire(self, rid=DEFAULT_RESOURCE, timeout=None):
+        r = self.resource(rid)
+        timeout = self.acquire_timeout if timeout is None else timeout
+        if timeout is None and not self._timed():
+            return await self._acquire(rid, r)
+        deadline = None if timeout is None else self.now() + timeout
+        try:
+            if deadline is None:
+                await r.queue.acquire()
+            else:
+                await asyncio.wait_for(r.queue.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"no lock on {rid} within {timeout}s")
+        try:
+            r.state = "WANTED"
+            r.request_ts = self.bump_clock()
+            r.started = self.now()
+            r.sent_at, r.lease_from = [], None
+            while True:
+                r.pending_replies = set(self.peers)
+                r.replied = set()
+                r.got_all_replies.clear()
+                self.log(f"REQUEST {rid}...")
+                await self._send_request(rid, r, self.peers)
+                await self._wait_replies(rid, r, deadline, timeout)
+                if self.lease_ttl is None:
+                    break
+                lease_from = r.lease_from if r.lease_from is not None else r.sent_at[0]
+                r.lease_until = lease_from + self.lease_ttl
+                # waited so long the replies are nearly used up: ask again
+                if r.lease_until - self.now() >= self.lease_ttl / 2:
+                    break
+                r.lease_from = None
+        except BaseException:
+            # gave up: answer whoever we made wait, let the next local request in
+            await self.release(rid)
+            raise
+        r.state = "HELD"
+
+    async def _acquire(self, rid, r):
+        # local requests for the same resource take turns; other resources
+        # run their own instance of the algorithm side by side
+        await r.queue.acquire()
+        r.state = "WANTED"
+        r.request_ts = self.bump_clock()
+        r.pending_replies = set(self.peers)
+        r.got_all_replies.clear()
+
+        self.log(f"REQUEST {rid}...")
+        await self._send_request(rid, r, self.peers)
 
         # wait til all replies are here
-        await self.got_all_replies.wait()
-
-        self.state = "HELD"
-        await self.critical_section()
-
-        # done
-        self.state = "RELEASED"
-        self.request_ts = None
-
-        # send deferred replies
-        for (h, p) in list(self.deferred_replies):
-            reply = {
-                "type": "REPLY",
-                "from": self.node_id,
-                "addr": self.addr,
-                "ts": self.bump_clock()
-            }
-            print(f"[{self.node_id}] sending deferred REPLY to {h}:{p}")
-            await self.send_msg(h, p, reply)
-            self.deferred_replies.remove((h, p))
-
-    async def critical_section(self):
-        print(f"\n[{self.node_id}] entered crit section\n")
-        await asyncio.sleep(1.2)  # fake work
-        print(f"\n[{self.node_id}]  exited crit section\n")
-
-    # Main
-
-    async def run(self, attempts=3):
-        asyncio.create_task(self.start_server())
-        await asyncio.sleep(3)  # wait for all servers to start
-
-        for i in range(attempts):
-            await asyncio.sleep(random.uniform(0.5, 2))
-            print(f"[{self.node_id}] trying to enter CS (attempt {i+1})")
-            await self.request_cs()
-
-        print(f"[{self.node_id}] finished all attempts. Exiting.")
-        while True:
-            await asyncio.sleep(9999)
+        if r.pending_replies:
+            await r.got_all_replies.wait()
+        r.state = "HELD"
+
+    def lease_remaining(self, rid=DEFAULT_RESOURCE):
+        r = self.resource(rid)
+        if self.lease_ttl is None or r.lease_until is None:
+            return None
+        return r.lease_until - self.now()
+
+    async def release(self, rid=DEFAULT_RESOURCE):
+        r = self.resource(rid)
+        r.state = "RELEASED"
+        r.request_ts = None
+        r.lease_until = None
+        await self.flush_deferred(rid)
+        r.queue.release()
+
+    async def flush_deferred(self, rid):
+        # all deferred replies go out together, stamped with one clock tick
+        r = self.resource(rid)
+        if not r.deferred_replies:
+            return
+        batch, r.deferred_replies = r.deferred_replies, {}
+        ts = self.bump_clock()
+        self.log(f"sending {len(batch)} deferred REPLY(s) for {rid}")
+        now = self.now()
+        for key in batch:
+            self.granted_at[key] = now
+        await asyncio.gather(*(self.send_msg(h, p, self.reply_msg(rid, ts, req_ts, attempt))
+                               for (h, p), (req_ts, attempt) in batch.items()))
+
+
+ALGORITHMS = {"ra": RANode, "maekawa": MaekawaNode,
+              "token": SuzukiKasamiNode, "lease": LeaseNode}
 
 
 def parse_args():
@@ -211,6 +358,13 @@ def parse_args():
     ap.add_argument("--host", default="127.0.0.1")
     ap.add_argument("--port", type=int, required=True)
     ap.add_argument("--peers", default="")
+    ap.add_argument("--algo", choices=sorted(ALGORITHMS), default="ra")
+    ap.add_argument("--resources", default="", help="comma-separated resource ids (file ids) to lock")
+    ap.add_argument("--acquire-timeout", type=float, help="ra: give up on a lock after this many seconds")
+    ap.add_argument("--retransmit", type=float, help="ra: resend unanswered REQUESTs this often")
+    ap.add_argument("--fd-timeout", type=float, help="ra: stop waiting for peers silent this long, once a majority "
+                    "replied (trades safety for liveness, see RANode)")
+    ap.add_argument("--lease-ttl", type=float, help="ra: max seconds a lock is held")
     return ap.parse_args()
 
 
@@ -222,8 +376,13 @@ async def main():
             h, prt = p.split(":")
             peer_list.append((h, int(prt)))
 
-    node = RANode(args.id, args.host, args.port, peer_list)
-    await node.run(attempts=3)
+    resources = [r for r in args.resources.split(",") if r] or [DEFAULT_RESOURCE]
+    kw = {}
+    if args.algo == "ra":
+        kw = dict(acquire_timeout=args.acquire_timeout, retransmit=args.retransmit,
+                  fd_timeout=args.fd_timeout, lease_ttl=args.lease_ttl)
+    node = ALGORITHMS[args.algo](args.id, args.host, args.port, peer_list, **kw)
+    await node.run(attempts=3, resources=resources)
 
 
 if __name__ == "__main__":
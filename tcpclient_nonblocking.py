@@ -1,37 +1,188 @@
-import argparse, socket, struct, hashlib, pathlib, time
-CHUNK = 64 * 1024
+import argparse, concurrent.futures, hashlib, pathlib, queue, socket, struct, threading
+from transfer_protocol import (CHUNK, TID_SIZE, OP_COMMIT, ST_OK, ST_MISSING, new_hasher,
+                               new_chunk_hasher, n_chunks, v2_header, v3_open, v3_range,
+                               v3_request, unpack_ranges, missing_ranges)
+
+RETRIES = 3
+
+def hash_file(path, out):
+    # runs next to sendfile(): hashlib drops the GIL on large updates, and the
+    # reads mostly hit the page cache the send is pulling through anyway
+    h = new_hasher()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK * 4), b""):
+            h.update(block)
+    out.append(h.digest())
+
+def send_file(host, port, path, timeout=60.0):
+    """Stream one file with the TXF2 protocol; returns the server's status."""
+    path = pathlib.Path(path)
+    size = path.stat().st_size
+    digest = []
+    hasher = threading.Thread(target=hash_file, args=(path, digest), daemon=True)
+    hasher.start()
+    with socket.create_connection((host, port), timeout=timeout) as s, open(path, "rb") as f:
+        s.sendall(v2_header(path.name, size))
+        # zero-copy from the page cache to the socket (plain send() where unsupported)
+        sent = s.sendfile(f)
+        if sent != size:
+            raise IOError(f"{path} changed while sending ({sent} of {size} bytes)")
+        hasher.join()
+        s.sendall(digest[0])
+        # blocking read of the status: the server replies and closes
+        return b"".join(iter(lambda: s.recv(16), b"")).decode()
+
+def recv_exact(s, n):
+    buf = bytearray()
+    while len(buf) < n:
+        data = s.recv(n - len(buf))
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buf.extend(data)
+    return bytes(buf)
+
+def read_reply(s):
+    """One TXF3 reply: (status, payload)."""
+    status, n = struct.unpack(">BI", recv_exact(s, 5))
+    return status, recv_exact(s, n)
+
+def request(s, data):
+    s.sendall(data)
+    return read_reply(s)
+
+def transfer_id(path):
+    # stable across client restarts while the file is unchanged, so a rerun resumes
+    st = path.stat()
+    key = f"{path.resolve()}|{st.st_size}|{st.st_mtime_ns}".encode()
+    return hashlib.blake2b(key, digest_size=TID_SIZE).digest()
+
+def hash_chunks(path, first, count, chunk_size):
+    """Digests of `count` chunks starting at chunk `first`, concatenated."""
+    out = bytearray()
+    with open(path, "rb") as f:
+        f.seek(first * chunk_size)
+        for _ in range(count):
+            h, left = new_chunk_hasher(), chunk_size
+            while left:
+                block = f.read(min(CHUNK * 16, left))
+                if not block: break
+                h.update(block); left -= len(block)
+            out += h.digest()
+    return bytes(out)
+
+def build_manifest(path, size, chunk_size, workers=4):
+    # one stripe of chunks per thread: hashlib drops the GIL on large updates,
+    # so the chunk digests are computed in parallel, unlike one whole-file MD5
+    total = n_chunks(size, chunk_size)
+    per = -(-total // max(1, workers)) or 1
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+        parts = pool.map(lambda first: hash_chunks(path, first, min(per, total - first), chunk_size),
+                         range(0, total, per))
+        return b"".join(parts)
+
+def send_ranges(host, port, path, tid, blocks, timeout, sent):
+    """One stream: takes blocks off the shared queue until it is empty."""
+    with socket.create_connection((host, port), timeout=timeout) as s, open(path, "rb") as f:
+        while True:
+            try:
+                offset, length, attempt = blocks.get_nowait()
+            except queue.Empty:
+                return
+            s.sendall(v3_range(tid, offset, length))
+            if s.sendfile(f, offset, length) != length:
+                raise IOError(f"{path} changed while sending")
+            status, payload = read_reply(s)
+            sent.append(length)
+            if status == ST_OK:
+                continue
+            if attempt + 1 >= RETRIES:
+                raise IOError(f"range {offset}+{length} failed verification {RETRIES} times")
+            # the server kept the good chunks: queue only the ones that failed
+            for start, end in unpack_ranges(payload):
+                blocks.put((start, end - start, attempt + 1))
+
+def send_blocks(host, port, path, tid, blocks, streams, timeout, sent):
+    errors = []
+
+    def worker():
+        try:
+            send_ranges(host, port, path, tid, blocks, timeout, sent)
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(min(streams, blocks.qsize()))]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    if errors:
+        raise errors[0]
+
+def control(host, port, data, timeout):
+    # OPEN and COMMIT each get a fresh connection: one held open through the
+    # data phase would sit idle and be dropped by the server's idle deadline
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        return request(s, data)
+
+def send_file_parallel(host, port, path, streams=4, block=8 * 1024 * 1024, timeout=60.0,
+                       chunk_size=1024 * 1024, root=False):
+    """
+    Send one file with the resumable TXF3 protocol. The client hashes the
+    file into a manifest of `chunk_size` chunks (plus a root hash if `root`),
+    and the server checks every chunk as it arrives. The ranges the server is
+    missing are cut into `block`-sized pieces and spread over `streams`
+    connections; chunks it already holds (from an interrupted run) are
+    skipped, and chunks that fail are the only ones sent again.
+    Returns {"status", "sent", "skipped"}.
+    """
+    path = pathlib.Path(path)
+    size = path.stat().st_size
+    tid = transfer_id(path)
+    block = max(chunk_size, block - block % chunk_size)   # ranges are whole chunks
+    digests = build_manifest(path, size, chunk_size, streams)
+    status, payload = control(host, port, v3_open(tid, path.name, size, chunk_size, digests, root),
+                              timeout)
+    if status != ST_OK:
+        return {"status": "BAD", "sent": 0, "skipped": 0}
+    todo = missing_ranges(unpack_ranges(payload), size)
+    skipped = size - sum(end - start for start, end in todo)
+    sent = []
+    for _ in range(RETRIES):
+        blocks = queue.Queue()
+        for start, end in todo:
+            for offset in range(start, end, block):
+                blocks.put((offset, min(block, end - offset), 0))
+        send_blocks(host, port, path, tid, blocks, streams, timeout, sent)
+        # the server only confirms once every chunk is verified (and, with a
+        # root, re-read from disk); anything it lost is listed and resent
+        status, payload = control(host, port, v3_request(OP_COMMIT, tid), timeout)
+        if status != ST_MISSING:
+            break
+        todo = unpack_ranges(payload)
+    result = {ST_OK: "OK", ST_MISSING: "MISSING"}.get(status, "BAD")
+    return {"status": result, "sent": sum(sent), "skipped": skipped}
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default="127.0.0.1")
     ap.add_argument("--port", type=int, default=5001)
     ap.add_argument("--file", required=True)
+    ap.add_argument("--timeout", type=float, default=60.0, help="socket timeout in seconds")
+    ap.add_argument("--streams", type=int, default=1, help="parallel connections (TXF3 when > 1)")
+    ap.add_argument("--block-mb", type=float, default=8.0, help="range size per request with --streams")
+    ap.add_argument("--resumable", action="store_true", help="use TXF3 even with one stream")
+    ap.add_argument("--chunk-kb", type=int, default=1024, help="TXF3 chunk size (one digest each)")
+    ap.add_argument("--root-hash", action="store_true",
+                    help="TXF3: send a whole-file root hash; the server re-reads the file to check it")
     args = ap.parse_args()
 
-    path = pathlib.Path(args.file)
-    data = path.read_bytes()
-    md5 = hashlib.md5(data).digest()
-
-    with socket.create_connection((args.host, args.port)) as s:
-        name_bytes = path.name.encode()
-        header = struct.pack(">I", len(name_bytes)) + name_bytes + struct.pack(">Q", len(data)) + md5
-        s.sendall(header)
-        s.sendall(data)
-
-        # Set the socket to non-blocking before receiving
-        s.setblocking(False)
-
-        # Loop until the response is received
-        status = None
-        while not status:
-            try:
-                status = s.recv(3).decode()
-            except BlockingIOError:
-                # No data yet, wait a moment and try again
-                print("[TCP CLIENT] Waiting for server response...")
-                # added a sleep period to not consume 100% of CPU
-                time.sleep(0.1) 
-                continue
-        print(f"[TCP CLIENT] Transfer status: {status}")
+    if args.streams > 1 or args.resumable:
+        r = send_file_parallel(args.host, args.port, args.file, args.streams,
+                               int(args.block_mb * 1024 * 1024), args.timeout,
+                               args.chunk_kb * 1024, args.root_hash)
+        print(f"[TCP CLIENT] Transfer status: {r['status']} "
+              f"({r['sent']} bytes sent, {r['skipped']} already on the server)")
+        return
+    status = send_file(args.host, args.port, args.file, args.timeout)
+    print(f"[TCP CLIENT] Transfer status: {status}")
 
 if __name__ == "__main__":
     main()
@@ -1,53 +1,548 @@
-import argparse, os, socket, struct, hashlib, pathlib, time
-CHUNK = 64 * 1024
-def recv_exact(conn, n):
-    data = bytearray()
-    while len(data) < n:
-        chunk = conn.recv(n - len(data))
-        if not chunk: raise ConnectionError("Socket closed early")
-        data.extend(chunk)
-    return bytes(data)
+import argparse, json, os, socket, struct, pathlib, selectors, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from transfer_protocol import (CHUNK, MAX_NAME, MAGIC_V2, MAGIC_V3, DIGEST_SIZE, TID_SIZE,
+                               CHUNK_DIGEST_SIZE, ROOT_SIZE, MAX_CHUNK, MAX_MANIFEST,
+                               OP_OPEN, OP_RANGE, OP_COMMIT, ST_OK, ST_BAD, ST_MISSING,
+                               new_hasher, new_chunk_hasher, root_hash, n_chunks, v3_reply,
+                               pack_ranges, add_range, remove_range, missing_ranges)
+
+# without pread/pwrite the file position is shared with the I/O workers
+_seek_lock = threading.Lock()
+
+def pread(fd, length, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+def pwrite(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset = data[n:], offset + n
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+class Upload:
+    """
+    A TXF3 upload in progress: a part file preallocated to the final size under
+    save_dir/.partial, its chunk manifest, and the ranges verified so far. The
+    manifest is written once next to the part file and the ranges are kept in
+    a JSON sidecar, so a restarted server still knows what it holds.
+
+    allocate(), verified() and reverify() block on the disk and run on the
+    server's worker threads; `lock` guards the ranges, the sidecar and the fd
+    against the selector thread and each other.
+    """
+    def __init__(self, save_dir, tid, name, size, chunk_size, digests, root=None, ranges=()):
+        self.save_dir, self.tid, self.name, self.size = save_dir, tid, name, size
+        self.chunk_size, self.digests, self.root = chunk_size, digests, root
+        self.ranges = [tuple(r) for r in ranges]
+        self.lock = threading.Lock()
+        base = pathlib.Path(save_dir) / ".partial" / tid.hex()
+        self.part, self.meta = base.with_suffix(".part"), base.with_suffix(".json")
+        self.manifest = base.with_suffix(".manifest")
+        self.part.parent.mkdir(exist_ok=True)
+        if not ranges:
+            self.manifest.write_bytes((root or b"") + digests)
+        self.fd = os.open(self.part, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        self.save()
+
+    def allocate(self):
+        """Reserve the final size on disk up front."""
+        if self.size:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.fd, 0, self.size)
+            else:
+                os.ftruncate(self.fd, self.size)
+
+    @classmethod
+    def load(cls, save_dir, tid):
+        """The upload as recorded by its sidecar, or None if there is none."""
+        base = pathlib.Path(save_dir) / ".partial" / tid.hex()
+        try:
+            m = json.loads(base.with_suffix(".json").read_text())
+            manifest = base.with_suffix(".manifest").read_bytes()
+        except (OSError, ValueError):
+            return None
+        root = manifest[:ROOT_SIZE] if m["root"] else None
+        digests = manifest[ROOT_SIZE:] if m["root"] else manifest
+        return cls(save_dir, tid, m["name"], m["size"], m["chunk_size"], digests, root, m["ranges"])
+
+    def save(self):
+        tmp = self.meta.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"name": self.name, "size": self.size, "chunk_size": self.chunk_size,
+                                   "root": self.root is not None, "ranges": self.ranges}))
+        os.replace(tmp, self.meta)
+
+    def same_file(self, name, size, chunk_size, digests, root):
+        return (self.name, self.size, self.chunk_size, self.digests, self.root) == \
+               (name, size, chunk_size, digests, root)
+
+    def chunk(self, i):
+        """(start, end, expected digest) of chunk i."""
+        start = i * self.chunk_size
+        d = self.digests[i * CHUNK_DIGEST_SIZE:(i + 1) * CHUNK_DIGEST_SIZE]
+        return start, min(start + self.chunk_size, self.size), d
+
+    def verified(self, ranges, failed=()):
+        """
+        Record `ranges` as held and forget `failed`: a chunk that was good
+        before and has just been overwritten with bad data is gone.
+        """
+        fd = self.fd
+        if fd is None:
+            return   # completed by another connection meanwhile
+        # the data must be on disk before the sidecar says we have it
+        os.fsync(fd)
+        with self.lock:
+            if self.fd is None:
+                return
+            for start, end in ranges:
+                self.ranges = add_range(self.ranges, start, end)
+            for start, end in failed:
+                self.ranges = remove_range(self.ranges, start, end)
+            self.save()
+
+    def reverify(self):
+        """
+        Re-read the part file and hash it chunk by chunk. The manifest was
+        checked against the root at OPEN, so the file matches the root exactly
+        when every chunk matches the manifest. Chunks that no longer do are
+        forgotten and returned.
+        """
+        bad, fd = [], self.fd
+        if fd is None:
+            return bad   # completed by another connection meanwhile
+        for i in range(n_chunks(self.size, self.chunk_size)):
+            start, end, expected = self.chunk(i)
+            h, pos = new_chunk_hasher(), start
+            while pos < end:
+                block = pread(fd, min(CHUNK * 16, end - pos), pos)
+                if not block: break
+                h.update(block); pos += len(block)
+            if h.digest() != expected:
+                bad.append((start, end))
+        with self.lock:
+            if bad and self.fd is not None:
+                for start, end in bad:
+                    self.ranges = remove_range(self.ranges, start, end)
+                self.save()
+        return bad
+
+    def missing(self):
+        return missing_ranges(self.ranges, self.size)
+
+    def complete(self):
+        with self.lock:
+            os.close(self.fd); self.fd = None
+            os.replace(self.part, pathlib.Path(self.save_dir) / self.name)
+            os.remove(self.meta); os.remove(self.manifest)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd); self.fd = None
+
+
+class Transfer:
+    """
+    One client connection as a state machine driven by the selector:
+      v1:   name_len -> name -> meta (size + md5) -> body -> reply -> closed
+      TXF2: magic -> name_len -> name -> meta (size) -> body -> trailer (md5) -> reply
+      TXF3: magic -> op + transfer id -> (OPEN: name_len -> name -> meta (size)
+            -> manifest_head -> manifest | RANGE: range (offset, length) -> body
+            | COMMIT) -> reply -> magic ... until the client closes
+    Header fields are collected in a buffer no larger than the field being
+    read; body bytes go straight from recv() to the file (positional writes
+    into the upload's part file for TXF3 ranges, hashed chunk by chunk
+    against the manifest on the way). Disk work that can block (preallocation,
+    the fsync before a range is recorded, the re-hash at COMMIT) is handed to
+    a worker with defer(): the connection sits in "wait", off the selector,
+    until resume() finishes the request.
+    """
+    def __init__(self, conn, addr, save_dir, uploads=None):
+        self.conn, self.addr, self.save_dir = conn, addr, save_dir
+        self.uploads = {} if uploads is None else uploads
+        self.version = 1
+        self.started = self.last_active = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        """Back to the start of a request (TXF3 connections carry several)."""
+        self.state, self.need, self.buf = "start", 4, bytearray()
+        self.op = self.tid = self.upload = None
+        self.name = None; self.size = 0; self.md5 = None; self.offset = 0
+        self.file = None; self.hasher = new_hasher(); self.received = 0
+        self.chunk_size = 0; self.has_root = False
+        self.good = []; self.failed = []; self.gone = False
+        self.reply = b""; self.ok = False
+        self.job = self.then = None
+
+    def on_readable(self, stats):
+        """Returns False once the connection needs no more reads."""
+        if self.state == "body":
+            data = self.conn.recv(min(CHUNK, self.size - self.received))
+        else:
+            data = self.conn.recv(self.need - len(self.buf))
+        if not data:
+            if self.version == 3 and self.state == "start" and not self.buf:
+                self.state = "closed"   # clean close between requests
+                return False
+            raise ConnectionError("Socket closed early")
+        stats.bytes += len(data)
+        if self.state == "body":
+            if self.upload is not None:
+                with self.upload.lock:
+                    # another connection may have committed (and closed) the upload
+                    self.gone = self.gone or self.upload.fd is None
+                    if not self.gone:
+                        pwrite(self.upload.fd, data, self.offset + self.received)
+                if self.gone:
+                    self.received += len(data)   # drain the range, answer BAD at the end
+                else:
+                    self.check_chunks(data)
+            else:
+                self.file.write(data); self.hasher.update(data)
+                self.received += len(data)
+            if self.received == self.size:
+                self.end_body()
+            return self.state not in ("reply", "wait")
+        self.buf.extend(data)
+        if len(self.buf) == self.need:
+            field, self.buf = bytes(self.buf), bytearray()
+            self.on_field(field)
+        return self.state not in ("reply", "wait")
+
+    def on_field(self, field):
+        if self.state == "start":
+            if field == MAGIC_V3:
+                self.version, self.state, self.need = 3, "op", 1 + TID_SIZE
+                return
+            if self.version == 3:
+                raise ValueError("bad request magic")
+            if field == MAGIC_V2:
+                self.version, self.state = 2, "name_len"   # the real name length follows
+                return
+            self.state = "name_len"   # v1: no magic, this is already the name length
+        if self.state == "name_len":
+            self.need = struct.unpack(">I", field)[0]
+            if not 0 < self.need <= MAX_NAME: raise ValueError(f"bad name length {self.need}")
+            self.state = "name"
+        elif self.state == "name":
+            # keep only the final component: the client can't write outside save_dir
+            self.name = pathlib.Path(field.decode()).name
+            self.state, self.need = "meta", 8 + (DIGEST_SIZE if self.version == 1 else 0)
+        elif self.state == "meta":
+            self.size = struct.unpack(">Q", field[:8])[0]
+            self.md5 = field[8:] or None
+            if self.version == 3:
+                self.state, self.need = "manifest_head", 5
+                return
+            self.file = open(pathlib.Path(self.save_dir) / self.name, "wb")
+            self.state = "body"
+            if self.size == 0:
+                self.end_body()
+        elif self.state == "manifest_head":
+            self.chunk_size, self.has_root = struct.unpack(">IB", field)
+            if not 0 < self.chunk_size <= MAX_CHUNK: raise ValueError(f"bad chunk size {self.chunk_size}")
+            self.need = ROOT_SIZE * bool(self.has_root) + \
+                        CHUNK_DIGEST_SIZE * n_chunks(self.size, self.chunk_size)
+            if self.need > MAX_MANIFEST: raise ValueError(f"manifest of {self.need} bytes too large")
+            self.state = "manifest"
+            if self.need == 0:
+                self.open_upload(None, b"")
+        elif self.state == "manifest":
+            root = field[:ROOT_SIZE] if self.has_root else None
+            self.open_upload(root, field[ROOT_SIZE:] if self.has_root else field)
+        elif self.state == "op":
+            self.op, self.tid = field[0], field[1:]
+            if self.op == OP_OPEN:
+                self.state, self.need = "name_len", 4
+            elif self.op == OP_RANGE:
+                self.state, self.need = "range", 16
+            elif self.op == OP_COMMIT:
+                self.commit()
+            else:
+                raise ValueError(f"bad op {self.op}")
+        elif self.state == "range":
+            self.offset, self.size = struct.unpack(">QQ", field)
+            self.upload = self.find_upload()
+            if self.upload is None: raise ValueError(f"unknown transfer {self.tid.hex()}")
+            end, cs = self.offset + self.size, self.upload.chunk_size
+            if not self.size or end > self.upload.size:
+                raise ValueError(f"range {self.offset}+{self.size} outside {self.upload.name}")
+            if self.offset % cs or (end % cs and end != self.upload.size):
+                raise ValueError(f"range {self.offset}+{self.size} not on {cs}-byte chunks")
+            self.hasher = new_chunk_hasher()
+            self.state = "body"
+        elif self.state == "trailer":
+            self.md5 = field
+            self.finish()
+
+    def find_upload(self):
+        up = self.uploads.get(self.tid)
+        if up is None:
+            up = Upload.load(self.save_dir, self.tid)
+            if up is not None: self.uploads[self.tid] = up
+        return up
+
+    def open_upload(self, root, digests):
+        if root is not None and root_hash(digests) != root:
+            return self.respond(ST_BAD)   # the manifest was damaged on the way
+        up = self.find_upload()
+        if up is None:
+            up = self.uploads[self.tid] = Upload(self.save_dir, self.tid, self.name, self.size,
+                                                 self.chunk_size, digests, root)
+            return self.defer(up.allocate, lambda _: self.respond(ST_OK, pack_ranges(up.ranges)))
+        elif not up.same_file(self.name, self.size, self.chunk_size, digests, root):
+            return self.respond(ST_BAD)   # the id belongs to another file
+        self.respond(ST_OK, pack_ranges(up.ranges))
+
+    def check_chunks(self, data):
+        """Hash range body bytes, checking each chunk against the manifest as it completes."""
+        up, view = self.upload, memoryview(data)
+        while view:
+            pos = self.offset + self.received
+            i = pos // up.chunk_size
+            start, end, expected = up.chunk(i)
+            take = min(len(view), end - pos)
+            self.hasher.update(view[:take])
+            self.received += take; view = view[take:]
+            if pos + take == end:
+                (self.good if self.hasher.digest() == expected else self.failed).append((start, end))
+                self.hasher = new_chunk_hasher()
+
+    def commit(self):
+        up = self.upload = self.find_upload()
+        if up is None:
+            return self.respond(ST_BAD)
+        gaps = up.missing()
+        if not gaps and up.root is not None:
+            # end to end: what is on disk must still hash to the root
+            return self.defer(up.reverify, self.end_commit)
+        self.end_commit(gaps)
+
+    def end_commit(self, gaps):
+        up = self.upload
+        if self.uploads.get(self.tid) is not up:
+            return self.respond(ST_BAD)   # another connection committed it meanwhile
+        gaps = gaps or up.missing()
+        if gaps:
+            return self.respond(ST_MISSING, pack_ranges(gaps))
+        up.complete()
+        del self.uploads[self.tid]
+        self.name, self.size = up.name, up.size
+        self.respond(ST_OK)
+
+    def defer(self, job, then):
+        """Run job() on a worker thread; then(its result) finishes the request."""
+        self.job, self.then = job, then
+        self.state = "wait"
+
+    def resume(self, result):
+        then, self.job, self.then = self.then, None, None
+        then(result)
+
+    def respond(self, status, payload=b""):
+        self.ok = status == ST_OK
+        self.reply = v3_reply(status, payload)
+        self.state = "reply"
+
+    def end_body(self):
+        if self.version == 3:
+            if self.gone:
+                return self.respond(ST_BAD)
+            # keep the chunks that verified; the client resends only the others
+            return self.defer(lambda: self.upload.verified(self.good, self.failed),
+                              lambda _: self.respond(ST_BAD if self.failed else ST_OK,
+                                                     pack_ranges(self.failed)))
+        if self.version == 1:
+            self.finish()
+        else:
+            self.state, self.need = "trailer", DIGEST_SIZE
+
+    def finish(self):
+        self.file.close()
+        self.ok = self.hasher.digest() == self.md5
+        self.reply = b"OK" if self.ok else b"BAD"
+        self.state = "reply"
+
+    def on_writable(self):
+        """Returns True once the whole reply is sent."""
+        sent = self.conn.send(self.reply)
+        self.reply = self.reply[sent:]
+        return not self.reply
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+        self.conn.close()
+
+
+class Stats:
+    """
+    Aggregate throughput across all connections. `done` counts files saved: a
+    v1/TXF2 upload that verified, or a TXF3 transfer at its successful COMMIT
+    (once, however many connections carried it). `failed` counts connections
+    dropped on an error, a bad digest or an idle deadline mid-request.
+    """
+    def __init__(self):
+        self.bytes = 0; self.done = 0; self.failed = 0
+        self.mark, self.mark_bytes = time.monotonic(), 0
+
+    def report(self, active):
+        now = time.monotonic()
+        rate = (self.bytes - self.mark_bytes) / max(now - self.mark, 1e-9) / 1e6
+        self.mark, self.mark_bytes = now, self.bytes
+        print(f"[TCP SERVER] {rate:.1f} MB/s, {active} active, {self.done} done, {self.failed} failed")
+
+
+def serve(host, port, save_dir, max_conns=64, stats_interval=5.0, stop=None, ready=None,
+          idle_timeout=30.0, io_workers=4):
+    os.makedirs(save_dir, exist_ok=True)
+    sel = selectors.DefaultSelector()
+    stats = Stats()
+    active = {}
+    uploads = {}   # transfer id -> Upload, shared by all connections of a TXF3 transfer
+    # blocking disk work runs here; finished jobs queue up and wake the selector
+    pool = ThreadPoolExecutor(io_workers, thread_name_prefix="txf-io")
+    finished = deque()
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False); wake_w.setblocking(False)
+    sel.register(wake_r, selectors.EVENT_READ)
+    with socket.create_server((host, port), backlog=128) as srv:
+        # Set the listening socket to non-blocking mode
+        srv.setblocking(False)
+        sel.register(srv, selectors.EVENT_READ)
+        accepting = True
+        print(f"[TCP SERVER] Listening on {host}:{port} (max {max_conns} concurrent transfers)")
+        if ready is not None: ready.set()
+
+        def drop(t, failed=False):
+            nonlocal accepting
+            sel.unregister(t.conn); t.close(); del active[t.conn]
+            if failed: stats.failed += 1
+            if not accepting and len(active) < max_conns:
+                # a slot is free again: resume accepting
+                sel.register(srv, selectors.EVENT_READ); accepting = True
+
+        def done(t, fut):
+            finished.append((t, fut))
+            try:
+                wake_w.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass   # already woken, or shutting down
+
+        def dispatch(t):
+            # no reads or writes on this connection until its job is done
+            sel.unregister(t.conn)
+            pool.submit(t.job).add_done_callback(lambda fut: done(t, fut))
+
+        def resume_finished():
+            wake_r.recv(4096)
+            while finished:
+                t, fut = finished.popleft()
+                t.last_active = time.monotonic()
+                sel.register(t.conn, selectors.EVENT_WRITE, t)
+                try:
+                    t.resume(fut.result())
+                except (OSError, ValueError) as e:
+                    print(f"[TCP SERVER] {t.addr}: {e}")
+                    drop(t, failed=True)
+
+        def sweep(now):
+            # a client that sends nothing (or reads nothing) must not hold a slot forever
+            for t in [t for t in active.values()
+                      if t.state != "wait" and now - t.last_active > idle_timeout]:
+                between = t.version == 3 and t.state == "start" and not t.buf
+                if not between:
+                    print(f"[TCP SERVER] {t.addr}: idle for {idle_timeout:g}s, dropping")
+                drop(t, failed=not between)
+
+        next_report, next_sweep = time.monotonic() + stats_interval, time.monotonic()
+        while stop is None or not stop.is_set():
+            # block until something is ready (bounded so stats and stop get a look in)
+            for key, mask in sel.select(timeout=max(0.0, min(next_report - time.monotonic(), 0.5))):
+                if key.fileobj is srv:
+                    while len(active) < max_conns:
+                        try:
+                            conn, addr = srv.accept()
+                        except BlockingIOError:
+                            break
+                        conn.setblocking(False)
+                        t = active[conn] = Transfer(conn, addr, save_dir, uploads)
+                        sel.register(conn, selectors.EVENT_READ, t)
+                    if len(active) >= max_conns:
+                        # leave further clients in the kernel backlog until a slot frees
+                        sel.unregister(srv); accepting = False
+                    continue
+                if key.fileobj is wake_r:
+                    resume_finished()
+                    continue
+                t = key.data
+                t.last_active = time.monotonic()
+                try:
+                    if mask & selectors.EVENT_READ:
+                        if t.on_readable(stats):
+                            pass
+                        elif t.state == "closed":
+                            drop(t)
+                        elif t.state == "wait":
+                            dispatch(t)
+                        else:
+                            sel.modify(t.conn, selectors.EVENT_WRITE, t)
+                    elif t.on_writable():
+                        if t.version == 3:
+                            if t.op == OP_COMMIT and t.ok:
+                                stats.done += 1
+                                print(f"[TCP SERVER] Saved {t.name} ({t.size} bytes), all ranges verified")
+                            # keep-alive: wait for the client's next request
+                            t.reset()
+                            sel.modify(t.conn, selectors.EVENT_READ, t)
+                            continue
+                        print(f"[TCP SERVER] Saved {t.name} ({t.size} bytes) from {t.addr} "
+                              f"Integrity: {'OK' if t.ok else 'BAD'}")
+                        if t.ok: stats.done += 1
+                        drop(t, failed=not t.ok)
+                except BlockingIOError:
+                    pass
+                except (OSError, ValueError) as e:
+                    print(f"[TCP SERVER] {t.addr}: {e}")
+                    drop(t, failed=True)
+            if idle_timeout is not None and time.monotonic() >= next_sweep:
+                sweep(time.monotonic())
+                next_sweep = time.monotonic() + min(idle_timeout / 4, 1.0)
+            if time.monotonic() >= next_report:
+                stats.report(len(active))
+                next_report = time.monotonic() + stats_interval
+        pool.shutdown(wait=True)
+        for t in list(active.values()):
+            t.close()
+        for up in uploads.values():
+            up.close()
+    sel.close()
+    wake_r.close(); wake_w.close()
+    return stats
+
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default="127.0.0.1")
     ap.add_argument("--port", type=int, default=5001)
     ap.add_argument("--save-dir", default="received")
+    ap.add_argument("--max-conns", type=int, default=64, help="concurrent transfers; more wait in the backlog")
+    ap.add_argument("--stats-interval", type=float, default=5.0, help="seconds between throughput reports")
+    ap.add_argument("--idle-timeout", type=float, default=30.0,
+                    help="drop a connection that sends or reads nothing for this long")
     args = ap.parse_args()
-
-    os.makedirs(args.save_dir, exist_ok=True)
-    with socket.create_server((args.host, args.port)) as srv:
-        # Set the listening socket to non-blocking mode
-        srv.setblocking(False)
-        print(f"[TCP SERVER] Listening on {args.host}:{args.port}")
-        while True:
-            # Wrap the accept() call in a try/except block
-            try:
-                conn, addr = srv.accept()
-                with conn:
-                    print(f"[TCP SERVER] Connected: {addr}")
-                    name_len = struct.unpack(">I", recv_exact(conn, 4))[0]
-                    name = recv_exact(conn, name_len).decode()
-                    size = struct.unpack(">Q", recv_exact(conn, 8))[0]
-                    md5_bytes = recv_exact(conn, 16)
-
-                    out_path = pathlib.Path(args.save_dir) / name
-                    hasher = hashlib.md5(); received = 0
-                    with open(out_path, "wb") as f:
-                        while received < size:
-                            chunk = conn.recv(min(CHUNK, size - received))
-                            if not chunk: break
-                            f.write(chunk); hasher.update(chunk)
-                            received += len(chunk)
-
-                    ok = hasher.digest() == md5_bytes
-                    conn.sendall(b"OK" if ok else b"BAD")
-                    print(f"[TCP SERVER] Saved {out_path} ({size} bytes) Integrity: {'OK' if ok else 'BAD'}")
-            except BlockingIOError:
-                # When no connection is pending, do nothing and continue
-                # A small sleep period is added to prevent loop from consuming 100% of CPU
-                time.sleep(0.1)
-                continue
+    serve(args.host, args.port, args.save_dir, args.max_conns, args.stats_interval,
+          idle_timeout=args.idle_timeout)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,195 @@
+import asyncio
+import argparse
+import socket
+import sys
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from mq_to_p2p_bridge import BridgeMetrics, BridgeWorker, PeerLink
+from p2p_peer import Peer
+
+class FakeMethod:
+    def __init__(self, tag):
+        self.delivery_tag = tag
+
+class FakeBroker:
+    """One queue shared by every worker's channel, with per-channel unacked deliveries."""
+    def __init__(self, bodies):
+        self.lock = threading.Lock()
+        self.ready = deque(bodies)
+        self.acked = []
+        self.nacks = 0
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker, self.unacked, self.tag, self.prefetch = broker, OrderedDict(), 0, 0
+
+    def queue_declare(self, queue, passive=False):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def consume(self, queue, inactivity_timeout):
+        while True:
+            body = None
+            with self.broker.lock:
+                if self.broker.ready and len(self.unacked) < self.prefetch:
+                    body = self.broker.ready.popleft()
+            if body is None:
+                time.sleep(inactivity_timeout)
+                yield None, None, None
+                continue
+            self.tag += 1
+            self.unacked[self.tag] = body
+            yield FakeMethod(self.tag), None, body
+
+    def _take(self, tag, multiple):
+        tags = [t for t in self.unacked if t <= tag] if multiple else [tag]
+        return [self.unacked.pop(t) for t in tags]
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        bodies = self._take(delivery_tag, multiple)
+        with self.broker.lock:
+            self.broker.acked += bodies
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        bodies = self._take(delivery_tag, multiple)
+        with self.broker.lock:
+            self.broker.nacks += 1
+            if requeue:
+                self.broker.ready.extendleft(reversed(bodies))
+
+    def cancel(self):
+        pass
+
+    def requeue_unacked(self):
+        with self.broker.lock:
+            self.broker.ready.extendleft(reversed(list(self.unacked.values())))
+        self.unacked.clear()
+
+class FakeConn:
+    def __init__(self, broker):
+        self.ch = FakeChannel(broker)
+
+    def channel(self):
+        return self.ch
+
+    def close(self):
+        self.ch.requeue_unacked()   # the broker redelivers what was never acked
+
+class FakePool:
+    """Stands in for PeerPool; the first `failures` batches find no peer."""
+    def __init__(self, failures=0):
+        self.lock, self.failures = threading.Lock(), failures
+        self.sent, self.threads = [], set()
+
+    def send(self, events):
+        time.sleep(0.005)
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("no peer accepted the batch")
+            self.sent += events
+            self.threads.add(threading.current_thread().name)
+        return ("127.0.0.1", 9001)
+
+    def keepalive(self, interval):
+        pass
+
+    def close(self):
+        pass
+
+class FakeWorker(BridgeWorker):
+    def __init__(self, idx, args, broker, pool, metrics, stop):
+        super().__init__(idx, args, [("127.0.0.1", 9001)], metrics, stop)
+        self.broker, self.pool = broker, pool
+
+    def _connect(self):
+        return FakeConn(self.broker)
+
+def bridge_args(**kw):
+    base = dict(mq_host="localhost", queue="file_alerts", prefetch=10, batch=8,
+                flush_ms=5.0, peer_timeout=1.0, keepalive=0.5)
+    base.update(kw)
+    return argparse.Namespace(**base)
+
+def run_workers():
+    n = 300
+    broker = FakeBroker([f"file.updated id=f{i} version=1".encode() for i in range(n)]
+                        + [b"not an event"])
+    pool, metrics, stop = FakePool(failures=1), BridgeMetrics(), threading.Event()
+    workers = [FakeWorker(i, bridge_args(), broker, pool, metrics, stop) for i in range(3)]
+    for w in workers:
+        w.start()
+    deadline = time.monotonic() + 10
+    while len(broker.acked) < n + 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop.set()
+    for w in workers:
+        w.join(2)
+
+    # every message acked exactly once, every event forwarded, the failed batch requeued
+    assert sorted(broker.acked) == sorted(set(broker.acked)) and len(broker.acked) == n + 1
+    assert {ev["file_id"] for ev in pool.sent} == {f"f{i}" for i in range(n)}
+    assert broker.nacks == 1 and metrics.requeued >= 1 and metrics.unrecognized == 1
+    assert not broker.ready
+    assert len(pool.threads) >= 2, pool.threads
+    print(f"PASS: {len(workers)} workers forwarded {n} events, nacked batch requeued and re-sent")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_barrier():
+    port = free_port()
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    peer = Peer("127.0.0.1", port, set(), coalesce_window=0.2)
+    serving = asyncio.run_coroutine_threadsafe(peer.start(), loop)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    try:
+        link = PeerLink(("127.0.0.1", port))
+        # a burst on one file sits in the coalescing window; the barrier flushes it
+        events = [{"type": "event", "file_id": "hot", "version": v, "ts": 0} for v in range(1, 6)]
+        events += [{"type": "event", "file_id": f"b{i}", "version": i + 1, "ts": 0} for i in range(20)]
+        link.send_batch(events)
+        assert peer.files.get("hot") == 5
+        assert all(peer.files.get(f"b{i}") == i + 1 for i in range(20))
+        print("PASS: barrier_ack only after every earlier event was applied")
+
+        sock = link.sock
+        link.send_batch([{"type": "event", "file_id": "hot", "version": 6, "ts": 0}])
+        assert link.sock is sock and peer.files["hot"] == 6
+        # the link went stale: the batch is retried once on a fresh connection
+        sock.shutdown(socket.SHUT_RDWR)
+        link.send_batch([{"type": "event", "file_id": "hot", "version": 7, "ts": 0}])
+        assert link.sock is not sock and peer.files["hot"] == 7
+        link.close()
+        print("PASS: link reused across batches and reconnected when stale")
+    finally:
+        loop.call_soon_threadsafe(serving.cancel)
+        loop.call_soon_threadsafe(peer.stop)
+        time.sleep(0.1)
+        loop.call_soon_threadsafe(loop.stop)
+
+def test_worker_pool_ack_nack():
+    run_workers()
+
+def test_barrier_handshake():
+    run_barrier()
+
+if __name__ == "__main__":
+    test_worker_pool_ack_nack()
+    test_barrier_handshake()
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from p2p_peer import Peer
+
+# Loopback "connection" that only records what a peer forwards
+class Recorder:
+    def __init__(self):
+        self.key = ("127.0.0.1", 9302)
+        self.sent = []
+
+    async def send(self, obj):
+        self.sent.append(json.loads(json.dumps(obj)))
+
+async def run_storm():
+    a = Peer("127.0.0.1", 9301, set(), coalesce_window=0.05)
+    out = Recorder()
+    a.connections[out.key] = out
+
+    # edit storm: 100 versions of one file, plus an older straggler
+    for v in range(1, 101):
+        await a._on_msg({"type": "event", "file_id": "f", "version": v}, None)
+    await a._on_msg({"type": "event", "file_id": "f", "version": 7}, None)
+    await asyncio.sleep(0.1)
+
+    assert a.files == {"f": 100}, a.files
+    forwarded = [m["version"] for m in out.sent if m["type"] == "event"]
+    assert forwarded == [1, 100], forwarded
+    print("PASS: 101 events applied/forwarded as", forwarded, "coalesced:", a.coalesced)
+
+    # a barrier flushes pending events before it is acknowledged
+    for v in range(101, 105):
+        await a._on_msg({"type": "event", "file_id": "f", "version": v}, None)
+    await a._on_msg({"type": "barrier", "id": 1}, out)
+    assert a.files["f"] == 104 and out.sent[-1]["type"] == "barrier_ack"
+    print("PASS: barrier applies pending events first")
+
+def test_event_coalescing():
+    asyncio.run(run_storm())
+
+if __name__ == "__main__":
+    test_event_coalescing()
@@ -0,0 +1,155 @@
+import asyncio
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from connections import Connection, ConnectionManager, PhiAccrualDetector
+
+class FakeWriter:
+    def __init__(self):
+        self.data, self.closed = b"", False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+async def on_message(msg, conn):
+    pass
+
+def manager(addr, **kw):
+    return ConnectionManager(addr, on_message, lambda: {"type": "hello", "from": addr}, **kw)
+
+def conn_to(key, initiator):
+    return Connection(None, FakeWriter(), initiator=initiator, key=key)
+
+def run_dedup():
+    low, high = "127.0.0.1:9001", "127.0.0.1:9002"
+    to_high, to_low = ("127.0.0.1", 9002), ("127.0.0.1", 9001)
+
+    # the lower address keeps its own dial, whichever connection registers first
+    for order in ("dialed first", "accepted first"):
+        cm = manager(low)
+        dialed, accepted = conn_to(to_high, low), conn_to(to_high, high)
+        first, second = (dialed, accepted) if order == "dialed first" else (accepted, dialed)
+        assert cm._register(first)
+        assert cm._register(second) is (second is dialed)
+        assert cm.conns[to_high] is dialed and not dialed.closed and accepted.closed
+    print("PASS: lower address keeps the connection it dialed")
+
+    # the higher address keeps the connection the lower one dialed
+    cm = manager(high)
+    dialed, accepted = conn_to(to_low, high), conn_to(to_low, low)
+    assert cm._register(dialed)
+    assert cm._register(accepted)
+    assert cm.conns[to_low] is accepted and dialed.closed
+    assert not cm._register(conn_to(to_low, high))
+    print("PASS: higher address gives up its own dial for the lower one's")
+
+    # a closed leftover doesn't win: the new connection replaces it
+    cm = manager(high)
+    old = conn_to(to_low, low)
+    assert cm._register(old)
+    old.close()
+    fresh = conn_to(to_low, high)
+    assert cm._register(fresh) and cm.conns[to_low] is fresh
+    print("PASS: closed connection replaced by a new one")
+
+def run_phi():
+    d = PhiAccrualDetector(threshold=8.0, first_interval=1.0)
+    for i in range(20):
+        d.heartbeat(float(i))
+    assert d.phi(19.5) < 1 and not d.suspect(20.0)
+    assert d.phi(21.0) > d.phi(20.0) and d.suspect(25.0)
+    # the detector adapts: a jittery peer is given more slack than a regular one
+    jittery = PhiAccrualDetector(threshold=8.0, first_interval=1.0)
+    t = 0.0
+    for i in range(20):
+        t += 0.2 if i % 2 else 1.8
+        jittery.heartbeat(t)
+    assert jittery.phi(t + 2.0) < d.phi(19.0 + 2.0)
+    print("PASS: phi grows with silence and adapts to arrival jitter")
+
+    async def scenario():
+        evicted, closed = [], []
+        cm = manager("127.0.0.1:9001", heartbeat_interval=0.05, phi_threshold=8.0,
+                     on_evict=evicted.append, on_close=closed.append)
+        silent, chatty = ("127.0.0.1", 9002), ("127.0.0.1", 9003)
+        for key in (silent, chatty):
+            conn = Connection(None, FakeWriter(), initiator=cm.addr, key=key, detector=cm._detector())
+            conn.detector.heartbeat(time.monotonic())
+            cm._register(conn)
+
+        async def keep_alive():
+            while True:
+                await asyncio.sleep(0.05)
+                if chatty in cm.conns:
+                    cm.conns[chatty].detector.heartbeat(time.monotonic())
+
+        tasks = [asyncio.create_task(cm.heartbeat_loop()), asyncio.create_task(keep_alive())]
+        deadline = time.monotonic() + 5
+        while silent in cm.conns and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in tasks:
+            t.cancel()
+        assert silent not in cm.conns and evicted == [silent] and closed == [silent]
+        assert chatty in cm.conns and not cm.conns[chatty].closed
+        assert b"ping" in cm.conns[chatty].writer.data
+
+    asyncio.run(scenario())
+    print("PASS: silent peer evicted by the heartbeat loop, live peer kept")
+
+class BrokenWriter(FakeWriter):
+    async def drain(self):
+        raise ConnectionResetError("peer went away")
+
+def run_batched_failure():
+    async def scenario():
+        closed = []
+        cm = manager("127.0.0.1:9001", on_close=closed.append)
+        key = ("127.0.0.1", 9002)
+        conn = Connection(None, BrokenWriter(), initiator=cm.addr, key=key, on_error=cm.drop)
+        conn.codec = "json"
+        cm._register(conn)
+
+        await conn.send({"type": "ping"})       # queued; the timed flush fails later
+        await asyncio.sleep(0.05)
+        assert conn.closed and key not in cm.conns and closed == [key]
+        try:
+            await conn.send({"type": "ping"})
+            assert False, "send on a failed connection must raise"
+        except ConnectionResetError:
+            pass
+
+        # a full batch is flushed inside send, so its caller sees the error itself
+        full = Connection(None, BrokenWriter(), initiator=cm.addr, key=key, max_batch=2)
+        full.codec = "json"
+        await full.send({"type": "ping"})
+        try:
+            await full.send({"type": "ping"})
+            assert False, "a failed flush must reach the sender"
+        except ConnectionResetError:
+            pass
+
+    asyncio.run(scenario())
+    print("PASS: failed batched write drops the peer and surfaces to later sends")
+
+def test_dedup():
+    run_dedup()
+
+def test_phi_eviction():
+    run_phi()
+
+def test_batched_send_failure():
+    run_batched_failure()
+
+if __name__ == "__main__":
+    test_dedup()
+    test_phi_eviction()
+    test_batched_send_failure()
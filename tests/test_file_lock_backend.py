@@ -0,0 +1,154 @@
+import contextlib
+import io
+import sys
+import os
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m2_rest_api"))
+
+import transactions
+from transactions import DistributedLockBackend, LockTimeout
+
+def run_replicas():
+    a = DistributedLockBackend("127.0.0.1:7111", ["127.0.0.1:7112"], linger=0.5, retransmit=0.2)
+    b = DistributedLockBackend("127.0.0.1:7112", ["127.0.0.1:7111"], linger=0.5, retransmit=0.2)
+    a.start()
+    b.start()
+    try:
+        # uncontended: repeated writes on one replica hit the cached lock
+        for _ in range(5):
+            a.acquire("f", 2)
+            a.release("f")
+        assert a.fast_hits == 4, a.fast_hits
+        print("PASS: 4 of 5 uncontended acquisitions served from the cache")
+
+        # the other replica gets it right away: its REQUEST evicts the cache
+        t0 = time.monotonic()
+        b.acquire("f", 2)
+        assert time.monotonic() - t0 < 0.3
+        b.release("f")
+
+        # contended: writers on both replicas never overlap
+        inside, overlaps = [], []
+        def writer(backend, name):
+            for _ in range(5):
+                backend.acquire("g", 5)
+                if inside:
+                    overlaps.append(name)
+                inside.append(name)
+                time.sleep(0.01)
+                inside.remove(name)
+                backend.release("g")
+        threads = [threading.Thread(target=writer, args=(x, n)) for x, n in ((a, "a"), (b, "b"))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert not overlaps, overlaps
+        print("PASS: 10 contended writes across two replicas, no overlap")
+
+        # a writer stuck on the other replica makes us time out, not hang
+        a.acquire("h", 2)
+        t0 = time.monotonic()
+        try:
+            b.acquire("h", 0.3)
+            assert False, "acquired a held lock"
+        except LockTimeout:
+            pass
+        assert time.monotonic() - t0 < 1.0
+        assert b.node.acquire_timeout == transactions.LOCK_TIMEOUT   # per call, not node-wide
+        a.release("h")
+        print("PASS: LockTimeout after", round(time.monotonic() - t0, 2), "s")
+    finally:
+        a.close()
+        b.close()
+
+def run_config():
+    env = {"FILE_LOCK_LISTEN": "127.0.0.1:7113", "FILE_LOCK_PEERS": "127.0.0.1:7114",
+           "FILE_LOCK_FD_TIMEOUT": "0.4", "FILE_LOCK_LEASE_TTL": "3"}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        backend = transactions.make_backend("ra")
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    node = backend._make_node()
+    assert (node.fd_timeout, node.lease_ttl) == (0.4, 3.0), (node.fd_timeout, node.lease_ttl)
+    assert transactions.make_backend("ra")._make_node().fd_timeout is None
+    print("PASS: FILE_LOCK_FD_TIMEOUT and FILE_LOCK_LEASE_TTL reach the lock node")
+
+    # the only peer is down: nothing is printed while the lock waits for it
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        backend.start()
+        try:
+            backend.acquire("x", 0.3)
+            assert False, "acquired without the peer"
+        except LockTimeout:
+            pass
+        finally:
+            backend.close()
+    assert out.getvalue() == "", out.getvalue()
+    print("PASS: a quiet lock node doesn't log connection retries")
+
+def run_lease():
+    a = DistributedLockBackend("127.0.0.1:7115", ["127.0.0.1:7116"], linger=5, retransmit=0.1,
+                               lease_ttl=0.6)
+    b = DistributedLockBackend("127.0.0.1:7116", ["127.0.0.1:7115"], linger=5, retransmit=0.1,
+                               lease_ttl=0.6)
+    a.start()
+    b.start()
+    try:
+        a.acquire("k", 2)
+        a.check("k")                       # fresh lease: fine
+        a.release("k")
+        a.acquire("k", 2)
+        assert a.fast_hits == 1
+        time.sleep(0.5)                    # held past three quarters of the lease
+        try:
+            a.check("k")
+            assert False, "write allowed on an expiring lease"
+        except LockTimeout:
+            pass
+        a.release("k")
+        print("PASS: a hold that outlives its lease is refused before the commit")
+
+        # the cache never outlives the lease: the next hold asks the peers again
+        a.acquire("k", 2)
+        assert a.fast_hits == 1
+        a.check("k")
+        a.release("k")
+        time.sleep(0.4)
+        a.acquire("k", 2)
+        assert a.fast_hits == 1, a.fast_hits
+        a.release("k")
+        # a cached hold found short of lease on the fast path is renewed, not reused
+        time.sleep(0.05)
+        r = a.node.resource("k")
+        a.loop.call_soon_threadsafe(lambda: setattr(r, "lease_until", a.node.now() + 0.1))
+        time.sleep(0.05)
+        a.acquire("k", 2)
+        a.check("k")
+        assert (a.fast_hits, a.renewals) == (1, 1), (a.fast_hits, a.renewals)
+        a.release("k")
+        print("PASS: cached holds are dropped before their lease runs out")
+    finally:
+        a.close()
+        b.close()
+
+def test_distributed_file_lock():
+    run_replicas()
+
+def test_backend_config():
+    run_config()
+
+def test_lease():
+    run_lease()
+
+if __name__ == "__main__":
+    test_distributed_file_lock()
+    test_backend_config()
+    test_lease()
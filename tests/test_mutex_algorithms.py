@@ -0,0 +1,30 @@
+import asyncio
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dist_mutex import grid_quorum
+from bench_mutex import run_one
+from ricart_agrawala import ALGORITHMS
+
+def check_quorums():
+    for n in range(1, 30):
+        members = [("127.0.0.1", 7000 + i) for i in range(n)]
+        qs = [set(grid_quorum(members, m)) for m in members]
+        assert all(a & b for a in qs for b in qs), n
+        assert max(map(len, qs)) <= 2 * (int(n ** 0.5) + 1)
+    print("PASS: grid quorums pairwise intersect for N = 1..29")
+
+async def run_contention():
+    for algo in ALGORITHMS:
+        r = await run_one(algo, n=7, active=7, entries=5)
+        assert r["violations"] == 0, r
+        print(f"PASS: {algo}: 35 contended entries, {r['msgs_per_entry']:.1f} msgs/entry")
+
+def test_mutex_algorithms():
+    check_quorums()
+    asyncio.run(run_contention())
+
+if __name__ == "__main__":
+    test_mutex_algorithms()
@@ -0,0 +1,48 @@
+import asyncio
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricart_agrawala import RANode
+
+inside = []
+overlaps = []
+
+class QuickNode(RANode):
+    async def critical_section(self, rid=None):
+        if inside:
+            overlaps.append((inside[0], self.node_id))
+        inside.append(self.node_id)
+        await asyncio.sleep(0.01)
+        inside.remove(self.node_id)
+
+async def run_pipelined():
+    ports = [6101, 6102, 6103]
+    nodes = [QuickNode(i + 1, "127.0.0.1", p, [("127.0.0.1", q) for q in ports if q != p])
+             for i, p in enumerate(ports)]
+    servers = [asyncio.create_task(n.start_server()) for n in nodes]
+    await asyncio.sleep(0.1)
+
+    async def worker(n):
+        for _ in range(10):
+            await n.request_cs()
+
+    await asyncio.wait_for(asyncio.gather(*(worker(n) for n in nodes)), 20)
+
+    assert not overlaps, overlaps
+    # 30 CS entries, but each node opened exactly one connection per peer
+    connects = [ch.connects for n in nodes for ch in n.channels.values()]
+    assert connects == [1] * 6, connects
+    print("PASS: 30 CS entries, no overlap, connections per peer:", connects)
+
+    for n in nodes:
+        await n.close()
+    for t in servers:
+        t.cancel()
+
+def test_ra_pipelining():
+    asyncio.run(run_pipelined())
+
+if __name__ == "__main__":
+    test_ra_pipelining()
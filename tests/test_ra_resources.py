@@ -0,0 +1,51 @@
+import asyncio
+import sys
+import os
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricart_agrawala import RANode
+
+nodes = {}       # port -> node
+inside = {}      # resource -> node ids currently in its CS
+overlaps = []
+
+class LocalNode(RANode):
+    async def send_msg(self, h, p, msg):
+        # in-process delivery, one task per message like a real connection
+        asyncio.create_task(nodes[p].on_message(msg))
+
+    async def critical_section(self, rid=None):
+        holders = inside.setdefault(rid, [])
+        if holders:
+            overlaps.append((rid, holders[0], self.node_id))
+        holders.append(self.node_id)
+        await asyncio.sleep(0.1)
+        holders.remove(self.node_id)
+
+async def run_resources():
+    ports = [6201, 6202, 6203, 6204]
+    for i, p in enumerate(ports):
+        nodes[p] = LocalNode(i + 1, "127.0.0.1", p, [("127.0.0.1", q) for q in ports if q != p])
+
+    # disjoint resources: all four critical sections run at the same time
+    t0 = time.monotonic()
+    await asyncio.gather(*(n.request_cs(f"file{i}") for i, n in enumerate(nodes.values())))
+    disjoint = time.monotonic() - t0
+    assert disjoint < 0.2, disjoint
+
+    # one shared resource: strictly one at a time, including two local requests
+    t0 = time.monotonic()
+    await asyncio.gather(*(n.request_cs("shared") for n in nodes.values()),
+                         nodes[6201].request_cs("shared"))
+    shared = time.monotonic() - t0
+    assert shared >= 0.5 and not overlaps, (shared, overlaps)
+    assert all(n.resource("shared").state == "RELEASED" for n in nodes.values())
+    print(f"PASS: 4 disjoint resources in {disjoint:.2f}s, 5 entries on one resource in {shared:.2f}s")
+
+def test_per_resource_locks():
+    asyncio.run(run_resources())
+
+if __name__ == "__main__":
+    test_per_resource_locks()
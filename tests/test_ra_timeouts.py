@@ -0,0 +1,118 @@
+import asyncio
+import sys
+import os
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricart_agrawala import RANode
+
+nodes = {}       # port -> node
+down = set()     # ports whose traffic is dropped
+drop_next = []   # (src, dst) pairs: drop one message each
+cut = set()      # frozenset({a, b}): a partition between two ports
+
+class LossyNode(RANode):
+    async def send_msg(self, h, p, msg):
+        if self.port in down or p in down or frozenset((self.port, p)) in cut:
+            return
+        if (self.port, p) in drop_next:
+            drop_next.remove((self.port, p))
+            return
+        asyncio.create_task(nodes[p].on_message(dict(msg)))
+
+    async def critical_section(self, rid=None):
+        await asyncio.sleep(0.01)
+
+def cluster(ports=(6301, 6302, 6303), **kw):
+    nodes.clear()
+    down.clear()
+    cut.clear()
+    for i, p in enumerate(ports):
+        nodes[p] = LossyNode(i + 1, "127.0.0.1", p, [("127.0.0.1", q) for q in ports if q != p], **kw)
+        nodes[p].verbose = False
+    return [nodes[p] for p in ports]
+
+async def run_timeouts():
+    # 1. deadline: an unreachable peer makes acquire fail, not hang
+    n1, n2, n3 = cluster(acquire_timeout=0.3)
+    down.add(n3.port)
+    t0 = time.monotonic()
+    try:
+        await n1.acquire()
+        assert False, "acquired without node 3"
+    except asyncio.TimeoutError:
+        pass
+    assert 0.25 < time.monotonic() - t0 < 0.6 and n1.state == "RELEASED"
+    print("PASS: acquire gave up after", round(time.monotonic() - t0, 2), "s")
+
+    # 2. a lost REQUEST is resent
+    n1, n2, n3 = cluster(retransmit=0.05)
+    drop_next.append((n1.port, n2.port))
+    await asyncio.wait_for(n1.request_cs(), 1)
+    print("PASS: lost REQUEST retransmitted")
+
+    # 3. a crashed peer is suspected and skipped; later requests don't wait for it
+    n1, n2, n3 = cluster(retransmit=0.05, fd_timeout=0.2, lease_ttl=0.5)
+    down.add(n3.port)
+    t0 = time.monotonic()
+    await asyncio.wait_for(n1.request_cs(), 2)
+    first = time.monotonic() - t0
+    t0 = time.monotonic()
+    await asyncio.wait_for(n1.request_cs(), 2)
+    second = time.monotonic() - t0
+    assert first >= 0.2 and second < 0.1 and ("127.0.0.1", n3.port) in n1.suspected, (first, second)
+    print(f"PASS: dead peer excluded after {first:.2f}s, next entry took {second:.2f}s")
+
+    # 4. ... but not while it may still hold a lease we granted
+    n1, n2, n3 = cluster(retransmit=0.05, fd_timeout=0.1, lease_ttl=0.5)
+    await n3.acquire()          # n3 holds the CS, then goes silent
+    down.add(n3.port)
+    t0 = time.monotonic()
+    task = asyncio.create_task(n1.acquire())
+    await asyncio.sleep(0.3)
+    assert not task.done()
+    await asyncio.wait_for(task, 2)
+    assert time.monotonic() - t0 >= 0.45
+    print("PASS: silent holder waited out until its lease ended")
+
+    # 5. the hold itself is bounded
+    n1, n2, n3 = cluster(lease_ttl=0.2)
+    n1.critical_section = lambda rid=None: asyncio.sleep(10)
+    t0 = time.monotonic()
+    try:
+        await n1.request_cs()
+        assert False, "CS outlived its lease"
+    except asyncio.TimeoutError:
+        pass
+    assert time.monotonic() - t0 < 0.3 and n1.state == "RELEASED"
+    await asyncio.wait_for(n2.request_cs(), 1)
+    print("PASS: CS cut short at lease expiry and the lock passed on")
+
+    # 6. a partition: only a side with a majority may stop waiting for the other
+    timing = dict(retransmit=0.1, fd_timeout=0.3, lease_ttl=2, acquire_timeout=1.5)
+    a, b = cluster(ports=(6301, 6302), **timing)
+    cut.add(frozenset((a.port, b.port)))
+    results = await asyncio.gather(a.acquire(), b.acquire(), return_exceptions=True)
+    assert all(isinstance(x, asyncio.TimeoutError) for x in results), results
+    assert a.state == b.state == "RELEASED"
+    print("PASS: two halves of a partition both wait, neither holds the lock")
+
+    n1, n2, n3 = cluster(**timing)
+    cut.update({frozenset((n1.port, n2.port)), frozenset((n1.port, n3.port))})
+    minority = asyncio.create_task(n1.acquire())
+    await asyncio.wait_for(n2.acquire(), 1.5)     # n2 + n3 exclude n1
+    assert n2.state == "HELD" and n1.state == "WANTED"
+    await n2.release()
+    try:
+        await minority
+        assert False, "minority side acquired"
+    except asyncio.TimeoutError:
+        pass
+    print("PASS: majority side skips the cut-off node, minority side times out")
+
+def test_ra_timeouts():
+    asyncio.run(run_timeouts())
+
+if __name__ == "__main__":
+    test_ra_timeouts()
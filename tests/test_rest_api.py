@@ -0,0 +1,347 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m2_rest_api"))
+
+# a private database and blob store, set before the app modules read them
+_tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'app.db')}"
+os.environ["STORAGE_DIR"] = os.path.join(_tmp, "storage")
+os.environ["SCRUB_ENABLED"] = "0"
+
+from fastapi.testclient import TestClient
+
+import app as api
+import db
+import search
+import usage
+from admission import ConcurrencyPool, RateLimiter, classify
+from db import SessionLocal
+from mq import MqPublisher
+from sqlalchemy import text
+
+def upload(c, user, name="a.txt", data=b"hello", ctype="text/plain"):
+    return c.post("/files", files={"uploaded": (name, data, ctype)}, headers={"X-User-Id": user})
+
+def run_admission():
+    assert classify("POST", "/shares/x") == "upload"
+    assert classify("DELETE", "/files/x") == "upload"
+    assert classify("GET", "/shares/x") == "read"
+    assert classify("GET", "/health") is None
+
+    with TestClient(api.app) as c:
+        ctl = api.admission
+        saved_limiters, saved_pools = dict(ctl.limiters), dict(ctl.pools)
+        try:
+            # one write allowed, then the bucket is dry for a long time
+            ctl.limiters["upload"] = RateLimiter(rate=0.01, burst=1)
+            r = upload(c, "rl")
+            assert r.status_code == 201, r.text
+            r = upload(c, "rl")
+            assert r.status_code == 429 and int(r.headers["Retry-After"]) >= 1
+            # sharing is a write too, so it is limited with the uploads
+            r = c.post("/shares/x", json={"target_user_id": "bob"}, headers={"X-User-Id": "rl"})
+            assert r.status_code == 429
+            # other users and reads are unaffected
+            assert upload(c, "other").status_code == 201
+            assert c.get("/files", headers={"X-User-Id": "rl"}).status_code == 200
+            print("PASS: per-user write limit answers 429 with Retry-After, shares included")
+
+            # a write pool with no slots and no queue rejects at once
+            ctl.pools["upload"] = ConcurrencyPool("upload", limit=0, max_waiting=0, wait_timeout=0.1)
+            r = upload(c, "fresh")
+            assert r.status_code == 503 and int(r.headers["Retry-After"]) >= 1
+            assert c.get("/files", headers={"X-User-Id": "fresh"}).status_code == 200
+            assert c.get("/health").json()["admission"]["upload"]["rejected"] == 1
+            print("PASS: saturated write pool answers 503 with Retry-After, reads still served")
+        finally:
+            ctl.limiters.update(saved_limiters)
+            ctl.pools.update(saved_pools)
+
+def usage_of(c, user):
+    return c.get("/usage", headers={"X-User-Id": user}).json()
+
+def run_usage():
+    with TestClient(api.app) as c:
+        a = upload(c, "uma", data=b"x" * 100).json()
+        upload(c, "uma", name="b.txt", data=b"y" * 50)
+        u = usage_of(c, "uma")
+        assert (u["bytes_used"], u["file_count"], u["shared_with_count"]) == (150, 2, 0), u
+
+        r = c.put(f"/files/{a['id']}", files={"uploaded": ("a.txt", b"z" * 30, "text/plain")},
+                  headers={"X-User-Id": "uma", "If-Match": '"1"'})
+        assert r.status_code == 200, r.text
+        c.post(f"/shares/{a['id']}", json={"target_user_id": "umb"}, headers={"X-User-Id": "uma"})
+        assert usage_of(c, "uma")["bytes_used"] == 80
+        assert usage_of(c, "umb")["shared_with_count"] == 1
+        print("PASS: usage follows uploads, updates and shares")
+
+        saved = usage.QUOTA_BYTES, usage.QUOTA_FILES
+        try:
+            usage.QUOTA_BYTES, usage.QUOTA_FILES = 100, 0
+            assert upload(c, "uma", name="c.txt", data=b"q" * 20).status_code == 201
+            r = upload(c, "uma", name="d.txt", data=b"q" * 1)
+            assert r.status_code == 413, r.text
+            usage.QUOTA_BYTES, usage.QUOTA_FILES = 0, 3
+            assert upload(c, "uma", name="e.txt").status_code == 413
+            assert usage_of(c, "uma")["file_count"] == 3
+        finally:
+            usage.QUOTA_BYTES, usage.QUOTA_FILES = saved
+        print("PASS: byte and file quotas answer 413 and leave usage unchanged")
+
+    # two first requests for one user: the second must not fail on the insert
+    first, second, errors = SessionLocal(), SessionLocal(), []
+    usage.get_usage(first, "race")          # row inserted, not yet committed
+
+    def racer():
+        try:
+            usage.get_usage(second, "race")  # waits on first's write lock
+            second.commit()
+        except Exception as e:
+            errors.append(e)
+
+    t = threading.Thread(target=racer)
+    t.start()
+    time.sleep(0.2)
+    first.commit()
+    t.join(10)
+    first.close(); second.close()
+    assert not errors, errors
+    print("PASS: concurrent first usage lookups for one user both succeed")
+
+def names(c, user, **params):
+    r = c.get("/files/search", params=params, headers={"X-User-Id": user})
+    assert r.status_code == 200, r.text
+    return sorted(f["filename"] for f in r.json())
+
+def run_search():
+    with TestClient(api.app) as c:
+        upload(c, "sa", name="report_2024.pdf", ctype="application/pdf")
+        upload(c, "sa", name="notes.txt")
+        theirs = upload(c, "sb", name="report_bob.txt").json()
+        upload(c, "sb", name="private.txt")
+
+        assert names(c, "sa", q="rep") == ["report_2024.pdf"]
+        assert names(c, "sa", q="rep", prefix="false") == []
+        assert names(c, "sa", q="report 2024") == ["report_2024.pdf"]
+        # other users' files stay invisible until shared
+        c.post(f"/shares/{theirs['id']}", json={"target_user_id": "sa"}, headers={"X-User-Id": "sb"})
+        assert names(c, "sa", q="report") == ["report_2024.pdf", "report_bob.txt"]
+        assert names(c, "sa", q="report", scope="shared") == ["report_bob.txt"]
+        assert names(c, "sa", q="report", scope="owned") == ["report_2024.pdf"]
+        assert names(c, "sa", q="private") == []
+        print("PASS: FTS prefix/token matching limited to owned and shared files")
+
+        # an update reindexes the file in place, by rowid
+        mine = upload(c, "sc", name="ledger.txt").json()
+        r = c.put(f"/files/{mine['id']}", files={"uploaded": ("ledger.txt", b"v2", "text/plain")},
+                  headers={"X-User-Id": "sc", "If-Match": '"1"'})
+        assert r.status_code == 200, r.text
+        assert names(c, "sc", q="ledger") == ["ledger.txt"]
+        if search.FTS_ENABLED:
+            with db.engine.connect() as conn:
+                rows = conn.execute(text(
+                    "SELECT s.rowid, m.rowid FROM file_search s "
+                    "JOIN file_search_ids m ON m.file_id = s.file_id WHERE s.file_id = :id"),
+                    {"id": mine["id"]}).all()
+            assert len(rows) == 1 and rows[0][0] == rows[0][1], rows
+        print("PASS: reindexing replaces the file's row keyed by its rowid")
+
+        # wildcards in filters match literally
+        assert names(c, "sa", content_type="text/") == ["notes.txt", "report_bob.txt"]
+        assert names(c, "sa", content_type="%") == []
+        assert names(c, "sa", content_type="_ext/") == []
+        saved = search.FTS_ENABLED
+        try:
+            search.FTS_ENABLED = False   # the LIKE fallback
+            assert names(c, "sa", q="report") == ["report_2024.pdf", "report_bob.txt"]
+            assert names(c, "sa", q="t_t") == []   # would match "txt" unescaped
+        finally:
+            search.FTS_ENABLED = saved
+        print("PASS: LIKE wildcards from user input are escaped")
+
+class FakeChannel:
+    def __init__(self, sent, fail_at=None):
+        self.sent, self.fail_at, self.n = sent, fail_at, 0
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.n += 1
+        if self.n == self.fail_at:
+            raise ConnectionError("broker went away")
+        self.sent.append(body)
+
+class FakeConn:
+    def process_data_events(self, t):
+        pass
+
+    def close(self):
+        pass
+
+class FlakyPublisher(MqPublisher):
+    """The first connection drops on its second publish."""
+    def __init__(self):
+        super().__init__()
+        self.sent, self.connects = [], 0
+
+    def _connect(self):
+        self.connects += 1
+        return FakeConn(), FakeChannel(self.sent, fail_at=2 if self.connects == 1 else None)
+
+def run_startup():
+    # the in-flight message is retried first after a reconnect, keeping order
+    pub = FlakyPublisher()
+    for i in range(4):
+        pub.publish(f"file.updated id=f version={i}")
+    pub.start()
+    deadline = time.monotonic() + 5
+    while len(pub.sent) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pub.close()
+    assert pub.connects == 2 and pub.sent == [f"file.updated id=f version={i}" for i in range(4)], pub.sent
+    print("PASS: publisher keeps event order across a reconnect")
+
+    # close() gives up on a thread stuck connecting; a restart must not revive it
+    gate, publishers, connects = threading.Event(), [], []
+
+    class StuckPublisher(MqPublisher):
+        def _connect(self):
+            connects.append(1)
+            if len(connects) == 1:
+                gate.wait(10)
+            return FakeConn(), StampChannel()
+
+    class StampChannel(FakeChannel):
+        def __init__(self):
+            super().__init__([])
+
+        def basic_publish(self, exchange, routing_key, body):
+            publishers.append(threading.current_thread())
+
+    pub = StuckPublisher()
+    pub.start()
+    first = pub._thread
+    pub.close()                       # join times out: `first` is still connecting
+    pub.start()
+    gate.set()
+    for i in range(3):
+        pub.publish(f"file.updated id=g version={i}")
+    first.join(5)
+    deadline = time.monotonic() + 5
+    while len(publishers) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    second = pub._thread
+    pub.close()
+    assert not first.is_alive() and publishers == [second] * 3, publishers
+    print("PASS: a publisher thread that outlived close() stays stopped after a restart")
+
+    # lifespan: schema, publisher thread and shutdown
+    with TestClient(api.app) as c:
+        assert api.publisher._thread is not None and api.publisher._thread.is_alive()
+        assert c.get("/health").json()["mq_connected"] is False   # no broker here
+        with db.engine.connect() as conn:
+            assert conn.execute(text("PRAGMA user_version")).scalar() == db.SCHEMA_VERSION
+    assert api.publisher._thread is None
+    print("PASS: lifespan starts and stops the publisher, schema is current")
+
+    # schema check: current DB -> no create_all; stale version -> one upgrade
+    calls = []
+    create_all = db.Base.metadata.create_all
+    db.Base.metadata.create_all = lambda **kw: (calls.append(1), create_all(**kw))
+    try:
+        db._schema_ready = False
+        db.init_schema(); db.init_schema()
+        assert calls == []
+        with db.engine.begin() as conn:
+            conn.execute(text("PRAGMA user_version = 0"))
+        db._schema_ready = False
+        db.init_schema(); db.init_schema()
+        assert calls == [1]
+        with db.engine.connect() as conn:
+            assert conn.execute(text("PRAGMA user_version")).scalar() == db.SCHEMA_VERSION
+    finally:
+        db.Base.metadata.create_all = create_all
+    print("PASS: schema creation skipped while PRAGMA user_version is current")
+
+def run_storage():
+    with TestClient(api.app) as c:
+        f = upload(c, "st", data=b"old content").json()
+        put = lambda: c.put(f"/files/{f['id']}", files={"uploaded": ("a.txt", b"new", "text/plain")},
+                            headers={"X-User-Id": "st", "If-Match": '"1"'})
+
+        def content():
+            listed = c.get("/files", headers={"X-User-Id": "st"}).json()
+            version = [x["version"] for x in listed if x["id"] == f["id"]][0]
+            return version, c.get(f"/files/{f['id']}", headers={"X-User-Id": "st"}).content
+
+        # the blob can't be moved into place: nothing is committed
+        publish = api.publish_blob
+        def broken_publish(tmp, fid):
+            raise OSError("disk full")
+        api.publish_blob = broken_publish
+        try:
+            assert put().status_code == 500
+        finally:
+            api.publish_blob = publish
+        assert content() == (1, b"old content")
+
+        # the commit fails after the swap: the old blob is put back
+        def failing_db():
+            s = SessionLocal()
+            def commit():
+                raise OSError("database is locked")
+            s.commit = commit
+            try:
+                yield s
+            finally:
+                s.close()
+        api.app.dependency_overrides[api.get_db] = failing_db
+        try:
+            assert put().status_code == 500
+        finally:
+            api.app.dependency_overrides.clear()
+        assert content() == (1, b"old content")
+        assert put().status_code == 200 and content() == (2, b"new")
+        assert not [n for n in os.listdir(os.environ["STORAGE_DIR"]) if n.startswith(".tmp-")]
+        print("PASS: blob on disk always matches the committed version")
+
+        # scrubber findings: admins see all, others only their own files
+        other = upload(c, "st2").json()
+        saved = api.scrubber.report
+        api.scrubber.report = {"status": "ok", "corrupt": [{"file_id": f["id"], "problem": "x"},
+                                                           {"file_id": other["id"], "problem": "x"}],
+                               "missing": [other["id"]]}
+        try:
+            mine = c.get("/maintenance/storage", headers={"X-User-Id": "st"}).json()
+            assert [x["file_id"] for x in mine["corrupt"]] == [f["id"]] and mine["missing"] == []
+            api.ADMIN_USERS.add("root")
+            everything = c.get("/maintenance/storage", headers={"X-User-Id": "root"}).json()
+            assert len(everything["corrupt"]) == 2 and everything["missing"] == [other["id"]]
+        finally:
+            api.scrubber.report = saved
+            api.ADMIN_USERS.discard("root")
+        print("PASS: storage report limited to the caller's files unless admin")
+
+def test_admission():
+    run_admission()
+
+def test_usage():
+    run_usage()
+
+def test_search():
+    run_search()
+
+def test_startup():
+    run_startup()
+
+def test_storage():
+    run_storage()
+
+if __name__ == "__main__":
+    test_admission()
+    test_usage()
+    test_search()
+    test_startup()
+    test_storage()
@@ -0,0 +1,47 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from simulator import Simulator
+
+def run(seed):
+    sim = Simulator(nodes=40, seed=seed, loss=0.01)
+    report = sim.run(warmup=10, updates=5, update_interval=0.5, max_time=30,
+                     partition_at=1, heal_at=6)
+    report.pop("wall_seconds")
+    return report
+
+def test_simulator_deterministic_and_converges():
+    a, b = run(3), run(3)
+    assert a == b, "same seed must give the same run"
+    conv = a["convergence"]
+    assert conv["converged"] == conv["updates"] == 5, conv
+    # the partition healed into one overlay again
+    assert a["overlay"]["components"] == 1, a["overlay"]
+    print("PASS: deterministic run, all updates converged:", conv)
+
+def run_overlay(nodes, seed):
+    sim = Simulator(nodes=nodes, seed=seed)
+    report = sim.run(warmup=10, updates=3, update_interval=0.5, max_time=30)
+    return report["overlay"]
+
+def test_overlay_connected_and_symmetric():
+    for nodes, seed in [(500, 1), (200, 2)]:
+        o = run_overlay(nodes, seed)
+        assert o["components"] == 1, o
+        # every active entry is mirrored and has an open connection at both ends
+        assert o["asymmetric"] == 0 and o["unbacked"] == 0, o
+        print(f"PASS: {nodes} nodes (seed {seed}) form one overlay of symmetric, live links:", o)
+
+def test_push_alone_reaches_overlay():
+    # anti-entropy effectively off: whatever holds the update got it by push
+    sim = Simulator(nodes=200, seed=1, fanout=3, ttl=6, gossip_interval=1e6)
+    conv = sim.run(warmup=10, updates=10, update_interval=0.5, max_time=10)["convergence"]
+    assert conv["reach_mean"] >= 0.99 and conv["reach_min"] >= 0.98, conv
+    print("PASS: push with fanout 3 and TTL 6 reaches >= 99% of 200 nodes:", conv)
+
+if __name__ == "__main__":
+    test_simulator_deterministic_and_converges()
+    test_overlay_connected_and_symmetric()
+    test_push_alone_reaches_overlay()
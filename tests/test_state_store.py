@@ -0,0 +1,120 @@
+import asyncio
+import sys
+import os
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from p2p_peer import Peer
+from state_store import StateStore, CLOCK_RESERVE
+
+def fresh_dir():
+    return tempfile.mkdtemp()
+
+def run_torn_tail():
+    d = fresh_dir()
+    s = StateStore(d)
+    s.append("a", 1, 5)
+    s.append("b", 2, 6, {"vv": {"x:1": 2}, "hlc": [1, 0], "by": "x:1"})
+    s.append("a", 3, 7)
+    s.close()
+    with open(s.log_path, "a", encoding="utf-8") as f:
+        f.write('{"f":"a","v":9,"c":')       # crash mid-write
+    files, peers, clock, meta = StateStore(d).load()
+    assert files == {"a": 3, "b": 2} and clock == 7 and meta["b"]["vv"] == {"x:1": 2}
+    print("PASS: torn last log line ignored, earlier records replayed")
+
+def run_compaction():
+    d = fresh_dir()
+    s = StateStore(d, compact_every=3)
+    for i in range(3):
+        s.append(f"f{i}", i + 1, i + 1)
+    assert s.needs_compaction()
+    s.snapshot({"f0": 1, "f1": 2, "f2": 3}, ["10.0.0.1:9001"], 3)
+    assert not s.needs_compaction()
+    assert not os.path.exists(s.log_path) and not os.path.exists(s.rotated_path)
+    s.append("f0", 4, 4)
+    s.close()
+    files, peers, clock, _ = StateStore(d).load()
+    assert files == {"f0": 4, "f1": 2, "f2": 3} and peers == ["10.0.0.1:9001"] and clock == 4
+    print("PASS: snapshot truncates the log, restore = snapshot + log")
+
+    # crash after the log was rotated but before the snapshot reached disk
+    s = StateStore(d)
+    s.load()
+    s.append("f1", 5, 5)
+    s.begin_snapshot({"f0": 4, "f1": 5, "f2": 3}, [], 5)
+    s.append("f2", 6, 6)                     # keeps going while the snapshot is written
+    s.close()
+    files, _, clock, _ = StateStore(d).load()
+    assert files == {"f0": 4, "f1": 5, "f2": 6} and clock == 6
+    # the next snapshot folds the leftover rotated log in
+    s = StateStore(d)
+    files, peers, clock, meta = s.load()
+    s.snapshot(files, peers, clock, meta)
+    assert not os.path.exists(s.rotated_path)
+    assert StateStore(d).load()[0] == {"f0": 4, "f1": 5, "f2": 6}
+    print("PASS: an unfinished snapshot loses nothing")
+
+    # a background write overtaken by the final snapshot must not replace it
+    d = fresh_dir()
+    s = StateStore(d)
+    s.append("a", 1, 1)
+    older = s.begin_snapshot({"a": 1}, [], 1)
+    s.append("a", 2, 2)
+    newer = s.begin_snapshot({"a": 2}, [], 2)
+    s.finish_snapshot(newer)
+    s.finish_snapshot(older)
+    assert StateStore(d).load()[:3] == ({"a": 2}, [], 2)
+    print("PASS: an older snapshot finishing late is skipped")
+
+    # the older one finishes first: records rotated for the newer one are kept
+    d = fresh_dir()
+    s = StateStore(d)
+    s.append("a", 1, 1)
+    older = s.begin_snapshot({"a": 1}, [], 1)
+    s.append("a", 2, 2)
+    s.begin_snapshot({"a": 2}, [], 2)        # never finished: crash
+    s.finish_snapshot(older)
+    assert os.path.exists(s.rotated_path)
+    assert StateStore(d).load()[:3] == ({"a": 2}, [], 2)
+    print("PASS: only the newest snapshot drops the rotated log")
+
+def run_clock_restore():
+    async def scenario():
+        d = fresh_dir()
+        sent = []
+
+        class Sink:
+            async def send(self, obj):
+                sent.append(obj["ts"])
+
+        p = Peer("127.0.0.1", 9401, set(), store=StateStore(d))
+        for _ in range(50):
+            await p._send(Sink(), {"type": "ping"})
+        # a message from far ahead moves the clock without any update being logged
+        await p._on_msg({"type": "ping", "ts": 3 * CLOCK_RESERVE}, None)
+        await p._send(Sink(), {"type": "ping"})
+        p.store.close()                      # crash: no final snapshot
+
+        q = Peer("127.0.0.1", 9401, set(), store=StateStore(d))
+        await q._send(Sink(), {"type": "ping"})
+        assert sent[-1] > max(sent[:-1]), sent[-3:]
+        q.store.close()
+
+    asyncio.run(scenario())
+    print("PASS: restarted peer never reuses a Lamport timestamp")
+
+def test_torn_tail():
+    run_torn_tail()
+
+def test_compaction():
+    run_compaction()
+
+def test_clock_restore():
+    run_clock_restore()
+
+if __name__ == "__main__":
+    test_torn_tail()
+    test_compaction()
+    test_clock_restore()
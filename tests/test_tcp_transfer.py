@@ -0,0 +1,285 @@
+import hashlib
+import os
+import pathlib
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tcpserver_nonblocking
+from tcpserver_nonblocking import serve
+from tcpclient_nonblocking import (send_file, send_file_parallel, request, read_reply, transfer_id,
+                                   build_manifest)
+from transfer_protocol import (v1_header, v3_open, v3_range, v3_request, OP_COMMIT,
+                               ST_OK, ST_BAD, ST_MISSING, unpack_ranges)
+
+def send_v1(port, name, data, md5=None):
+    md5 = md5 or hashlib.md5(data).digest()
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(v1_header(name, len(data), md5))
+        s.sendall(data)
+        return s.recv(3)
+
+def run_concurrent(port=5101):
+    save = tempfile.mkdtemp()
+    stop, ready = threading.Event(), threading.Event()
+    srv = threading.Thread(target=serve, args=("127.0.0.1", port, save),
+                           kwargs=dict(max_conns=4, stats_interval=60, stop=stop, ready=ready))
+    srv.start()
+    ready.wait(5)
+    try:
+        blobs = {f"f{i}.bin": os.urandom(200_000 + i) for i in range(20)}
+        results = {}
+        def client(name):
+            results[name] = send_v1(port, name, blobs[name])
+        threads = [threading.Thread(target=client, args=(n,)) for n in blobs]
+        for t in threads: t.start()
+        for t in threads: t.join(30)
+        assert all(r == b"OK" for r in results.values()) and len(results) == 20, results
+        for name, data in blobs.items():
+            with open(os.path.join(save, name), "rb") as f:
+                assert f.read() == data
+        print("PASS: 20 concurrent transfers through 4 slots")
+
+        assert send_v1(port, "bad.bin", b"x" * 1000, md5=b"\0" * 16) == b"BAD"
+        assert send_v1(port, "../escape.bin", b"y") == b"OK"
+        assert os.path.exists(os.path.join(save, "escape.bin"))
+        print("PASS: corrupt transfer answered BAD, names confined to save dir")
+
+        big = os.path.join(tempfile.mkdtemp(), "big.bin")
+        with open(big, "wb") as f:
+            f.write(os.urandom(8 * 1024 * 1024 + 7))
+        assert send_file("127.0.0.1", port, big) == "OK"
+        with open(big, "rb") as a, open(os.path.join(save, "big.bin"), "rb") as b:
+            assert a.read() == b.read()
+        print("PASS: 8 MiB streamed with sendfile and a trailing digest")
+    finally:
+        stop.set()
+        srv.join(5)
+
+def start_server(port, save):
+    stop, ready = threading.Event(), threading.Event()
+    srv = threading.Thread(target=serve, args=("127.0.0.1", port, save),
+                           kwargs=dict(stats_interval=60, stop=stop, ready=ready))
+    srv.start()
+    ready.wait(5)
+    return stop, srv
+
+def run_resume(ports=(5102, 5103)):
+    save = tempfile.mkdtemp()
+    path = pathlib.Path(tempfile.mkdtemp()) / "resume.bin"
+    data = bytearray(os.urandom(8 * 1024 * 1024 + 7))
+    path.write_bytes(data)
+    tid, mib, chunk = transfer_id(path), 1024 * 1024, 256 * 1024
+    digests = build_manifest(path, len(data), chunk)
+
+    # an interrupted run: the first MiB arrives, the second with one corrupt chunk, then the server stops
+    stop, srv = start_server(ports[0], save)
+    try:
+        with socket.create_connection(("127.0.0.1", ports[0])) as s:
+            opened = request(s, v3_open(tid, path.name, len(data), chunk, digests, root=True))
+            assert opened == (ST_OK, b"\0\0\0\0")
+            assert request(s, v3_range(tid, 0, mib) + bytes(data[:mib]))[0] == ST_OK
+            corrupt = bytearray(data[mib:2 * mib]); corrupt[chunk + 5] ^= 0xFF
+            status, failed = request(s, v3_range(tid, mib, mib) + bytes(corrupt))
+            assert status == ST_BAD and unpack_ranges(failed) == [(mib + chunk, mib + 2 * chunk)]
+            status, gaps = request(s, v3_request(OP_COMMIT, tid))
+            assert status == ST_MISSING
+            assert unpack_ranges(gaps) == [(mib + chunk, mib + 2 * chunk), (2 * mib, len(data))]
+        assert not os.path.exists(os.path.join(save, path.name))
+        print("PASS: corrupt chunk refused alone, COMMIT reports the gaps")
+    finally:
+        stop.set()
+        srv.join(5)
+
+    # damage a verified chunk on disk: only the root check at COMMIT can catch it
+    with open(os.path.join(save, ".partial", tid.hex() + ".part"), "r+b") as f:
+        f.seek(10); f.write(bytes([data[10] ^ 0xFF]))
+
+    # a new server on the same directory still knows the verified chunks
+    stop, srv = start_server(ports[1], save)
+    try:
+        r = send_file_parallel("127.0.0.1", ports[1], path, streams=4, block=mib,
+                               chunk_size=chunk, root=True)
+        # the missing data, the corrupt chunk, and chunk 0 again after the root check
+        sent = len(data) - 2 * mib + 2 * chunk
+        assert r == {"status": "OK", "sent": sent, "skipped": 2 * mib - chunk}, r
+        with open(os.path.join(save, path.name), "rb") as f:
+            assert f.read() == data
+        assert not os.listdir(os.path.join(save, ".partial"))
+        print("PASS: resumed after a server restart over 4 streams, resending only bad chunks")
+    finally:
+        stop.set()
+        srv.join(5)
+
+def run_idle(port=5104):
+    save = tempfile.mkdtemp()
+    stop, ready, result = threading.Event(), threading.Event(), []
+    srv = threading.Thread(target=lambda: result.append(serve(
+        "127.0.0.1", port, save, max_conns=2, stats_interval=60, stop=stop, ready=ready,
+        idle_timeout=0.5)))
+    srv.start()
+    ready.wait(5)
+    try:
+        # one client stalls mid-header, another keeps an idle TXF3 connection: both slots taken
+        stalled = socket.create_connection(("127.0.0.1", port))
+        stalled.sendall(b"\0\0")
+        kept = socket.create_connection(("127.0.0.1", port))
+        path = pathlib.Path(tempfile.mkdtemp()) / "kept.bin"
+        path.write_bytes(os.urandom(300_000))
+        tid = transfer_id(path)
+        assert request(kept, v3_open(tid, path.name, 300_000, 65536,
+                                     build_manifest(path, 300_000, 65536)))[0] == ST_OK
+        assert request(kept, v3_range(tid, 0, 300_000) + path.read_bytes())[0] == ST_OK
+        assert request(kept, v3_request(OP_COMMIT, tid))[0] == ST_OK
+        t0 = time.monotonic()
+        assert send_v1(port, "late.bin", b"z" * 1000) == b"OK"
+        assert time.monotonic() - t0 < 3
+        assert stalled.recv(1) == b"" and kept.recv(1) == b""
+        stalled.close(); kept.close()
+        print("PASS: idle connections dropped after the deadline, their slots reused")
+    finally:
+        stop.set()
+        srv.join(5)
+    stats = result[0]
+    # two files saved; only the client that stalled mid-request counts as failed
+    assert (stats.done, stats.failed) == (2, 1), (stats.done, stats.failed)
+    print("PASS: done counts saved files, not closed connections")
+
+def run_overwrite(port=5106):
+    save = tempfile.mkdtemp()
+    path = pathlib.Path(tempfile.mkdtemp()) / "overwrite.bin"
+    data = os.urandom(300_000)
+    path.write_bytes(data)
+    tid, chunk = transfer_id(path), 65536
+    stop, srv = start_server(port, save)
+    try:
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            # no root: COMMIT trusts the recorded ranges
+            opened = request(s, v3_open(tid, path.name, len(data), chunk,
+                                        build_manifest(path, len(data), chunk)))
+            assert opened[0] == ST_OK
+            assert request(s, v3_range(tid, 0, len(data)) + data)[0] == ST_OK
+            corrupt = bytearray(data[:chunk]); corrupt[7] ^= 0xFF
+            status, failed = request(s, v3_range(tid, 0, chunk) + bytes(corrupt))
+            assert status == ST_BAD and unpack_ranges(failed) == [(0, chunk)]
+            status, gaps = request(s, v3_request(OP_COMMIT, tid))
+            assert status == ST_MISSING and unpack_ranges(gaps) == [(0, chunk)], (status, gaps)
+            assert request(s, v3_range(tid, 0, chunk) + data[:chunk])[0] == ST_OK
+            assert request(s, v3_request(OP_COMMIT, tid))[0] == ST_OK
+        assert (pathlib.Path(save) / path.name).read_bytes() == data
+        print("PASS: a verified chunk overwritten with bad data is no longer counted")
+    finally:
+        stop.set()
+        srv.join(5)
+
+def run_slow_disk(port=5105):
+    # preallocation and the per-range fsync take a second each on this "disk"
+    allocate, verified = tcpserver_nonblocking.Upload.allocate, tcpserver_nonblocking.Upload.verified
+    def slow(f):
+        return lambda self, *a: (time.sleep(1.0), f(self, *a))[1]
+    tcpserver_nonblocking.Upload.allocate, tcpserver_nonblocking.Upload.verified = slow(allocate), slow(verified)
+    save = tempfile.mkdtemp()
+    stop, srv = start_server(port, save)
+    try:
+        path = pathlib.Path(tempfile.mkdtemp()) / "slow.bin"
+        path.write_bytes(os.urandom(200_000))
+        tid, digests = transfer_id(path), build_manifest(path, 200_000, 65536)
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            for req in (v3_open(tid, path.name, 200_000, 65536, digests),
+                        v3_range(tid, 0, 200_000) + path.read_bytes()):
+                s.sendall(req)
+                time.sleep(0.1)   # the slow job has started
+                t0 = time.monotonic()
+                assert send_v1(port, "quick.bin", b"q") == b"OK"
+                assert time.monotonic() - t0 < 0.5, time.monotonic() - t0
+                assert read_reply(s)[0] == ST_OK
+            assert request(s, v3_request(OP_COMMIT, tid))[0] == ST_OK
+        assert (pathlib.Path(save) / path.name).read_bytes() == path.read_bytes()
+        print("PASS: other clients served while an upload waits on the disk")
+    finally:
+        tcpserver_nonblocking.Upload.allocate, tcpserver_nonblocking.Upload.verified = allocate, verified
+        stop.set()
+        srv.join(5)
+
+def run_commit_race(port=5107):
+    save = tempfile.mkdtemp()
+    path = pathlib.Path(tempfile.mkdtemp()) / "race.bin"
+    data = os.urandom(200_000)
+    path.write_bytes(data)
+    tid, chunk = transfer_id(path), 65536
+    stop, srv = start_server(port, save)
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as a, \
+                socket.create_connection(("127.0.0.1", port), timeout=10) as b:
+            assert request(a, v3_open(tid, path.name, len(data), chunk,
+                                      build_manifest(path, len(data), chunk)))[0] == ST_OK
+            assert request(a, v3_range(tid, 0, len(data)) + data)[0] == ST_OK
+            # b is halfway through resending a range when a commits the upload
+            b.sendall(v3_range(tid, 0, chunk) + data[:chunk // 2])
+            time.sleep(0.1)
+            assert request(a, v3_request(OP_COMMIT, tid))[0] == ST_OK
+            assert request(b, data[chunk // 2:chunk])[0] == ST_BAD
+        assert (pathlib.Path(save) / path.name).read_bytes() == data
+        assert send_v1(port, "after.bin", b"still up") == b"OK"
+        print("PASS: a range racing a COMMIT is refused, the server keeps running")
+    finally:
+        stop.set()
+        srv.join(5)
+
+def run_long_data_phase(port=5108):
+    # every range waits on a slow fsync: the data phase outlasts the idle deadline
+    verified = tcpserver_nonblocking.Upload.verified
+    tcpserver_nonblocking.Upload.verified = lambda self, *a: (time.sleep(0.4), verified(self, *a))[1]
+    save = tempfile.mkdtemp()
+    stop, ready = threading.Event(), threading.Event()
+    srv = threading.Thread(target=serve, args=("127.0.0.1", port, save),
+                           kwargs=dict(stats_interval=60, stop=stop, ready=ready, idle_timeout=1.0))
+    srv.start()
+    ready.wait(5)
+    try:
+        path = pathlib.Path(tempfile.mkdtemp()) / "long.bin"
+        data = os.urandom(6 * 65536)
+        path.write_bytes(data)
+        t0 = time.monotonic()
+        r = send_file_parallel("127.0.0.1", port, path, streams=1, block=65536, chunk_size=65536)
+        assert r["status"] == "OK" and time.monotonic() - t0 > 2.0, r
+        assert (pathlib.Path(save) / path.name).read_bytes() == data
+        print("PASS: COMMIT succeeds after a data phase longer than the idle deadline")
+    finally:
+        tcpserver_nonblocking.Upload.verified = verified
+        stop.set()
+        srv.join(5)
+
+def test_tcp_transfer():
+    run_concurrent()
+
+def test_tcp_overwrite():
+    run_overwrite()
+
+def test_tcp_commit_race():
+    run_commit_race()
+
+def test_tcp_long_data_phase():
+    run_long_data_phase()
+
+def test_tcp_slow_disk():
+    run_slow_disk()
+
+def test_tcp_idle():
+    run_idle()
+
+def test_tcp_resume():
+    run_resume()
+
+if __name__ == "__main__":
+    test_tcp_transfer()
+    test_tcp_idle()
+    test_tcp_overwrite()
+    test_tcp_slow_disk()
+    test_tcp_commit_race()
+    test_tcp_long_data_phase()
+    test_tcp_resume()
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+from p2p_peer import Peer
+
+# Loopback "connection": each message is delivered to the other peer as a new task
+class Loopback:
+    def __init__(self, target, key):
+        self.target = target
+        self.key = key          # remote address, as Connection.key
+        self.reply = None
+
+    async def send(self, obj):
+        asyncio.create_task(self.target._on_msg(json.loads(json.dumps(obj)), self.reply))
+
+def link(a, b):
+    ab, ba = Loopback(b, (b.host, b.port)), Loopback(a, (a.host, a.port))
+    ab.reply, ba.reply = ba, ab
+    a.connections[(b.host, b.port)] = ab
+    b.connections[(a.host, a.port)] = ba
+    return ab
+
+async def run_concurrent_writes():
+    a = Peer("127.0.0.1", 9401, set())
+    b = Peer("127.0.0.1", 9402, set())
+    c = Peer("127.0.0.1", 9403, set())
+
+    # all three start from the same server version, then write while partitioned
+    for p in (a, b, c):
+        p._set_version("doc", 3)
+    a.local_write("doc")
+    b.local_write("doc")
+    b.local_write("doc")
+    c.local_write("doc")
+    await asyncio.sleep(0)
+
+    # heal: anti-entropy a<->b, then b<->c, then a<->b again
+    for x, y in ((a, b), (b, c), (a, b)):
+        await link(x, y).send({"type": "digest", "from": x.addr, "root": x.digest.root()})
+        await asyncio.sleep(0.05)
+
+    assert a.vclocks["doc"] == b.vclocks["doc"] == c.vclocks["doc"], \
+        (a.vclocks, b.vclocks, c.vclocks)
+    assert a.files["doc"] == b.files["doc"] == c.files["doc"] == 3 + 4
+    # each conflict is resolved once, where the concurrent states first meet
+    assert a.conflicts + b.conflicts + c.conflicts >= 2
+    winner = a.vclocks["doc"]["by"]
+    print("PASS: concurrent writes converged, vv =", a.vclocks["doc"]["vv"],
+          "winner", winner, "conflicts", (a.conflicts, b.conflicts, c.conflicts))
+
+    # a write made after seeing everything dominates: no new conflict
+    before = (a.conflicts, c.conflicts)
+    c.local_write("doc")
+    await asyncio.sleep(0.05)
+    assert a.vclocks["doc"] == c.vclocks["doc"] and a.vclocks["doc"]["by"] == c.addr
+    assert (a.conflicts, c.conflicts) == before
+    print("PASS: dominating write accepted without conflict")
+
+async def run_server_version_collision():
+    x = Peer("127.0.0.1", 9411, set())
+    y = Peer("127.0.0.1", 9412, set())
+    for p in (x, y):
+        p._set_version("doc", 3)
+    # y forks locally (vv {"_": 3, y: 1} is v4) while the server's v4 reaches x
+    assert y.local_write("doc") == 4
+    await x._on_msg({"type": "event", "file_id": "doc", "version": 4}, None)
+    await asyncio.sleep(0)
+    assert x.files["doc"] == y.files["doc"] == 4 and "doc" in y.vclocks
+
+    for a, b in ((x, y), (y, x)):
+        await link(a, b).send({"type": "digest", "from": a.addr, "root": a.digest.root()})
+        await asyncio.sleep(0.05)
+    # same number, different histories: both settle on the server's version
+    assert x.files["doc"] == y.files["doc"] == 4
+    assert "doc" not in x.vclocks and "doc" not in y.vclocks
+    assert x.digest.root() == y.digest.root()
+    assert y.conflicts == 1
+    print("PASS: server version and local write at the same number converge")
+
+def test_version_vectors():
+    asyncio.run(run_concurrent_writes())
+
+def test_server_version_collision():
+    asyncio.run(run_server_version_collision())
+
+if __name__ == "__main__":
+    test_version_vectors()
+    test_server_version_collision()
@@ -0,0 +1,64 @@
+import asyncio
+import sys
+import os
+import zlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "m3_p2p"))
+
+import wire
+
+def test_mixed_stream_roundtrip():
+    """A reader must accept legacy JSON lines and binary frames on the same stream."""
+    async def run():
+        big = {"type": "entries", "files": {f"file_{i}": i for i in range(2000)}}
+        reader = asyncio.StreamReader()
+        reader.feed_data(wire.encode_line({"type": "hello", "from": "127.0.0.1:9001"}))
+        reader.feed_data(wire.encode_frame([{"type": "ping"}, {"type": "digest", "root": "ab"}], "json"))
+        frame = wire.encode_frame([big], "json")
+        reader.feed_data(frame)
+        reader.feed_eof()
+
+        got = []
+        while True:
+            msgs = await wire.read_messages(reader)
+            if msgs is None:
+                break
+            got.append(msgs)
+
+        assert [len(m) for m in got] == [1, 2, 1]
+        assert got[0][0]["type"] == "hello"
+        assert got[1][1] == {"type": "digest", "root": "ab"}
+        assert got[2][0] == big
+        # large state frame was compressed
+        assert frame[1] & wire.FLAG_ZLIB
+        print("PASS: JSON line + batched + compressed frames decoded;", len(frame), "byte state frame")
+
+    asyncio.run(run())
+
+def test_negotiation_falls_back_to_json_lines():
+    assert wire.negotiate(None) is None                       # legacy peer, no "wire" field
+    assert wire.negotiate({"frames": 1, "codecs": ["json"]}) == "json"
+    assert wire.negotiate({"frames": 1, "codecs": ["cbor"]}) is None
+    print("PASS: handshake negotiation")
+
+def test_compressed_frame_size_is_bounded():
+    async def run(payload):
+        reader = asyncio.StreamReader()
+        reader.feed_data(wire.HEADER.pack(wire.MAGIC, wire.FLAG_ZLIB, len(payload)) + payload)
+        reader.feed_eof()
+        try:
+            await wire.read_messages(reader)
+            assert False, "frame accepted"
+        except ValueError:
+            pass
+
+    bomb = zlib.compress(b" " * (wire.MAX_FRAME + 1), 9)
+    assert len(bomb) < wire.MAX_FRAME // 100
+    asyncio.run(run(bomb))
+    asyncio.run(run(zlib.compress(b"[1, 2, 3]")[:-4]))   # truncated stream
+    print("PASS: frames inflating past MAX_FRAME or truncated are rejected")
+
+if __name__ == "__main__":
+    test_mixed_stream_roundtrip()
+    test_negotiation_falls_back_to_json_lines()
+    test_compressed_frame_size_is_bounded()
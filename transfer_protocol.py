@@ -0,0 +1,139 @@
+"""
+transfer_protocol.py — wire format shared by tcpclient_nonblocking.py and
+tcpserver_nonblocking.py.
+
+v1 (original):
+    name_len u32 | name | size u64 | md5[16] | body            -> b"OK" / b"BAD"
+TXF2 (streaming):
+    b"TXF2" | name_len u32 | name | size u64 | body | md5[16]  -> b"OK" / b"BAD"
+    The digest trails the body, so the sender can hash while it streams
+    instead of reading the whole file first.
+TXF3 (resumable, parallel, per-chunk integrity): a connection carries any
+number of requests, each b"TXF3" | op u8 | transfer_id[16] | ..., each
+answered with status u8 | payload_len u32 | payload:
+    OPEN    name_len u32 | name | size u64 | manifest
+            -> OK, payload = ranges the server already holds
+            -> BAD if the id is in use for another file or manifest
+    RANGE   offset u64 | length u64 | body
+            -> OK, or BAD + the chunks that failed; the good ones are kept
+    COMMIT  -> OK once every chunk is verified, else MISSING + the gaps
+    manifest = chunk_size u32 | has_root u8 | [root[32]] | digest[16] * n_chunks,
+    a BLAKE2b-128 digest per chunk. The server checks each chunk as it arrives,
+    so a corrupt byte costs one chunk, not the file. RANGE offsets are chunk
+    aligned and lengths whole chunks (or up to the end of the file). The root,
+    if sent, is BLAKE2b-256 over the chunk digests: at COMMIT the server
+    re-reads the file, and chunks that no longer match are reported MISSING.
+    The transfer id names one upload across connections and restarts, so a
+    client can split the file over several connections and, after an
+    interruption, send only the chunks the server doesn't hold yet.
+    Ranges are encoded as count u32 | (start u64, end u64) * count.
+
+All integers are big-endian. The server tells the versions apart by the
+first four bytes: b"TXF2" read as a name length is far above MAX_NAME.
+"""
+
+import hashlib
+import struct
+
+CHUNK = 64 * 1024
+MAX_NAME = 4096
+MAGIC_V2 = b"TXF2"
+MAGIC_V3 = b"TXF3"
+DIGEST_SIZE = 16
+TID_SIZE = 16
+CHUNK_DIGEST_SIZE = 16
+ROOT_SIZE = 32
+MAX_CHUNK = 64 * 1024 * 1024
+MAX_MANIFEST = 16 * 1024 * 1024    # 1 TiB in 1 MiB chunks
+
+OP_OPEN, OP_RANGE, OP_COMMIT = 1, 2, 3
+ST_OK, ST_BAD, ST_MISSING = 0, 1, 2
+
+
+def new_hasher():
+    return hashlib.md5()
+
+
+def new_chunk_hasher():
+    return hashlib.blake2b(digest_size=CHUNK_DIGEST_SIZE)
+
+
+def root_hash(digests: bytes) -> bytes:
+    """The whole-file hash: BLAKE2b-256 over the concatenated chunk digests."""
+    return hashlib.blake2b(digests, digest_size=ROOT_SIZE).digest()
+
+
+def n_chunks(size: int, chunk_size: int) -> int:
+    return -(-size // chunk_size)
+
+
+def v1_header(name: str, size: int, digest: bytes) -> bytes:
+    n = name.encode()
+    return struct.pack(">I", len(n)) + n + struct.pack(">Q", size) + digest
+
+
+def v2_header(name: str, size: int) -> bytes:
+    n = name.encode()
+    return MAGIC_V2 + struct.pack(">I", len(n)) + n + struct.pack(">Q", size)
+
+
+def v3_request(op: int, tid: bytes, body: bytes = b"") -> bytes:
+    return MAGIC_V3 + bytes([op]) + tid + body
+
+
+def v3_open(tid: bytes, name: str, size: int, chunk_size: int, digests: bytes,
+            root: bool = False) -> bytes:
+    n = name.encode()
+    manifest = struct.pack(">IB", chunk_size, root) + (root_hash(digests) if root else b"") + digests
+    return v3_request(OP_OPEN, tid, struct.pack(">I", len(n)) + n + struct.pack(">Q", size) + manifest)
+
+
+def v3_range(tid: bytes, offset: int, length: int) -> bytes:
+    """Header of a RANGE request; the body follows."""
+    return v3_request(OP_RANGE, tid, struct.pack(">QQ", offset, length))
+
+
+def v3_reply(status: int, payload: bytes = b"") -> bytes:
+    return struct.pack(">BI", status, len(payload)) + payload
+
+
+def pack_ranges(ranges) -> bytes:
+    return struct.pack(">I", len(ranges)) + b"".join(struct.pack(">QQ", a, b) for a, b in ranges)
+
+
+def unpack_ranges(data: bytes):
+    (n,) = struct.unpack_from(">I", data)
+    return [struct.unpack_from(">QQ", data, 4 + 16 * i) for i in range(n)]
+
+
+def add_range(ranges, start: int, end: int):
+    """Insert [start, end) into a sorted list of disjoint ranges, merging neighbours."""
+    out = []
+    for a, b in ranges:
+        if b < start or a > end:
+            out.append((a, b))
+        else:
+            start, end = min(a, start), max(b, end)
+    out.append((start, end))
+    return sorted(out)
+
+
+def remove_range(ranges, start: int, end: int):
+    """Cut [start, end) out of a sorted list of disjoint ranges."""
+    out = []
+    for a, b in ranges:
+        if a < start: out.append((a, min(b, start)))
+        if b > end: out.append((max(a, end), b))
+    return out
+
+
+def missing_ranges(ranges, size: int):
+    """The gaps in [0, size) not covered by the sorted ranges."""
+    gaps, pos = [], 0
+    for a, b in ranges:
+        if a > pos:
+            gaps.append((pos, a))
+        pos = max(pos, b)
+    if pos < size:
+        gaps.append((pos, size))
+    return gaps